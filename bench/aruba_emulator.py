@@ -0,0 +1,235 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+"""
+Minimal Aruba controller emulator.
+
+Speaks just enough of the controller web interface for the `Aruba`
+driver: login, station table, SSID profile listing and editing.  The
+station table is synthetic, with configurable size and churn, so that
+the rest of the stack can be exercised without real hardware:
+
+    python3 bench/aruba_emulator.py --port 8443 --stations 5000
+
+and then use `address = http://localhost:8443` in the `[aruba]` section.
+"""
+
+import click
+import random
+import threading
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
+from time import sleep
+
+import uuid
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Controller(object):
+    """State of the emulated controller."""
+
+    def __init__(self, stations=1000, aps=50, essids=('eduroam', 'NTK-Guest'),
+                 profiles=4, prefix='wifinator-', churn=0.05, delay=0.0):
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.delay = delay
+        self.churn = churn
+
+        self.aps = ['00:0b:86:00:{0:02x}:{1:02x}'.format(i // 256, i % 256)
+                    for i in range(aps)]
+        self.essids = list(essids)
+        self.names = ['user{0}'.format(i) for i in range(max(1, stations * 2 // 3))] \
+                   + ['guest{0}@cvut.cz'.format(i) for i in range(stations // 3 + 1)]
+
+        self.profiles = {'default': {'ssid': 'default', 'psk': 'default1',
+                                     'active': True}}
+
+        for i in range(profiles):
+            name = '{0}{1}'.format(prefix, i + 1)
+            self.profiles[name] = {'ssid': name, 'psk': 'xxx', 'active': False}
+
+        self.stations = [self.station(i) for i in range(stations)]
+
+    def station(self, i):
+        return [
+            '{0:012x}'.format(0x10000000 + i),
+            random.choice(self.names),
+            'authenticated',
+            '00:{0:02d}:{1:02d}'.format(random.randint(0, 59), random.randint(0, 59)),
+            'Yes',
+            random.choice(self.aps),
+            random.choice(self.essids),
+            'a-HT-40',
+            'No',
+            'default',
+        ]
+
+    def shuffle(self):
+        """Move some of the stations around, like real users do."""
+
+        with self.lock:
+            for i in random.sample(range(len(self.stations)),
+                                   int(len(self.stations) * self.churn)):
+                self.stations[i][5] = random.choice(self.aps)
+
+    def login(self, username, password):
+        session = uuid.uuid4().hex
+
+        with self.lock:
+            self.sessions.add(session)
+
+        return session
+
+    def execute(self, command, session):
+        if self.delay:
+            sleep(self.delay)
+
+        if session not in self.sessions:
+            return '<re><data>Not authenticated</data></re>'
+
+        words = command.split()
+
+        if command == 'show roleinfo':
+            return '<re><data><r>root</r></data></re>'
+
+        if command == 'show station-table':
+            self.shuffle()
+
+            with self.lock:
+                return table(['MAC', 'Name', 'Role', 'Age', 'Auth', 'AP name',
+                              'Essid', 'Phy', 'Remote', 'Profile'],
+                             self.stations)
+
+        if command == 'show wlan ssid-profile':
+            with self.lock:
+                return table(['Profile name', 'References'],
+                             [[name, '1'] for name in sorted(self.profiles)])
+
+        if words[:3] == ['show', 'wlan', 'ssid-profile'] and len(words) == 4:
+            profile = self.profiles.get(words[3])
+
+            if profile is None:
+                return '<re><data>No such profile</data></re>'
+
+            return table(['Parameter', 'Value'], [
+                ['ESSID', profile['ssid']],
+                ['SSID enable', 'Enabled' if profile['active'] else 'Disabled'],
+            ])
+
+        if words[:2] == ['wlan', 'ssid-profile'] and len(words) >= 4:
+            with self.lock:
+                profile = self.profiles.setdefault(words[2], {
+                    'ssid': words[2], 'psk': 'xxx', 'active': False,
+                })
+
+                if words[3] == 'essid':
+                    profile['ssid'] = ' '.join(words[4:])
+                elif words[3] == 'wpa-passphrase':
+                    profile['psk'] = ' '.join(words[4:])
+                elif words[3] == 'ssid-enable':
+                    profile['active'] = True
+                elif words[3:] == ['no', 'ssid-enable']:
+                    profile['active'] = False
+
+            return '<re><data>OK</data></re>'
+
+        return '<re><data>Unknown command</data></re>'
+
+
+def table(headers, rows):
+    out = ['<re><t tn="table">']
+    out.append('<th>' + ''.join('<h>{0}</h>'.format(escape(h)) for h in headers) + '</th>')
+
+    for row in rows:
+        out.append('<r>' + ''.join('<c>{0}</c>'.format(escape(c)) for c in row) + '</r>')
+
+    out.append('</t></re>')
+    return ''.join(out)
+
+
+def make_handler(controller):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, body, headers={}):
+            body = body.encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+
+            for name, value in headers.items():
+                self.send_header(name, value)
+
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+
+            if not path.endswith('/execCommandReturnResult.xml'):
+                self.send_error(404)
+                return
+
+            command = unquote(query).split('@@', 1)[0]
+            session = unquote(query).rpartition('UIDARUBA=')[2]
+            self.reply(controller.execute(command, session))
+
+        def do_POST(self):
+            size = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(size)
+
+            if not self.path.endswith('/wms.login'):
+                self.send_error(404)
+                return
+
+            session = controller.login(None, None)
+            self.reply('<html>Authentication complete</html>', {
+                'Set-Cookie': 'SESSION={0}; Path=/'.format(session),
+            })
+
+    return Handler
+
+
+def serve(controller, host='127.0.0.1', port=0):
+    """Start the emulator in a background thread, return the server."""
+
+    server = ThreadingHTTPServer((host, port), make_handler(controller))
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on.')
+@click.option('--port', '-p', default=8443, help='Port to listen on.')
+@click.option('--stations', '-s', default=1000, help='Number of stations.')
+@click.option('--aps', '-a', default=50, help='Number of access points.')
+@click.option('--delay', '-d', default=0.0, help='Seconds per command.')
+def cli(host, port, stations, aps, delay):
+    controller = Controller(stations=stations, aps=aps, delay=delay)
+    server = ThreadingHTTPServer((host, port), make_handler(controller))
+
+    print('Emulating controller on http://{0}:{1}'.format(host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    cli()
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,480 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+"""
+HTTP load test for wifinatord.
+
+Drives a mix of traffic against a running site, or against one started
+just for the test, and reports latency percentiles, throughput and
+error rate of every endpoint.  Requests are issued at fixed rates,
+regardless of how quickly the site responds, and latency is measured
+from the moment every request was due.  Overload therefore shows up as
+growing latency instead of silently lower load.  Form submissions that
+the site rejects count as errors, even though it answers them with
+a redirect like the successful ones.
+
+To test an already running instance, pass its address:
+
+    python3 bench/loadtest.py --url http://localhost:6060
+
+Otherwise the complete stack is started locally: the controller emulator
+from `aruba_emulator.py` and `wifinatord` configured to use it.  The site
+needs PostgreSQL.  Either pass `--database-url` of an empty database
+that the schema gets loaded into:
+
+    createdb wifi_load
+    python3 bench/loadtest.py --database-url postgresql:///wifi_load
+
+or, with the PostgreSQL server binaries (`initdb`, `pg_ctl`) on the
+PATH, leave it out and a throwaway cluster is created in a temporary
+directory and removed afterwards.
+
+Rates are in requests per second, zero disables the endpoint:
+
+    python3 bench/loadtest.py --duration 60 --zones 20 --create 0.5
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import click
+import base64
+import random
+import shutil
+import socket
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.client import HTTPConnection
+from subprocess import Popen, run, DEVNULL
+from tempfile import mkdtemp
+from urllib.parse import urlparse, urlencode
+
+from aruba_emulator import Controller, serve
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEADERS = {
+    'X-Roles': 'omnipotent',
+    'X-User-Id': '1',
+    'X-Full-Name': 'Load Test',
+}
+
+CONFIG = '''
+[http]
+host = 127.0.0.1
+port = {port}
+debug = no
+
+[aruba]
+address = {aruba}
+username = admin
+password = aruba
+profile-prefix = wifinator-
+
+[affiliation]
+cvut = CVUT cvut.cz *.cvut.cz
+
+[database]
+url = {database}
+
+[access]
+admin = +omnipotent
+user = +* -impotent
+'''
+
+
+# Statuses of a redirect, which the client does not follow.
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+def flashed_errors(cookies):
+    """
+    Error messages flashed into the session by the given response.
+
+    The signed session cookie is only decoded here, not verified.
+    """
+
+    errors = []
+
+    for cookie in cookies:
+        m = re.match(r'session=([^;]*)', cookie)
+
+        if m is None or not m.group(1):
+            continue
+
+        value = m.group(1)
+        payload = value.lstrip('.').split('.')[0]
+        data = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+
+        if value.startswith('.'):
+            data = zlib.decompress(data)
+
+        for flash in json.loads(data.decode('utf8')).get('_flashes', []):
+            # Tuples are tagged by the session serializer.
+            category, message = flash.get(' t', flash) \
+                                    if isinstance(flash, dict) else flash
+
+            if category == 'error':
+                errors.append(message)
+
+    return errors
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Stats(object):
+    """Latencies and errors of a single endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.latencies.append(latency)
+
+            if not ok:
+                self.errors += 1
+
+    def summary(self, duration):
+        lat = sorted(self.latencies)
+
+        def pct(p):
+            if not lat:
+                return 0.0
+            return lat[min(len(lat) - 1, int(len(lat) * p / 100))] * 1000
+
+        return {
+            'requests': len(lat),
+            'rps': len(lat) / duration,
+            'errors': 100.0 * self.errors / len(lat) if lat else 0.0,
+            'p50': pct(50),
+            'p90': pct(90),
+            'p99': pct(99),
+            'max': lat[-1] * 1000 if lat else 0.0,
+        }
+
+
+class LoadTest(object):
+    def __init__(self, url, concurrency):
+        u = urlparse(url)
+        self.host = u.hostname
+        self.port = u.port or 80
+
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.stats = {}
+
+        # Identifiers of profiles seen on the index page.
+        self.profiles = []
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, path, form=None):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = self.local.conn = HTTPConnection(self.host, self.port, timeout=60)
+
+        headers = dict(HEADERS)
+        body = None
+
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        try:
+            conn.request(method, path, body, headers)
+            r = conn.getresponse()
+            return r.status, r.msg, r.read()
+        except Exception:
+            conn.close()
+            self.local.conn = None
+            raise
+
+    def index(self):
+        status, headers, body = self.request('GET', '/')
+        ids = re.findall(rb'/edit/(\d+)"', body)
+
+        if ids:
+            self.profiles = [int(i) for i in ids]
+
+        return status
+
+    def submit(self, path, form):
+        """
+        Post a form, return 422 if the site has rejected it.
+
+        Rejected forms are answered with a redirect back to the form or
+        with an error flashed for the page the client is redirected to.
+        """
+
+        status, headers, body = self.request('POST', path, form)
+
+        if status in REDIRECTS:
+            location = urlparse(headers.get('Location', '')).path
+
+            if location.startswith('/edit/') \
+                    or flashed_errors(headers.get_all('Set-Cookie', [])):
+                return 422
+
+        return status
+
+    def zones(self):
+        return self.request('GET', '/zones')[0]
+
+    def stations(self):
+        return self.request('GET', '/stations?limit=100')[0]
+
+    def create(self):
+        with self.lock:
+            self.counter += 1
+            n = self.counter
+
+        day = (date(2200, 1, 1) + timedelta(days=n + random.randint(0, 10 ** 5))) \
+                .strftime('%Y-%m-%d')
+
+        return self.submit('/create', {
+            'ssid': 'load-{0}-{1}'.format(os.getpid(), n),
+            'psk': 'loadtest-{0}'.format(n),
+            'start': day,
+            'stop': day,
+        })
+
+    def edit(self):
+        if not self.profiles:
+            return None
+
+        pid = random.choice(self.profiles)
+        return self.submit('/edit/{0}/confirm'.format(pid), {
+            'psk': 'edited-{0}'.format(random.randint(0, 10 ** 6)),
+        })
+
+    def printable(self):
+        if not self.profiles:
+            return None
+
+        pid = random.choice(self.profiles)
+        return self.request('GET', '/printable/{0}'.format(pid))[0]
+
+    def call(self, name, due):
+        fn = getattr(self, name)
+
+        try:
+            status = fn()
+        except Exception:
+            status = 599
+
+        if status is None:
+            return
+
+        self.stats[name].record(time.perf_counter() - due, status < 400)
+
+    def schedule(self, name, rate, deadline):
+        """Submit requests to the endpoint at the given rate."""
+
+        self.stats[name] = Stats()
+        interval = 1.0 / rate
+        due = time.perf_counter() + random.random() * interval
+
+        while due < deadline:
+            delay = due - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            self.executor.submit(self.call, name, due)
+            due += interval
+
+    def run(self, rates, duration):
+        start = time.perf_counter()
+        deadline = start + duration
+
+        threads = [threading.Thread(target=self.schedule,
+                                    args=(name, rate, deadline))
+                   for name, rate in rates.items() if rate > 0]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - start
+
+        return {name: stats.summary(elapsed)
+                for name, stats in self.stats.items()}
+
+
+class Stack(object):
+    """Locally started emulator, database and wifinatord."""
+
+    def __init__(self, database=None, stations=1000, delay=0.0, args=()):
+        self.tmp = mkdtemp(prefix='wifinator-load-')
+        self.postgres = None
+        self.site = None
+
+        self.emulator = serve(Controller(stations=stations, delay=delay))
+        aruba = 'http://127.0.0.1:{0}'.format(self.emulator.server_address[1])
+
+        if database is None:
+            database = self.start_postgres()
+        else:
+            run(['psql', '-q', '-d', database, '-f',
+                 os.path.join(ROOT, 'sql', 'schema.sql')],
+                stdout=DEVNULL, stderr=DEVNULL)
+
+        self.port = free_port()
+        self.url = 'http://127.0.0.1:{0}'.format(self.port)
+
+        config = os.path.join(self.tmp, 'wifinator.ini')
+
+        with open(config, 'w') as fp:
+            fp.write(CONFIG.format(port=self.port, aruba=aruba,
+                                   database=database))
+
+        self.log = open(os.path.join(self.tmp, 'wifinatord.log'), 'w')
+        self.site = Popen([sys.executable, '-m', 'wifinator.bin.wifinatord',
+                           '--config', config] + list(args),
+                          cwd=ROOT, stdout=self.log, stderr=self.log,
+                          env=dict(os.environ, PYTHONPATH=ROOT))
+
+        self.wait()
+
+    def start_postgres(self):
+        data = os.path.join(self.tmp, 'pgdata')
+        port = free_port()
+
+        run(['initdb', '-D', data, '-U', 'wifi', '--auth=trust'],
+            stdout=DEVNULL, check=True)
+
+        run(['pg_ctl', '-D', data, '-w', '-l', os.path.join(self.tmp, 'pg.log'),
+             '-o', '-p {0} -k {1} -c listen_addresses=127.0.0.1' \
+                        .format(port, self.tmp),
+             'start'], stdout=DEVNULL, check=True)
+
+        self.postgres = data
+
+        # The dump also adjusts privileges of roles we do not have,
+        # those statements are harmless to skip.
+        run(['psql', '-q', '-h', self.tmp, '-p', str(port), '-U', 'wifi',
+             '-d', 'postgres', '-f', os.path.join(ROOT, 'sql', 'schema.sql')],
+            stdout=DEVNULL, stderr=DEVNULL)
+
+        return 'postgresql://wifi@127.0.0.1:{0}/postgres'.format(port)
+
+    def wait(self, timeout=60):
+        deadline = time.time() + timeout
+
+        while time.time() < deadline:
+            if self.site.poll() is not None:
+                raise click.ClickException('wifinatord exited, see {0}' \
+                                                .format(self.log.name))
+            try:
+                conn = HTTPConnection('127.0.0.1', self.port, timeout=5)
+                conn.request('GET', '/zones', headers=HEADERS)
+
+                if conn.getresponse().status < 500:
+                    return
+            except Exception:
+                pass
+
+            time.sleep(0.5)
+
+        raise click.ClickException('wifinatord did not start in time')
+
+    def stop(self):
+        if self.site is not None and self.site.poll() is None:
+            self.site.terminate()
+            self.site.wait()
+
+        self.emulator.shutdown()
+
+        if self.postgres is not None:
+            run(['pg_ctl', '-D', self.postgres, '-m', 'fast', 'stop'],
+                stdout=DEVNULL)
+
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+@click.command()
+@click.option('--url', '-u', help='Test an already running site.')
+@click.option('--database-url', help='Empty PostgreSQL database to use.')
+@click.option('--stations', default=1000, help='Emulated stations.')
+@click.option('--controller-delay', default=0.0,
+              help='Emulated controller latency per command.')
+@click.option('--duration', '-t', default=30.0, help='Seconds to run for.')
+@click.option('--concurrency', '-c', default=50,
+              help='Maximum requests in flight.')
+@click.option('--index', default=2.0, help='Index page rate.')
+@click.option('--zones', default=10.0, help='/zones polling rate.')
+@click.option('--stations-api', default=1.0, help='/stations rate.')
+@click.option('--create', default=0.2, help='Profile creation rate.')
+@click.option('--edit', default=0.2, help='Profile editing rate.')
+@click.option('--printable', default=0.2, help='Printable PDF rate.')
+@click.option('--json', 'as_json', is_flag=True, help='Output JSON.')
+@click.argument('site_args', nargs=-1)
+def cli(url, database_url, stations, controller_delay, duration, concurrency,
+        index, zones, stations_api, create, edit, printable, as_json,
+        site_args):
+    """
+    Load test wifinatord.
+
+    Extra arguments are passed to the locally started wifinatord.
+    """
+
+    stack = None
+
+    if url is None:
+        stack = Stack(database_url, stations, controller_delay, site_args)
+        url = stack.url
+
+    try:
+        test = LoadTest(url, concurrency)
+
+        # Learn about some profiles first.
+        test.index()
+
+        results = test.run({
+            'index': index,
+            'zones': zones,
+            'stations': stations_api,
+            'create': create,
+            'edit': edit,
+            'printable': printable,
+        }, duration)
+
+    finally:
+        if stack is not None:
+            stack.stop()
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{0:<10} {1:>8} {2:>8} {3:>7} {4:>9} {5:>9} {6:>9} {7:>9}'.format(
+          'Endpoint', 'Requests', 'Req/s', 'Err %', 'p50 ms', 'p90 ms',
+          'p99 ms', 'Max ms'))
+
+    for name, r in sorted(results.items()):
+        print('{0:<10} {requests:>8} {rps:>8.1f} {errors:>7.1f} {p50:>9.1f} '
+              '{p90:>9.1f} {p99:>9.1f} {max:>9.1f}'.format(name, **r))
+
+
+if __name__ == '__main__':
+    cli()
+
+
+# vim:set sw=4 ts=4 et:
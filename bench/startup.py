@@ -0,0 +1,96 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+"""
+Startup time regression benchmark for wifinatorctl.
+
+Runs the command-line client repeatedly in fresh interpreters and
+reports the median wall time.  Also makes sure that none of the heavy
+libraries get imported just by loading the client.  Exits with a non-zero
+status when either check fails, so that it can be run from CI:
+
+    python3 bench/startup.py --max 250
+"""
+
+import os
+import sys
+import click
+
+from statistics import median
+from subprocess import run, DEVNULL
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+
+
+# Libraries that must only be imported by sub-commands that need them.
+HEAVY = ('requests', 'ldap3', 'tabulate', 'sqlalchemy', 'sqlsoup',
+         'twisted', 'numpy')
+
+CONFIG = '''
+[aruba]
+address = aruba.invalid
+username = admin
+password = aruba
+
+[affiliation]
+cvut = CVUT cvut.cz *.cvut.cz
+'''
+
+CHECK = '''
+import sys
+import wifinator.bin.wifinatorctl
+print(' '.join(m for m in {0!r} if m in sys.modules))
+'''.format(HEAVY)
+
+
+@click.command()
+@click.option('--runs', '-n', default=20, help='Number of runs.')
+@click.option('--max', '-m', 'limit', default=None, type=float,
+              metavar='MS', help='Fail when the median exceeds this.')
+def bench(runs, limit):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+
+    failed = False
+
+    r = run([sys.executable, '-c', CHECK], env=env,
+            capture_output=True, universal_newlines=True, check=True)
+
+    if r.stdout.strip():
+        print('Eagerly imported: {0}'.format(r.stdout.strip()))
+        failed = True
+
+    with NamedTemporaryFile('w', suffix='.ini') as fp:
+        fp.write(CONFIG)
+        fp.flush()
+
+        cmds = {
+            'python': [sys.executable, '-c', 'pass'],
+            'help': [sys.executable, '-m', 'wifinator.bin.wifinatorctl',
+                     '--config', fp.name, '--help'],
+            'sub-help': [sys.executable, '-m', 'wifinator.bin.wifinatorctl',
+                         '--config', fp.name, 'stations', '--help'],
+        }
+
+        for name, cmd in cmds.items():
+            times = []
+
+            for i in range(runs):
+                start = perf_counter()
+                run(cmd, env=env, stdout=DEVNULL, check=True)
+                times.append((perf_counter() - start) * 1000)
+
+            print('{0:<10} median {1:7.1f} ms  min {2:7.1f} ms' \
+                    .format(name, median(times), min(times)))
+
+            if limit is not None and name != 'python' and median(times) > limit:
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    bench()
+
+
+# vim:set sw=4 ts=4 et:
@@ -31,6 +31,9 @@ setup(**{
         wifinatord=wifinator.bin.wifinatord:cli
     ''',
     'install_requires': read_requires(),
+    'extras_require': {
+        'report': ['numpy'],
+    },
     'zip_safe': False,
 })
 
@@ -0,0 +1,72 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+import pytest
+
+
+# Headers set by the authenticating proxy in front of the website.
+ADMIN = {'X-Roles': 'omnipotent', 'X-Full-Name': 'Tester', 'X-User-Id': '1'}
+USER = {'X-Roles': 'student', 'X-Full-Name': 'Student', 'X-User-Id': '2'}
+
+
+@pytest.fixture
+def db(tmp_path):
+    sqlsoup = pytest.importorskip('sqlsoup')
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import scoped_session, sessionmaker
+
+    engine = create_engine('sqlite:///' + str(tmp_path / 'db.sqlite'))
+    engine.execute('CREATE TABLE profile (id INTEGER PRIMARY KEY, '
+                   'ssid VARCHAR, psk VARCHAR, start TIMESTAMP, stop TIMESTAMP)')
+    engine.execute('CREATE TABLE audit (id INTEGER PRIMARY KEY, '
+                   'profile INTEGER, old_data JSON, new_data JSON, '
+                   'time TIMESTAMP, user VARCHAR)')
+    engine.execute('CREATE TABLE location (ap VARCHAR PRIMARY KEY, '
+                   'location VARCHAR)')
+
+    session = scoped_session(sessionmaker(autocommit=False, autoflush=False))
+    return sqlsoup.SQLSoup(engine, session=session)
+
+
+@pytest.fixture
+def manager(db):
+    from wifinator.aruba import Aruba
+    from wifinator.manager import Manager
+
+    # Nothing listens there, tests provide the station snapshot.
+    aruba = Aruba('http://127.0.0.1:9', 'user', 'secret', retries=0)
+
+    manager = Manager(db, aruba, 'wifinator-')
+    manager.syncs = []
+    manager.schedule_sync = lambda force=[]: manager.syncs.append(force)
+    return manager
+
+
+@pytest.fixture
+def app(db, manager):
+    pytest.importorskip('flask_qrcode')
+
+    from wifinator.rbac import AccessModel
+    from wifinator.site import make_site
+
+    access = AccessModel([('admin', '+omnipotent'), ('user', '+* -impotent')])
+
+    app = make_site(db, manager, access)
+    app.testing = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def flashes(client):
+    """Messages flashed to the client so far."""
+
+    with client.session_transaction() as session:
+        return session.get('_flashes', [])
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,135 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifinator.affiliation import LdapResolver, ResolverCache
+
+ldap3 = pytest.importorskip('ldap3')
+
+
+BASE = 'ou=people,dc=example,dc=org'
+
+USERS = {
+    'alice': 'cvut.cz',
+    'bob': 'vscht.cz',
+    'carol': 'cuni.cz',
+}
+
+
+class CountingConnect(object):
+    """Opens mock connections pre-populated with the test users."""
+
+    def __init__(self):
+        self.server = ldap3.Server('mock')
+        self.searches = 0
+        self.connections = []
+
+    def __call__(self):
+        conn = ldap3.Connection(self.server, 'cn=admin,dc=example,dc=org',
+                                'secret', client_strategy=ldap3.MOCK_SYNC)
+
+        for uid, domain in USERS.items():
+            conn.strategy.add_entry('uid={0},{1}'.format(uid, BASE), {
+                'objectClass': ['inetOrgPerson'],
+                'uid': uid,
+                'o': domain,
+            })
+
+        conn.bind()
+
+        search = conn.search
+
+        def counting_search(*args, **kwargs):
+            self.searches += 1
+            return search(*args, **kwargs)
+
+        conn.search = counting_search
+        self.connections.append(conn)
+        return conn
+
+
+def make_resolver(connect, **kwargs):
+    return LdapResolver(connect, BASE, '(uid={name})', 'o', **kwargs)
+
+
+def test_resolve_batches_and_marks_missing():
+    connect = CountingConnect()
+
+    with make_resolver(connect, batch=2) as resolver:
+        found = resolver.resolve(['alice', 'bob', 'carol', 'mallory', 'bob'])
+
+    assert found == dict(USERS, mallory=None)
+
+    # Four distinct names in batches of two.
+    assert connect.searches == 2
+
+
+def test_resolve_without_batching():
+    connect = CountingConnect()
+
+    resolver = LdapResolver(connect, BASE, '(&(uid={name})(o=*))', 'o')
+
+    try:
+        assert resolver.resolve(['alice', 'nobody']) == \
+                {'alice': 'cvut.cz', 'nobody': None}
+    finally:
+        resolver.close()
+
+    assert connect.searches == 2
+
+
+def test_cache_hit_skips_search(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+
+    connect = CountingConnect()
+    with make_resolver(connect, cache=ResolverCache(path)) as resolver:
+        resolver.resolve(['alice', 'bob'])
+
+    assert connect.searches == 1
+
+    connect = CountingConnect()
+    with make_resolver(connect, cache=ResolverCache(path)) as resolver:
+        assert resolver.resolve(['alice', 'bob']) == \
+                {'alice': 'cvut.cz', 'bob': 'vscht.cz'}
+
+    assert connect.searches == 0
+
+
+def test_negative_cache_expires(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+
+    cache = ResolverCache(path, negative_ttl=3600)
+    with make_resolver(CountingConnect(), cache=cache) as resolver:
+        assert resolver.resolve(['mallory']) == {'mallory': None}
+
+    # Cached as not found.
+    connect = CountingConnect()
+    with make_resolver(connect, cache=ResolverCache(path)) as resolver:
+        assert resolver.resolve(['mallory']) == {'mallory': None}
+
+    assert connect.searches == 0
+
+    # Looked up again once the negative entry expires.
+    connect = CountingConnect()
+    cache = ResolverCache(path, negative_ttl=-1)
+    with make_resolver(connect, cache=cache) as resolver:
+        cache.put_many({'mallory': None})
+        resolver.resolve(['mallory'])
+
+    assert connect.searches == 1
+
+
+def test_close_unbinds_connections():
+    connect = CountingConnect()
+
+    resolver = make_resolver(connect, batch=1, connections=2)
+    resolver.resolve(['alice', 'bob', 'carol'])
+    resolver.close()
+
+    assert connect.connections
+    assert all(conn.closed for conn in connect.connections)
+    assert resolver.executor is None
+
+
+# vim:set sw=4 ts=4 et:
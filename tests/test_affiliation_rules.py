@@ -0,0 +1,91 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from fnmatch import fnmatch
+from itertools import product
+
+import re
+
+import pytest
+
+from wifinator.affiliation import AffiliationRules
+
+
+RULES = [
+    ('cvut', 'cvut.cz *.cvut.cz'),
+    ('vscht', 'vscht.cz *.vscht.cz'),
+    ('fel', '*.fel.cvut.cz'),
+    ('uk', 'cuni.cz *.cuni.cz UK-*'),
+    ('guests', 'Guest-??  Visitor[0-9]'),
+    ('staff', 'Staff-ESSID'),
+    ('any-cz', '*.cz'),
+]
+
+DOMAINS = [None, 'cvut.cz', 'fel.cvut.cz', 'student.fel.cvut.cz', 'vscht.cz',
+           'cuni.cz', 'natur.cuni.cz', 'xcvut.cz', 'seznam.cz', 'example.org',
+           'Staff-ESSID', 'UK-FF', 'cz', '.cvut.cz']
+
+ESSIDS = ['eduroam', 'Staff-ESSID', 'UK-FF', 'UK-', 'Guest-01', 'Guest-001',
+          'Visitor7', 'VisitorX', 'cvut.cz', 'sub.vscht.cz']
+
+
+def classify_by_loop(rules, domain, essid):
+    """The original rule evaluation, one fnmatch at a time."""
+
+    for org, patterns in rules:
+        for rule in re.split(r'\s+', patterns.strip()):
+            if domain is not None and fnmatch(domain, rule):
+                return org
+
+            if fnmatch(essid, rule):
+                return org
+
+    if domain is None:
+        return 'Local'
+
+    return 'Other'
+
+
+@pytest.mark.parametrize('rules', [
+    RULES,
+    list(reversed(RULES)),
+    RULES[:2],
+    [],
+])
+def test_matches_the_original_loop(rules):
+    compiled = AffiliationRules(rules)
+
+    for domain, essid in product(DOMAINS, ESSIDS):
+        assert compiled.classify(domain, essid) == \
+                classify_by_loop(rules, domain, essid), (domain, essid)
+
+
+def test_first_rule_wins_between_essid_and_domain():
+    rules = AffiliationRules([('staff', 'Staff-ESSID'), ('cvut', '*.cvut.cz')])
+
+    # ESSID rule is listed first.
+    assert rules.classify('fel.cvut.cz', 'Staff-ESSID') == 'staff'
+    assert rules.classify('fel.cvut.cz', 'eduroam') == 'cvut'
+
+    rules = AffiliationRules([('cvut', '*.cvut.cz'), ('staff', 'Staff-ESSID')])
+    assert rules.classify('fel.cvut.cz', 'Staff-ESSID') == 'cvut'
+
+
+def test_fallbacks():
+    rules = AffiliationRules([('cvut', 'cvut.cz')])
+
+    assert rules.classify(None, 'eduroam') == 'Local'
+    assert rules.classify('example.org', 'eduroam') == 'Other'
+
+
+def test_memo_is_bounded(monkeypatch):
+    monkeypatch.setattr(AffiliationRules, 'MEMO_SIZE', 10)
+    rules = AffiliationRules(RULES)
+
+    for i in range(25):
+        assert rules.classify('host{0}.cvut.cz'.format(i), 'eduroam') == 'cvut'
+
+    assert len(rules.memo) <= 10
+
+
+# vim:set sw=4 ts=4 et:
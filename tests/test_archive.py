@@ -0,0 +1,96 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+import gzip
+
+import pytest
+
+from wifinator.archive import ArchiveError, append_snapshot, \
+                              read_snapshots, last_snapshot, COLUMNS
+
+
+def make_stations(count, essids=('eduroam', 'guest')):
+    stations = []
+
+    for i in range(count):
+        station = {c: '' for c in COLUMNS}
+        station.update({
+            'mac': '00:0b:86:{0:02x}:{1:02x}:{2:02x}'.format(
+                        i >> 16, (i >> 8) & 0xff, i & 0xff),
+            'name': 'user{0}'.format(i),
+            'ap': 'ap{0}'.format(i % 7),
+            'essid': essids[i % len(essids)],
+            'age': '00:00:{0:02d}'.format(i % 60),
+        })
+        stations.append(station)
+
+    return stations
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'stations.wfs')
+
+    first = make_stations(10)
+    second = make_stations(300, essids=('eduroam', 'guest', 'Staff'))
+
+    append_snapshot(path, first, 1000.0)
+    append_snapshot(path, second, 2000.0)
+
+    snapshots = list(read_snapshots(path))
+
+    assert [s.time for s in snapshots] == [1000.0, 2000.0]
+    assert [len(s) for s in snapshots] == [10, 300]
+    assert list(snapshots[0].iter_stations()) == first
+    assert list(snapshots[1].iter_stations()) == second
+
+    # Repetitive columns are only stored once.
+    assert sorted(snapshots[1].dicts['essid']) == ['Staff', 'eduroam', 'guest']
+
+    last = last_snapshot(path)
+    assert last.time == 2000.0
+    assert last.list_stations() == {s['mac']: s for s in second}
+
+
+def test_wide_codes(tmp_path):
+    path = str(tmp_path / 'stations.wfs')
+
+    # More distinct names than fit into a single byte or two.
+    stations = make_stations(70000)
+    append_snapshot(path, stations, 1000.0)
+
+    assert list(last_snapshot(path).iter_stations()) == stations
+
+
+def test_empty_archive(tmp_path):
+    path = str(tmp_path / 'stations.wfs')
+    open(path, 'wb').close()
+
+    with pytest.raises(ArchiveError):
+        last_snapshot(path)
+
+
+def test_foreign_file(tmp_path):
+    path = str(tmp_path / 'stations.wfs')
+
+    with gzip.open(path, 'wb') as fp:
+        fp.write(b'something else entirely')
+
+    with pytest.raises(ArchiveError):
+        list(read_snapshots(path))
+
+
+def test_truncated_snapshot(tmp_path):
+    path = str(tmp_path / 'stations.wfs')
+    append_snapshot(path, make_stations(100), 1000.0)
+
+    with gzip.open(path, 'rb') as fp:
+        data = fp.read()
+
+    with gzip.open(path, 'wb') as fp:
+        fp.write(data[:-10])
+
+    with pytest.raises(ArchiveError):
+        list(read_snapshots(path))
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,155 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from threading import Event, Thread
+
+import pytest
+
+from requests.exceptions import ConnectionError
+
+from wifinator import aruba as module
+from wifinator.aruba import Aruba, ArubaUnavailable
+from wifinator.breaker import CircuitBreaker
+from wifinator.scheduler import Scheduler
+
+
+def test_attempt_retries_then_gives_up(monkeypatch):
+    monkeypatch.setattr(module, 'sleep', lambda delay: None)
+
+    aruba = Aruba('http://localhost:1', 'user', 'secret',
+                  breaker=CircuitBreaker(threshold=100), retries=2)
+    calls = []
+
+    def send(timeout):
+        calls.append(None)
+        raise ConnectionError('refused')
+
+    with aruba.scheduler.slot():
+        with pytest.raises(ArubaUnavailable):
+            aruba.attempt(send, aruba.retries)
+
+    assert len(calls) == 3
+
+
+def test_attempt_stops_when_breaker_opens(monkeypatch):
+    monkeypatch.setattr(module, 'sleep', lambda delay: None)
+
+    aruba = Aruba('http://localhost:1', 'user', 'secret',
+                  breaker=CircuitBreaker(threshold=2), retries=5)
+    calls = []
+
+    def send(timeout):
+        calls.append(None)
+        raise ConnectionError('refused')
+
+    with aruba.scheduler.slot():
+        with pytest.raises(ArubaUnavailable):
+            aruba.attempt(send, aruba.retries)
+
+    assert len(calls) == 2
+
+
+def test_backoff_releases_the_slot(monkeypatch):
+    scheduler = Scheduler(concurrency=1)
+    aruba = Aruba('http://localhost:1', 'user', 'secret', scheduler,
+                  retries=1)
+
+    sleeping = Event()
+    admitted = Event()
+
+    def sleep(delay):
+        sleeping.set()
+        assert admitted.wait(5.0)
+
+    monkeypatch.setattr(module, 'sleep', sleep)
+
+    def other():
+        assert sleeping.wait(5.0)
+
+        with scheduler.slot():
+            admitted.set()
+
+    thread = Thread(target=other)
+    thread.start()
+
+    attempts = []
+
+    def send(timeout):
+        attempts.append(None)
+
+        if len(attempts) == 1:
+            raise ConnectionError('refused')
+
+        return 'ok'
+
+    with scheduler.slot():
+        assert aruba.attempt(send, aruba.retries) == 'ok'
+
+    thread.join(5.0)
+    assert admitted.is_set()
+    assert scheduler.running == 0
+
+
+def test_budget_limits_timeouts_and_retries(monkeypatch):
+    now = [100.0]
+
+    monkeypatch.setattr(module, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(module, 'sleep', lambda delay: None)
+    monkeypatch.setattr(module, 'uniform', lambda a, b: 0.0)
+
+    aruba = Aruba('http://localhost:1', 'user', 'secret',
+                  breaker=CircuitBreaker(threshold=100),
+                  timeout=(5.0, 30.0), retries=10, budget=45.0)
+    timeouts = []
+
+    def send(timeout):
+        timeouts.append(timeout)
+        now[0] += timeout[1]
+        raise ConnectionError('timed out')
+
+    with aruba.scheduler.slot():
+        with pytest.raises(ArubaUnavailable):
+            aruba.attempt(send, aruba.retries)
+
+    # The second attempt only gets what is left of the budget.
+    assert timeouts == [(5.0, 30.0), (5.0, 15.0)]
+    assert now[0] == 145.0
+
+
+class SlowResponse(object):
+    def __init__(self, now, chunks):
+        self.now = now
+        self.chunks = chunks
+
+    def iter_content(self, size, decode_unicode=False):
+        for chunk in self.chunks:
+            self.now[0] += 10.0
+            yield chunk
+
+    def close(self):
+        pass
+
+
+def test_budget_covers_streamed_table(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(module, 'monotonic', lambda: now[0])
+
+    aruba = Aruba('http://localhost:1', 'user', 'secret', budget=25.0)
+
+    response = SlowResponse(now, [b'<re><t><th><h>A</h></th>',
+                                  b'<r><c>1</c></r>',
+                                  b'<r><c>2</c></r>',
+                                  b'</t></re>'])
+    aruba.get = lambda command, **kwargs: response
+
+    rows = []
+
+    with pytest.raises(ArubaUnavailable):
+        for row in aruba.iter_table('show user-table'):
+            rows.append(row)
+
+    assert rows == [['1']]
+    assert aruba.scheduler.running == 0
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,153 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+import json
+import os
+
+import pytest
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from wifinator.audit import AuditLog, AuditError, export_audit
+
+
+PROFILE = {
+    'ssid': 'Conference',
+    'psk': 'secret-passphrase',
+    'start': datetime(2026, 10, 1),
+    'stop': datetime(2026, 10, 2, 23, 59, 59),
+}
+
+
+def create(db, audit, user='alice'):
+    profile = db.profile.insert(**PROFILE)
+    db.flush()
+
+    audit.record(user, profile.id, None, PROFILE)
+    audit.commit()
+
+    return profile.id
+
+
+def test_direct(db):
+    audit = AuditLog(db)
+    pid = create(db, audit)
+
+    row, = db.audit.all()
+    assert (row.user, row.profile, row.old_data) == ('alice', pid, None)
+    assert row.new_data['stop'] == '2026-10-02 23:59:59'
+
+
+def test_queue_is_flushed_in_batches(db, tmp_path):
+    audit = AuditLog(db, str(tmp_path / 'audit.queue'), batch=2)
+
+    for user in ('alice', 'bob', 'carol'):
+        create(db, audit, user)
+
+    # Profiles are committed, the records are only queued.
+    assert db.profile.count() == 3
+    assert db.audit.count() == 0
+
+    assert audit.flush() == 3
+    db.rollback()
+
+    assert sorted(row.user for row in db.audit.all()) == \
+            ['alice', 'bob', 'carol']
+
+    assert not os.path.exists(audit.processing)
+    assert audit.flush() == 0
+
+
+def test_queue_rollback(db, tmp_path):
+    audit = AuditLog(db, str(tmp_path / 'audit.queue'))
+
+    db.profile.insert(**PROFILE)
+    audit.record('alice', 1, None, PROFILE)
+    audit.rollback()
+
+    # Nothing was written and the next commit does not carry it over.
+    assert not os.path.exists(audit.queue)
+    create(db, audit, 'bob')
+
+    assert audit.flush() == 1
+    db.rollback()
+    assert [row.user for row in db.audit.all()] == ['bob']
+
+
+def test_failed_commit_cancels_queued_records(db, tmp_path, monkeypatch):
+    audit = AuditLog(db, str(tmp_path / 'audit.queue'))
+
+    def fail():
+        raise SQLAlchemyError('could not serialize access')
+
+    monkeypatch.setattr(db, 'commit', fail)
+
+    with pytest.raises(SQLAlchemyError):
+        create(db, audit)
+
+    monkeypatch.undo()
+    audit.rollback()
+
+    # Record written ahead of the commit is there, but cancelled.
+    with open(audit.queue) as fp:
+        assert [sorted(json.loads(line)) for line in fp] == [
+            ['new_data', 'old_data', 'profile', 'time', 'txn', 'user'],
+            ['cancel'],
+        ]
+
+    assert audit.flush() == 0
+    assert db.audit.count() == 0
+
+
+def test_queue_failure_aborts_the_change(db, tmp_path):
+    audit = AuditLog(db, str(tmp_path / 'missing' / 'audit.queue'))
+
+    with pytest.raises(AuditError):
+        create(db, audit)
+
+    assert db.profile.count() == 0
+
+
+def test_failed_flush_is_retried(db, tmp_path, monkeypatch):
+    audit = AuditLog(db, str(tmp_path / 'audit.queue'))
+    create(db, audit, 'alice')
+
+    def fail(*args, **kwargs):
+        raise SQLAlchemyError('database is gone')
+
+    monkeypatch.setattr('wifinator.audit.insert_records', fail)
+
+    with pytest.raises(SQLAlchemyError):
+        audit.flush()
+
+    monkeypatch.undo()
+
+    # New records wait in the queue until the leftovers are moved.
+    create(db, audit, 'bob')
+
+    assert audit.flush() == 1
+    assert audit.flush() == 1
+    assert audit.flush() == 0
+
+    db.rollback()
+    assert sorted(row.user for row in db.audit.all()) == ['alice', 'bob']
+
+
+def test_export(db):
+    audit = AuditLog(db)
+    create(db, audit, 'alice')
+    create(db, audit, 'bob')
+
+    lines = ''.join(export_audit(db)).splitlines()
+    assert [json.loads(line)['user'] for line in lines] == ['alice', 'bob']
+
+    csv = ''.join(export_audit(db, format='csv')).splitlines()
+    assert csv[0].startswith('id,time,user,profile,old_ssid')
+    assert len(csv) == 3
+
+    assert list(export_audit(db, stop=datetime(2000, 1, 1))) == []
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,88 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from wifinator import breaker as module
+from wifinator.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_breaker(monkeypatch, threshold=3, reset_timeout=10.0):
+    clock = Clock()
+    monkeypatch.setattr(module, 'monotonic', clock)
+
+    breaker = CircuitBreaker(threshold, reset_timeout)
+    changes = []
+    breaker.listeners.append(lambda old, new: changes.append((old, new)))
+
+    return breaker, clock, changes
+
+
+def test_opens_after_consecutive_failures(monkeypatch):
+    breaker, clock, changes = make_breaker(monkeypatch)
+
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+
+    # Success resets the count.
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert changes == [(CLOSED, OPEN)]
+
+
+def test_half_open_probe_closes(monkeypatch):
+    breaker, clock, changes = make_breaker(monkeypatch, threshold=1)
+
+    breaker.failure()
+    clock.now += 9.9
+    assert not breaker.allow()
+
+    clock.now += 0.2
+
+    # Only a single probe is let through.
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+    assert changes == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+
+
+def test_failed_probe_opens_again(monkeypatch):
+    breaker, clock, changes = make_breaker(monkeypatch, threshold=1)
+
+    breaker.failure()
+    clock.now += 11.0
+    assert breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    # Another full period has to pass.
+    clock.now += 5.0
+    assert not breaker.allow()
+
+    clock.now += 6.0
+    assert breaker.allow()
+
+    assert breaker.status()['state'] == HALF_OPEN
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,91 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifinator.aruba import Aruba, ArubaCluster, ArubaUnavailable
+
+
+def row(mac, name, age):
+    return [mac, name, 'authenticated', age, 'Yes', 'ap1', 'eduroam',
+            'a-HT-40', 'No', 'default']
+
+
+def controller(address, rows):
+    aruba = Aruba(address, 'user', 'secret')
+
+    def iter_table(command):
+        if isinstance(rows, Exception):
+            raise rows
+
+        return iter([list(r) for r in rows])
+
+    aruba.iter_table = iter_table
+    return aruba
+
+
+def test_roaming_stations_keep_the_freshest_entry():
+    cluster = ArubaCluster([
+        controller('http://one:8443', [row('m1', 'alice', '00:10:00'),
+                                       row('m2', 'bob', '00:00:05')]),
+        controller('http://two:8443', [row('m1', 'alice', '00:00:30'),
+                                       row('m2', 'bob', '01:00:00'),
+                                       row('m3', 'carol', '00:01:00')]),
+    ])
+
+    stations = cluster.list_stations()
+
+    assert sorted(stations) == ['m1', 'm2', 'm3']
+    assert stations['m1']['age'] == '00:00:30'
+    assert stations['m1']['controller'] == 'http://two:8443'
+    assert stations['m2']['controller'] == 'http://one:8443'
+
+    assert all(s['ok'] for s in cluster.status.values())
+
+
+def test_failed_controller_is_left_out():
+    cluster = ArubaCluster([
+        controller('http://one:8443', [row('m1', 'alice', '00:10:00')]),
+        controller('http://two:8443', ArubaUnavailable('refused')),
+    ])
+
+    assert list(cluster.list_stations()) == ['m1']
+
+    assert cluster.status['http://one:8443']['ok']
+    assert cluster.status['http://two:8443'] == \
+            dict(cluster.status['http://two:8443'], ok=False, error='refused')
+
+    metrics = cluster.metrics()
+    assert metrics['http://two:8443']['stations']['ok'] is False
+
+
+def test_all_controllers_failing():
+    cluster = ArubaCluster([
+        controller('http://one:8443', ArubaUnavailable('refused')),
+        controller('http://two:8443', ArubaUnavailable('timed out')),
+    ])
+
+    with pytest.raises(ArubaUnavailable):
+        cluster.list_stations()
+
+    assert len(cluster.status) == 2
+
+
+def test_duplicate_addresses_are_reported_apart():
+    cluster = ArubaCluster([
+        controller('wlc.example.org', [row('m1', 'alice', '00:10:00')]),
+        controller('https://wlc.example.org:4343', ArubaUnavailable('down')),
+        controller('http://other:8443', [row('m2', 'bob', '00:10:00')]),
+    ])
+
+    assert sorted(cluster.list_stations()) == ['m1', 'm2']
+
+    assert cluster.status['https://wlc.example.org:4343#1']['ok']
+    assert not cluster.status['https://wlc.example.org:4343#2']['ok']
+    assert cluster.status['http://other:8443']['ok']
+
+    metrics = cluster.metrics()
+    assert sorted(metrics) == sorted(cluster.status)
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,97 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from time import mktime
+
+import pytest
+
+from wifinator.history import ZoneHistory
+from wifinator.stations import StationSnapshot
+
+
+LOCATIONS = {'ap1': 'Hall', 'ap2': 'Lab'}
+
+
+def at(hour, day=1):
+    return mktime((2026, 10, day, hour, 30, 0, 0, 0, -1))
+
+
+def snapshot(users, timestamp):
+    stations = {}
+
+    for i, (name, ap, essid) in enumerate(users):
+        mac = '00:00:00:00:00:{0:02x}'.format(i)
+        stations[mac] = {'mac': mac, 'name': name, 'ap': ap,
+                         'essid': essid, 'role': 'user'}
+
+    return StationSnapshot(stations, timestamp)
+
+
+def test_counts_distinct_users_per_period():
+    history = ZoneHistory()
+
+    history.add(snapshot([('alice', 'ap1', 'eduroam'),
+                          ('alice', 'ap1', 'eduroam'),
+                          ('bob', 'ap2', 'eduroam')], at(10)), LOCATIONS)
+
+    history.add(snapshot([('alice', 'ap1', 'eduroam'),
+                          ('carol', 'ap1', 'eduroam')], at(11)), LOCATIONS)
+
+    assert history.counts('hour') == [
+        ('2026-10-01 10:00', {'Hall': 1, 'Lab': 1}),
+        ('2026-10-01 11:00', {'Hall': 2, 'Lab': 0}),
+    ]
+
+    assert history.counts('day') == [
+        ('2026-10-01', {'Hall': 2, 'Lab': 1}),
+    ]
+
+
+def test_excluded_essids_and_anonymous_stations():
+    history = ZoneHistory(exclude=['Staff'])
+
+    history.add(snapshot([('alice', 'ap1', 'Staff'),
+                          ('', 'ap1', 'eduroam'),
+                          ('', 'ap1', 'eduroam')], at(10)), LOCATIONS)
+
+    # Stations without a name are told apart by their MAC address.
+    assert history.counts('day') == [('2026-10-01', {'Hall': 2, 'Lab': 0})]
+
+
+def test_old_periods_are_pruned():
+    history = ZoneHistory({'hour': 2, 'day': 1})
+
+    for day in (1, 2):
+        for hour in (8, 9, 10):
+            history.add(snapshot([('alice', 'ap1', 'eduroam')],
+                                 at(hour, day)), LOCATIONS)
+
+    assert [label for label, zones in history.counts('hour')] == \
+            ['2026-10-02 09:00', '2026-10-02 10:00']
+
+    assert [label for label, zones in history.counts('day')] == \
+            ['2026-10-02']
+
+
+@pytest.mark.parametrize('keep', [{'hour': 0, 'day': 31},
+                                  {'hour': 48, 'day': -1}])
+def test_nothing_to_keep_is_rejected(keep):
+    with pytest.raises(ValueError):
+        ZoneHistory(keep)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'history')
+
+    history = ZoneHistory(path=path)
+    history.add(snapshot([('alice', 'ap1', 'eduroam')], at(10)), LOCATIONS)
+    history.save()
+
+    other = ZoneHistory(path=path)
+    other.load()
+
+    assert other.counts('hour') == history.counts('hour')
+    assert other.counts('day') == history.counts('day')
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,74 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from wifinator.hll import HyperLogLog, hash64, position
+
+
+def test_empty():
+    assert HyperLogLog().count() == 0
+
+
+def test_small_counts_are_exact_enough():
+    sketch = HyperLogLog()
+    sketch.update('user{0}'.format(i) for i in range(100))
+
+    assert abs(sketch.count() - 100) <= 2
+
+
+@pytest.mark.parametrize('n', [1000, 20000, 100000])
+def test_error_bound(n):
+    sketch = HyperLogLog()
+    sketch.update('user{0}@example.org'.format(i) for i in range(n))
+
+    # Standard error with 2048 registers is about 2.3 %, allow for 3 sigma.
+    assert abs(sketch.count() - n) / n < 0.07
+
+
+def test_duplicates_do_not_count():
+    sketch = HyperLogLog()
+
+    for round in range(5):
+        sketch.update('user{0}'.format(i) for i in range(1000))
+
+    registers = bytes(sketch.registers)
+    sketch.update('user{0}'.format(i) for i in range(1000))
+
+    assert bytes(sketch.registers) == registers
+
+
+def test_merge_is_union():
+    a = HyperLogLog()
+    b = HyperLogLog()
+    both = HyperLogLog()
+
+    a.update('user{0}'.format(i) for i in range(0, 6000))
+    b.update('user{0}'.format(i) for i in range(4000, 10000))
+    both.update('user{0}'.format(i) for i in range(0, 10000))
+
+    assert a.merge(b).registers == both.registers
+
+
+def test_merge_rejects_other_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(11).merge(HyperLogLog(12))
+
+
+def test_hash_is_stable():
+    assert hash64('alice') == hash64('alice')
+    assert hash64('alice') != hash64('bob')
+    assert 0 <= hash64('alice') < 2 ** 64
+
+
+def test_position():
+    index, rank = position(2 ** 64 - 1, 11)
+    assert index == 2 ** 11 - 1
+    assert rank == 1
+
+    index, rank = position(0, 11)
+    assert index == 0
+    assert rank == 64 - 11 + 1
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,180 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import pytest
+
+from conftest import ADMIN, USER, flashes
+from wifinator.profile import ProfileError, parse_profile, parse_profiles, \
+                              read_profiles
+
+
+def test_parse_profile():
+    assert parse_profile('Conference', 'passphrase', '2026-10-01',
+                         '2026-10-02') == {
+        'ssid': 'Conference',
+        'psk': 'passphrase',
+        'start': datetime(2026, 10, 1),
+        'stop': datetime(2026, 10, 2, 23, 59, 59),
+    }
+
+
+@pytest.mark.parametrize('ssid, psk, start, stop, message', [
+    ('', 'passphrase', '2026-10-01', '2026-10-01', 'Network name missing.'),
+    ('x' * 31, 'passphrase', '2026-10-01', '2026-10-01', 'Network name too long.'),
+    ('Conference', 'short', '2026-10-01', '2026-10-01', 'Password too short'),
+    ('Conference', 'x' * 31, '2026-10-01', '2026-10-01', 'Password too long.'),
+    ('Conference', 'passphrase', '1. 10. 2026', '2026-10-01', 'Invalid date'),
+    ('Conference', 'passphrase', '2026-10-02', '2026-10-01', 'Last day'),
+])
+def test_parse_profile_rejects(ssid, psk, start, stop, message):
+    with pytest.raises(ProfileError) as e:
+        parse_profile(ssid, psk, start, stop)
+
+    assert e.value.args[0].startswith(message)
+
+
+def test_parse_profiles_defaults_to_today():
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    profile, = parse_profiles([{'ssid': 'Conference', 'psk': 12345678}])
+
+    assert profile['psk'] == '12345678'
+    assert profile['start'] == today
+    assert profile['stop'] == today + timedelta(days=1, seconds=-1)
+
+
+def test_parse_profiles_reports_all_rows():
+    rows = [
+        {'ssid': 'Good', 'psk': 'passphrase'},
+        {'ssid': '', 'psk': 'passphrase'},
+        {'ssid': 'Good', 'psk': 'passphrase', 'start': '2026-10-01'},
+        {'ssid': 'Bad', 'psk': 'short'},
+    ]
+
+    with pytest.raises(ProfileError) as e:
+        parse_profiles(rows)
+
+    message = e.value.args[0]
+
+    assert 'Row 2: Network name missing.' in message
+    assert 'Row 4: Password too short' in message
+    assert 'Row 1' not in message
+
+    # The third row ends today, after it starts.
+    assert 'Row 3' not in message
+
+
+def test_parse_profiles_empty():
+    with pytest.raises(ProfileError):
+        parse_profiles([])
+
+
+CSV = 'ssid,psk,start,stop\nConference,passphrase,2026-10-01,2026-10-02\n'
+JSON = '[{"ssid": "Conference", "psk": "passphrase", ' \
+       '"start": "2026-10-01", "stop": "2026-10-02"}]'
+
+
+@pytest.mark.parametrize('data, format', [
+    (CSV, None),
+    (CSV, 'csv'),
+    (JSON, None),
+    ('  \n' + JSON, None),
+    (JSON, 'json'),
+    ('{"profiles": ' + JSON + '}', None),
+])
+def test_read_profiles(data, format):
+    row, = read_profiles(data, format)
+
+    assert row == {'ssid': 'Conference', 'psk': 'passphrase',
+                   'start': '2026-10-01', 'stop': '2026-10-02'}
+
+
+@pytest.mark.parametrize('data, format', [
+    ('name,password\nConference,passphrase\n', None),
+    ('', 'csv'),
+    ('[{"ssid": "Conference"', None),
+    ('{"ssid": "Conference"}', None),
+    ('["Conference"]', 'json'),
+    (CSV, 'xml'),
+])
+def test_read_profiles_rejects(data, format):
+    with pytest.raises(ProfileError):
+        read_profiles(data, format)
+
+
+@pytest.fixture
+def inserted(monkeypatch):
+    """
+    Capture the bulk insert.
+
+    Multi-row insert with RETURNING is not available with SQLite.
+    """
+
+    calls = []
+
+    def insert_profiles(db, profiles, username, audit=None):
+        calls.append((profiles, username))
+        return list(range(1, len(profiles) + 1))
+
+    monkeypatch.setattr('wifinator.site.insert_profiles', insert_profiles)
+    return calls
+
+
+def test_import_upload(client, manager, inserted):
+    r = client.post('/import', headers=ADMIN, data={
+        'file': (BytesIO(CSV.encode('utf8')), 'profiles.csv'),
+    })
+
+    assert r.status_code == 302
+    assert flashes(client) == []
+
+    (profiles, username), = inserted
+    assert username == 'Tester'
+    assert [p['ssid'] for p in profiles] == ['Conference']
+    assert manager.syncs == [[]]
+
+
+def test_import_body_with_format(client, manager, inserted):
+    r = client.post('/import?format=json', headers=ADMIN, data=JSON,
+                    content_type='application/json')
+
+    assert r.status_code == 302
+    assert len(inserted) == 1
+
+
+def test_import_rejects_invalid_rows(client, manager, inserted):
+    data = CSV + 'Broken,short,2026-10-01,2026-10-02\n'
+
+    r = client.post('/import', headers=ADMIN, data={
+        'file': (BytesIO(data.encode('utf8')), 'profiles.txt'),
+    })
+
+    assert r.status_code == 302
+    assert flashes(client) == [('error', 'Row 2: Password too short, '
+                                         'please supply at least 8 characters.')]
+    assert inserted == []
+    assert manager.syncs == []
+
+
+def test_import_rejects_other_encodings(client, inserted):
+    r = client.post('/import', headers=ADMIN, data={
+        'file': (BytesIO(CSV.encode('utf16')), 'profiles.csv'),
+    })
+
+    assert r.status_code == 302
+    assert flashes(client) == [('error', 'Import must be encoded in UTF-8.')]
+    assert inserted == []
+
+
+def test_import_needs_admin(client, inserted):
+    r = client.post('/import', headers=USER, data=CSV)
+
+    # The forbidden page is rendered in place.
+    assert r.status_code != 302
+    assert inserted == []
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,168 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from time import localtime, mktime, strftime
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from wifinator.archive import append_snapshot, read_snapshots, COLUMNS
+from wifinator.report import Report, BUCKETS
+
+
+LOCATIONS = {'ap1': 'Library', 'ap2': 'Library', 'ap3': 'Dorms'}
+
+BASE = mktime((2024, 3, 1, 10, 0, 0, 0, 0, -1))
+
+
+def station(mac, name, ap, essid):
+    result = {c: '' for c in COLUMNS}
+    result.update({'mac': mac, 'name': name, 'ap': ap, 'essid': essid})
+    return result
+
+
+# Offsets in minutes and stations of every snapshot.  Alice has two
+# devices, Dave roams between zones and the empty snapshot counts as
+# a sample with no users at all.
+SNAPSHOTS = [
+    (0, [station('m1', 'alice@cvut.cz', 'ap1', 'eduroam'),
+         station('m2', 'alice@cvut.cz', 'ap2', 'eduroam'),
+         station('m3', 'bob@cuni.cz', 'ap1', 'eduroam'),
+         station('m4', 'guest-1', 'ap3', 'guest')]),
+    (20, [station('m1', 'alice@cvut.cz', 'ap1', 'eduroam'),
+          station('m5', 'carol@cvut.cz', 'ap3', 'eduroam'),
+          station('m6', 'dave@vscht.cz', 'ap3', 'eduroam')]),
+    (40, []),
+    (65, [station('m6', 'dave@vscht.cz', 'ap1', 'eduroam'),
+          station('m4', 'guest-1', 'ap2', 'guest'),
+          station('m7', 'guest-2', 'ap2', 'guest')]),
+    (24 * 60, [station('m3', 'bob@cuni.cz', 'ap9', 'eduroam')]),
+    (25 * 60, []),
+]
+
+
+def classify(name, essid):
+    if essid == 'guest':
+        return 'Guests'
+
+    return name.rsplit('@', 1)[-1]
+
+
+def group_of(dimension, s):
+    if dimension == 'zone':
+        return LOCATIONS.get(s['ap'], 'Unknown')
+
+    if dimension == 'essid':
+        return s['essid']
+
+    return classify(s['name'], s['essid'])
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def expected_rows(dimension, bucket, percentiles):
+    """Straightforward computation of the same report."""
+
+    buckets = {}
+
+    for offset, stations in SNAPSHOTS:
+        label = strftime(BUCKETS[bucket], localtime(BASE + offset * 60))
+        buckets.setdefault(label, []).append(stations)
+
+    rows = {}
+
+    for label, samples in buckets.items():
+        groups = {group_of(dimension, s) for ss in samples for s in ss}
+
+        for group in groups:
+            users = []
+            devices = []
+            names = set()
+
+            for stations in samples:
+                inside = [s for s in stations if group_of(dimension, s) == group]
+                users.append(len({s['name'] for s in inside}))
+                devices.append(len(inside))
+                names.update(s['name'] for s in inside)
+
+            rows[label, group] = (
+                (label, group, len(samples), max(users),
+                 round(sum(users) / len(samples), 2))
+                + tuple(round(percentile(users, p), 2) for p in percentiles)
+                + (len(names), max(devices))
+            )
+
+    return rows
+
+
+def make_report(tmp_path, dimension, bucket='day', percentiles=(50, 95)):
+    path = str(tmp_path / 'stations.wfs')
+
+    for offset, stations in SNAPSHOTS:
+        append_snapshot(path, stations, BASE + offset * 60)
+
+    report = Report(dimension, bucket, percentiles,
+                    locations=LOCATIONS, classify=classify)
+
+    for snapshot in read_snapshots(path):
+        report.add(snapshot)
+
+    return report
+
+
+@pytest.mark.parametrize('dimension', ['zone', 'essid', 'org'])
+@pytest.mark.parametrize('bucket', ['hour', 'day', 'month'])
+def test_matches_plain_computation(tmp_path, dimension, bucket):
+    report = make_report(tmp_path, dimension, bucket, (25, 50, 90))
+    rows = list(report.rows())
+
+    assert {(r[0], r[1]): r for r in rows} == \
+            expected_rows(dimension, bucket, (25, 50, 90))
+
+    # No group is reported twice within a bucket.
+    assert len(rows) == len({(r[0], r[1]) for r in rows})
+    assert all(len(r) == len(report.headers()) for r in rows)
+
+
+def test_org_dimension(tmp_path):
+    report = make_report(tmp_path, 'org', 'day', ())
+    rows = {(r[0], r[1]): r for r in report.rows()}
+
+    first = strftime('%Y-%m-%d', localtime(BASE))
+
+    # Alice's two devices count as a single user.
+    assert rows[first, 'cvut.cz'] == (first, 'cvut.cz', 4, 2, 0.75, 2, 2)
+    assert rows[first, 'Guests'] == (first, 'Guests', 4, 2, 0.75, 2, 2)
+
+
+def test_empty_buckets(tmp_path):
+    path = str(tmp_path / 'stations.wfs')
+
+    append_snapshot(path, [], BASE)
+    append_snapshot(path, [], BASE + 60)
+
+    report = Report('zone', 'hour', locations=LOCATIONS)
+
+    for snapshot in read_snapshots(path):
+        report.add(snapshot)
+
+    assert list(report.rows()) == []
+
+
+def test_no_snapshots():
+    report = Report('essid', 'day', (50,))
+
+    assert list(report.rows()) == []
+    assert report.headers() == \
+            ('Bucket', 'ESSID', 'Samples', 'Max', 'Mean', 'P50',
+             'Distinct', 'Devices')
+
+
+# vim:set sw=4 ts=4 et:
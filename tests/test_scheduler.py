@@ -0,0 +1,116 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from threading import Thread
+from time import monotonic, sleep
+
+from wifinator.scheduler import Scheduler, INTERACTIVE, WRITE, BACKGROUND, \
+                                priority, current_priority, call_with_priority
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = monotonic() + timeout
+
+    while not predicate():
+        assert monotonic() < deadline, 'Timed out'
+        sleep(0.001)
+
+
+def test_priority_order():
+    scheduler = Scheduler(concurrency=1)
+    order = []
+
+    def command(cls, name):
+        with scheduler.slot(cls):
+            order.append(name)
+
+    with scheduler.slot(INTERACTIVE):
+        threads = []
+
+        for cls, name in [(BACKGROUND, 'sample-1'), (WRITE, 'edit'),
+                          (BACKGROUND, 'sample-2'), (INTERACTIVE, 'zones')]:
+            thread = Thread(target=command, args=(cls, name))
+            thread.start()
+            threads.append(thread)
+
+            # Make the order of arrival deterministic.
+            wait_for(lambda: len(scheduler.queue) == len(threads))
+
+    for thread in threads:
+        thread.join(5.0)
+
+    assert order == ['zones', 'edit', 'sample-1', 'sample-2']
+    assert scheduler.running == 0
+
+
+def test_concurrency_limit():
+    scheduler = Scheduler(concurrency=2)
+    peak = []
+
+    def command():
+        with scheduler.slot(BACKGROUND):
+            peak.append(scheduler.running)
+            sleep(0.01)
+
+    threads = [Thread(target=command) for i in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join(5.0)
+
+    assert max(peak) == 2
+    assert scheduler.metrics()['classes']['background']['total'] == 8
+
+
+def test_rate_limit():
+    scheduler = Scheduler(rate=50.0, burst=2)
+    start = monotonic()
+
+    for i in range(7):
+        with scheduler.slot(INTERACTIVE):
+            pass
+
+    # Two commands of the burst go right away, the other five wait.
+    assert monotonic() - start >= 5 / 50.0 * 0.9
+
+
+def test_released_slot_is_taken_again():
+    scheduler = Scheduler(concurrency=1)
+    admitted = []
+
+    def other():
+        with scheduler.slot(BACKGROUND):
+            admitted.append(True)
+
+    with scheduler.slot(INTERACTIVE):
+        thread = Thread(target=other)
+        thread.start()
+        wait_for(lambda: scheduler.queue)
+
+        with scheduler.released(INTERACTIVE):
+            thread.join(5.0)
+
+        assert admitted
+        assert scheduler.running == 1
+
+    assert scheduler.running == 0
+
+
+def test_thread_priority():
+    assert current_priority() == INTERACTIVE
+
+    with priority(BACKGROUND):
+        assert current_priority() == BACKGROUND
+
+        with priority(WRITE):
+            assert current_priority() == WRITE
+
+        assert current_priority() == BACKGROUND
+
+    assert current_priority() == INTERACTIVE
+    assert call_with_priority(WRITE, current_priority) == WRITE
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,109 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from conftest import USER
+from wifinator.stations import StationSnapshot
+
+
+@pytest.fixture
+def stations(manager):
+    stations = {}
+
+    for i in range(30):
+        mac = '00:0b:86:00:00:{0:02x}'.format(i)
+        stations[mac] = {
+            'mac': mac,
+            'name': 'user{0:02d}'.format(i),
+            'role': 'staff' if i % 3 == 0 else 'guest',
+            'ap': 'ap{0}'.format(i % 3),
+            'essid': 'eduroam' if i % 2 else 'guest',
+        }
+
+    # Fresh snapshot, so that the controller is never contacted.
+    manager.station_snapshot = StationSnapshot(stations)
+    manager.locations = {'ap0': 'Hall', 'ap1': 'Hall', 'ap2': 'Lab'}
+    return stations
+
+
+def get(client, **args):
+    r = client.get('/stations', query_string=args, headers=USER)
+    assert r.status_code == 200
+    return r
+
+
+def test_paging_with_cursor(client, stations):
+    macs = []
+    cursor = None
+
+    while True:
+        args = {'limit': 7}
+
+        if cursor is not None:
+            args['cursor'] = cursor
+
+        page = get(client, **args).get_json()
+        macs.extend(s['mac'] for s in page['stations'])
+        cursor = page['next']
+
+        if cursor is None:
+            break
+
+        assert len(page['stations']) == 7
+
+    assert macs == sorted(stations)
+
+
+def test_default_and_maximum_limit(client, manager):
+    manager.station_snapshot = StationSnapshot({
+        '{0:012x}'.format(i): {'mac': '{0:012x}'.format(i), 'name': '',
+                               'role': 'guest', 'ap': 'ap0', 'essid': 'guest'}
+        for i in range(1200)
+    })
+
+    page = get(client).get_json()
+    assert len(page['stations']) == 100
+    assert page['next'] == '{0:012x}'.format(99)
+
+    page = get(client, limit=100000).get_json()
+    assert len(page['stations']) == 1000
+
+
+def test_filters(client, stations):
+    page = get(client, essid='eduroam', role='guest', zone='Hall').get_json()
+
+    expected = sorted(mac for mac, s in stations.items()
+                      if s['essid'] == 'eduroam' and s['role'] == 'guest'
+                      and s['ap'] in ('ap0', 'ap1'))
+
+    assert [s['mac'] for s in page['stations']] == expected
+
+    page = get(client, ap='ap2', prefix='user1').get_json()
+    assert [s['name'] for s in page['stations']] == ['user11', 'user14', 'user17']
+
+    page = get(client, ap='ap2', zone='Hall').get_json()
+    assert page['stations'] == []
+
+
+def test_ndjson(client, stations):
+    r = get(client, format='ndjson', cursor='00:0b:86:00:00:04', limit=3)
+    assert r.mimetype == 'application/x-ndjson'
+
+    rows = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert [row['mac'] for row in rows] == \
+            ['00:0b:86:00:00:05', '00:0b:86:00:00:06', '00:0b:86:00:00:07']
+
+    r = get(client, format='ndjson')
+    assert len(r.get_data(as_text=True).splitlines()) == 30
+
+
+@pytest.mark.parametrize('limit', ['-1', 'ten', '1.5'])
+def test_invalid_limit(client, stations, limit):
+    r = client.get('/stations', query_string={'limit': limit}, headers=USER)
+    assert r.status_code == 400
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,99 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from itertools import islice
+
+from wifinator.stations import StationSnapshot
+
+
+def make_stations(count=100):
+    stations = {}
+
+    for i in range(count):
+        mac = '00:0b:86:00:{0:02x}:{1:02x}'.format(i // 256, i % 256)
+        stations[mac] = {
+            'mac': mac,
+            'name': 'user{0:03d}'.format(i % 40) if i % 10 else '',
+            'role': 'staff' if i % 3 == 0 else 'guest',
+            'ap': 'ap{0}'.format(i % 4),
+            'essid': 'eduroam' if i % 2 else 'guest',
+        }
+
+    return stations
+
+
+def page(snapshot, size, **criteria):
+    """Walk through all pages the way the /stations endpoint does."""
+
+    pages = []
+    after = None
+
+    while True:
+        stations = list(islice(snapshot.select(after=after, **criteria), size))
+        pages.append(stations)
+
+        if len(stations) < size:
+            return pages
+
+        after = stations[-1]['mac']
+
+
+def test_pages_cover_everything_once():
+    stations = make_stations()
+    snapshot = StationSnapshot(stations)
+
+    pages = page(snapshot, 7)
+    macs = [s['mac'] for p in pages for s in p]
+
+    assert macs == sorted(stations)
+    assert all(len(p) == 7 for p in pages[:-1])
+
+
+def test_filtered_pages_match_a_scan():
+    stations = make_stations()
+    snapshot = StationSnapshot(stations)
+
+    criteria = {'essid': 'eduroam', 'aps': ['ap1', 'ap3'],
+                'role': 'guest', 'prefix': 'user01'}
+
+    expected = sorted(mac for mac, s in stations.items()
+                      if s['essid'] == 'eduroam'
+                      and s['ap'] in ('ap1', 'ap3')
+                      and s['role'] == 'guest'
+                      and s['name'].startswith('user01'))
+
+    assert expected
+
+    for size in (1, 3, 100):
+        pages = page(snapshot, size, **criteria)
+        assert [s['mac'] for p in pages for s in p] == expected
+
+
+def test_after_cursor_between_macs():
+    snapshot = StationSnapshot(make_stations(10))
+
+    macs = [s['mac'] for s in snapshot.select(after='00:0b:86:00:00:04~')]
+    assert macs == ['00:0b:86:00:00:{0:02x}'.format(i) for i in range(5, 10)]
+
+    assert list(snapshot.select(after='ff')) == []
+
+
+def test_unknown_filters_yield_nothing():
+    snapshot = StationSnapshot(make_stations(10))
+
+    assert list(snapshot.select(essid='nope')) == []
+    assert list(snapshot.select(aps=['nope'])) == []
+    assert list(snapshot.select(prefix='nope')) == []
+
+
+def test_zone_counts():
+    snapshot = StationSnapshot(make_stations(8))
+    locations = {'ap0': 'Hall', 'ap1': 'Hall', 'ap2': 'Lab'}
+
+    # Stations on ap3 are not counted without an Unknown zone.
+    assert snapshot.zone_counts(locations) == {'Hall': 4, 'Lab': 2}
+    assert snapshot.zone_counts(locations, exclude=['guest']) == \
+            {'Hall': 2, 'Lab': 0}
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,156 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from xml.etree.ElementTree import XML
+
+import json
+
+import pytest
+
+from wifinator.aruba import Aruba, ArubaError, sanitize
+
+
+TABLE = (
+    '<re><t tn="Station Table">'
+    '<th><h>MAC</h><h>Name</h><h>Role</h></th>'
+    '<r><c>00:0b:86:00:00:01</c><c>alice</c><c>guest</c></r>'
+    '<r><c>00:0b:86:00:00:02</c><c>Žluťoučký kůň\x01\x1b</c><c> staff </c></r>'
+    '<r><c>00:0b:86:00:00:03</c><c/><c>guest</c></r>'
+    '</t>'
+    '<t tn="Other"><th><h>X</h></th><r><c>not this one</c></r></t>'
+    '</re>'
+)
+
+
+def parse_whole(text):
+    """The original parse of the complete response."""
+
+    data = sanitize(text.encode('utf8', 'xmlcharrefreplace'))
+    table = XML(data).find('t')
+
+    if table is None:
+        raise ArubaError('Response does not contain a table')
+
+    return [[(c.text.strip() if c.text is not None else '') for c in row]
+            for row in table[1:]]
+
+
+class Response(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, size, decode_unicode=False):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def iter_table(chunks):
+    aruba = Aruba('http://127.0.0.1:9', 'user', 'secret')
+    response = Response(chunks)
+    aruba.get = lambda command, **kwargs: response
+
+    rows = list(aruba.iter_table('show user-table'))
+    assert response.closed
+    return rows
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 100000])
+def test_byte_chunks(size):
+    # Small sizes split the multi-byte characters between chunks.
+    chunks = split(TABLE.encode('utf8'), size)
+    assert iter_table(chunks) == parse_whole(TABLE)
+
+
+@pytest.mark.parametrize('size', [1, 5, 100000])
+def test_text_chunks(size):
+    assert iter_table(split(TABLE, size)) == parse_whole(TABLE)
+
+
+def test_control_characters_are_escaped():
+    rows = iter_table([TABLE.encode('utf8')])
+    assert rows[1][1] == 'Žluťoučký kůň\\x01\\x1b'
+    assert rows[1][2] == 'staff'
+    assert rows[2][1] == ''
+
+
+def test_missing_table():
+    with pytest.raises(ArubaError):
+        iter_table([b'<re><data><r>root</r></data></re>'])
+
+
+def test_invalid_xml():
+    with pytest.raises(ArubaError):
+        iter_table([b'<re><t><th></th><r><c>x</c></r>'])
+
+
+HEADERS = ('MAC', 'Name', 'Age')
+ROWS = [('00:0b:86:00:00:01', 'alice', '00:01'),
+        ('00:0b:86:00:00:02', 'bob, "the builder"', '00:02')]
+
+
+@pytest.fixture
+def print_table():
+    pytest.importorskip('click')
+    from wifinator.bin.wifinatorctl import print_table
+    return print_table
+
+
+def test_csv(print_table, capsys):
+    print_table(HEADERS, iter(ROWS), 'csv')
+
+    assert capsys.readouterr().out == (
+        '"mac","name","age"\n'
+        '"00:0b:86:00:00:01","alice","00:01"\n'
+        '"00:0b:86:00:00:02","bob, ""the builder""","00:02"\n'
+    )
+
+
+def test_tsv(print_table, capsys):
+    print_table(HEADERS, iter(ROWS), 'tsv')
+
+    assert capsys.readouterr().out == (
+        'mac\tname\tage\n'
+        '00:0b:86:00:00:01\talice\t00:01\n'
+        '00:0b:86:00:00:02\t"bob, ""the builder"""\t00:02\n'
+    )
+
+
+def test_ndjson(print_table, capsys):
+    print_table(HEADERS, iter(ROWS), 'ndjson')
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'mac': '00:0b:86:00:00:01', 'name': 'alice', 'age': '00:01'},
+        {'mac': '00:0b:86:00:00:02', 'name': 'bob, "the builder"',
+         'age': '00:02'},
+    ]
+
+
+def test_table(print_table, capsys):
+    pytest.importorskip('tabulate')
+    print_table(HEADERS, iter(ROWS), 'table')
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ['MAC', 'Name', 'Age']
+    assert lines[2].split() == list(ROWS[0])
+    assert len(lines) == 4
+
+
+def test_dict_rows(print_table, capsys):
+    headers = {'mac': 'MAC', 'age': 'Age'}
+    rows = [{'mac': m, 'name': n, 'age': a} for m, n, a in ROWS]
+
+    print_table(headers, iter(rows), 'ndjson')
+
+    lines = capsys.readouterr().out.splitlines()
+    assert json.loads(lines[1]) == {'mac': '00:0b:86:00:00:02', 'age': '00:02'}
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,86 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from wifinator.warmup import WarmUp
+
+
+class Flaky(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+
+        if self.calls <= self.failures:
+            raise IOError('Controller is unavailable')
+
+
+def test_ready_when_all_steps_succeed():
+    warmup = WarmUp()
+    assert warmup.run('templates', lambda: None)
+    assert not warmup.ready
+
+    warmup.finish()
+    assert warmup.ready
+
+    status = warmup.status()
+    assert status['ready']
+    assert [s['name'] for s in status['steps']] == ['templates']
+
+
+def test_failed_steps_are_retried_in_order():
+    login = Flaky(2)
+    sample = Flaky(1)
+
+    warmup = WarmUp()
+    assert not warmup.run('controller', login)
+    assert not warmup.run('sample', sample)
+    warmup.finish()
+
+    assert not warmup.ready
+    assert warmup.failed() == ['controller', 'sample']
+    assert warmup.status()['steps'][0]['error'] == 'Controller is unavailable'
+
+    # Later steps wait for the earlier ones.
+    assert not warmup.retry()
+    assert (login.calls, sample.calls) == (2, 1)
+
+    assert warmup.retry()
+    assert warmup.ready
+    assert (login.calls, sample.calls) == (3, 2)
+
+    status = warmup.status()
+    assert status['ready']
+    assert [s['attempts'] for s in status['steps']] == [3, 2]
+
+
+def test_controller_steps_get_a_single_short_try(manager):
+    aruba = manager.aruba
+    aruba.retries, aruba.budget = 2, 60.0
+    seen = []
+
+    def login():
+        seen.append(('login', aruba.retries, aruba.budget))
+        raise IOError('Controller is unavailable')
+
+    def sample():
+        seen.append(('sample', aruba.retries, aruba.budget))
+
+    aruba.login = login
+    manager.sample = sample
+
+    warmup = WarmUp()
+    manager.warm_up(warmup, 5.0)
+    warmup.finish()
+
+    assert seen == [('login', 0, 5.0), ('sample', 0, 5.0)]
+    assert warmup.failed() == ['controller']
+
+    # Retries in the background use the configured limits again.
+    assert (aruba.retries, aruba.budget) == (2, 60.0)
+    assert not warmup.retry()
+    assert seen[-1] == ('login', 2, 60.0)
+
+
+# vim:set sw=4 ts=4 et:
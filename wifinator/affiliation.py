@@ -0,0 +1,347 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['AffiliationRules', 'LdapResolver', 'ResolverCache']
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import local, Lock
+from fnmatch import translate
+from time import time
+
+import sqlite3
+import re
+
+
+class AffiliationRules(object):
+    """
+    Compiled affiliation mapping rules.
+
+    Rules are glob patterns matched against both the login domain and
+    the ESSID of a station.  The first matching rule in the configured
+    order determines the organization.  Instead of trying every rule in
+    turn, the patterns are sorted into three structures:
+
+     - plain names go to a dictionary,
+     - `*.domain` patterns to a trie of reversed domain labels,
+     - everything else to a single combined regular expression.
+
+    Every structure yields the lowest index of a matching rule and the
+    overall lowest index wins.  Results are memoized, since the number
+    of distinct domain and ESSID combinations is usually small.  The
+    memo is cleared once it reaches `MEMO_SIZE` entries, so that even
+    a long-running `watch` does not grow without a limit.
+    """
+
+    MEMO_SIZE = 65536
+
+    def __init__(self, items):
+        """Initialize with `(organization, rules)` pairs."""
+
+        self.orgs = []
+        self.exact = {}
+        self.suffixes = {}
+        regexes = []
+
+        for org, rules in items:
+            for rule in re.split(r'\s+', rules.strip()):
+                index = len(self.orgs)
+                self.orgs.append(org)
+
+                if not re.search(r'[*?[]', rule):
+                    self.exact.setdefault(rule, index)
+
+                elif rule.startswith('*.') and not re.search(r'[*?[]', rule[2:]):
+                    node = self.suffixes
+
+                    for label in reversed(rule[2:].split('.')):
+                        node = node.setdefault(label, {})
+
+                    node.setdefault(None, index)
+
+                else:
+                    # Group names must be unique in the combined pattern.
+                    pattern = re.sub(r'\(\?P(<|=)g(\d+)',
+                                     r'(?P\1r{0}g\2'.format(index),
+                                     translate(rule))
+
+                    regexes.append('(?P<r{0}>{1})'.format(index, pattern))
+
+        self.regex = re.compile('|'.join(regexes)) if regexes else None
+        self.memo = {}
+
+    def match(self, value):
+        """Return index of the first rule matching the value or `None`."""
+
+        best = self.exact.get(value)
+
+        node = self.suffixes
+
+        # At least the leftmost label must be matched by the asterisk.
+        for label in reversed(value.split('.')[1:]):
+            node = node.get(label)
+
+            if node is None:
+                break
+
+            if None in node and (best is None or node[None] < best):
+                best = node[None]
+
+        if self.regex is not None:
+            m = self.regex.match(value)
+
+            if m is not None:
+                for name, group in m.groupdict().items():
+                    if group is not None and 'g' not in name:
+                        index = int(name[1:])
+
+                        if best is None or index < best:
+                            best = index
+
+                        break
+
+        return best
+
+    def classify(self, domain, essid):
+        """
+        Determine organization of a station.
+
+        Stations without any known domain are considered `Local` and those
+        with a domain not matched by any rule fall to the `Other` category.
+        """
+
+        key = (domain, essid)
+
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+
+        found = [self.match(essid)]
+
+        if domain is not None:
+            found.append(self.match(domain))
+
+        found = [index for index in found if index is not None]
+
+        if found:
+            org = self.orgs[min(found)]
+        elif domain is None:
+            org = 'Local'
+        else:
+            org = 'Other'
+
+        if len(self.memo) >= self.MEMO_SIZE:
+            self.memo.clear()
+
+        self.memo[key] = org
+        return org
+
+
+class ResolverCache(object):
+    """
+    Persistent cache of LDAP lookup results.
+
+    Stored in a SQLite file so that it survives between runs of the
+    command-line client.  Failed lookups are cached as well, only for
+    a (usually shorter) `negative_ttl` period.
+    """
+
+    def __init__(self, path, ttl=86400, negative_ttl=3600):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS affiliation (
+                name TEXT PRIMARY KEY,
+                domain TEXT,
+                expires REAL NOT NULL
+            )
+        ''')
+
+    def get_many(self, names):
+        """Return cached results for the names that have not expired."""
+
+        names = list(names)
+        found = {}
+        now = time()
+
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            query = 'SELECT name, domain FROM affiliation ' \
+                    'WHERE expires > ? AND name IN ({0})' \
+                        .format(', '.join('?' * len(chunk)))
+
+            for name, domain in self.conn.execute(query, [now] + chunk):
+                found[name] = domain
+
+        return found
+
+    def put_many(self, results):
+        """Store results, `None` meaning the name was not found."""
+
+        now = time()
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO affiliation VALUES (?, ?, ?)',
+                [(name, domain, now + (self.ttl if domain is not None
+                                             else self.negative_ttl))
+                 for name, domain in results.items()])
+
+    def close(self):
+        self.conn.close()
+
+
+class LdapResolver(object):
+    """
+    Resolves user names to affiliation attribute values using LDAP.
+
+    Names are deduplicated, looked up in the optional cache and the rest
+    is searched for in batches, joining the individual filters into a
+    single OR filter.  Batches are spread over a small pool of worker
+    threads, each with its own connection returned by `connect`.  That
+    can be any ldap3 connection, including a `MOCK_SYNC` one for testing.
+    """
+
+    def __init__(self, connect, base, filter, attribute, cache=None,
+                 batch=50, connections=4):
+        self.connect = connect
+        self.base = base
+        self.filter = filter
+        self.attribute = attribute
+        self.cache = cache
+        self.connections = connections
+
+        # Batching is only possible when we know what attribute to match
+        # the entries against.  Otherwise search for every name separately.
+        m = re.match(r'^\(([\w-]+)=\{name\}\)$', filter)
+        self.key = m.group(1) if m else None
+        self.batch = batch if self.key is not None else 1
+
+        self.local = local()
+        self.opened = []
+        self.lock = Lock()
+        self.executor = None
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = self.local.conn = self.connect()
+
+            with self.lock:
+                self.opened.append(conn)
+
+        return conn
+
+    def search(self, names):
+        """Search for a batch of names, return the found ones."""
+
+        # Imported here so that the rest of the module can be used
+        # without ldap3 installed.
+        from ldap3.utils.conv import escape_filter_chars
+
+        conn = self.connection()
+        found = {}
+
+        if self.key is None:
+            name, = names
+            conn.search(self.base,
+                        self.filter.format(name=escape_filter_chars(name)),
+                        attributes=[self.attribute])
+
+            for entry in conn.entries[:1]:
+                found[name] = first_value(entry, self.attribute)
+
+            return found
+
+        wanted = {name.lower(): name for name in names}
+        query = ''.join(self.filter.format(name=escape_filter_chars(name))
+                        for name in names)
+
+        conn.search(self.base, '(|{0})'.format(query),
+                    attributes=[self.attribute, self.key])
+
+        for entry in conn.entries:
+            for value in values_of(entry, self.key):
+                name = wanted.get(str(value).lower())
+
+                if name is not None and name not in found:
+                    found[name] = first_value(entry, self.attribute)
+
+        return found
+
+    def resolve(self, names):
+        """
+        Resolve all the given names at once.
+
+        Returns a dictionary with all of the names, mapping those that
+        could not be resolved to `None`.
+        """
+
+        names = set(names)
+        results = {}
+
+        if self.cache is not None:
+            results.update(self.cache.get_many(names))
+
+        misses = sorted(names - set(results))
+        batches = [misses[i:i + self.batch]
+                   for i in range(0, len(misses), self.batch)]
+
+        fresh = {name: None for name in misses}
+
+        if len(batches) == 1:
+            fresh.update(self.search(batches[0]))
+
+        elif batches:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.connections)
+
+            for found in self.executor.map(self.search, batches):
+                fresh.update(found)
+
+        if self.cache is not None and fresh:
+            self.cache.put_many(fresh)
+
+        results.update(fresh)
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close all the connections, the pool and the cache."""
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+        with self.lock:
+            for conn in self.opened:
+                conn.unbind()
+
+            self.opened = []
+
+        if self.cache is not None:
+            self.cache.close()
+
+
+def values_of(entry, attribute):
+    for key, values in entry.entry_attributes_as_dict.items():
+        if key.lower() == attribute.lower():
+            return values
+
+    return []
+
+
+def first_value(entry, attribute):
+    values = values_of(entry, attribute)
+    return str(values[0]) if values else None
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,187 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['ArchiveError', 'ArchivedSnapshot', 'append_snapshot',
+           'read_snapshots', 'last_snapshot']
+
+from array import array
+from time import time
+
+import gzip
+import json
+import struct
+import sys
+
+
+# Columns of the controller station table.
+COLUMNS = ('mac', 'name', 'role', 'age', 'auth',
+           'ap', 'essid', 'phy', 'remote', 'profile')
+
+MAGIC = b'WFS1'
+
+
+class ArchiveError(Exception):
+    """Station archive is damaged or in an unknown format."""
+
+
+class ArchivedSnapshot(object):
+    """
+    Station table stored in an archive.
+
+    Every column is dictionary-encoded: `dicts` hold the distinct values
+    and `codes` arrays of indexes into them, one per station.  That keeps
+    the repetitive columns such as ESSID or AP small and allows further
+    processing without decoding the individual stations.
+    """
+
+    def __init__(self, timestamp, dicts, codes):
+        self.time = timestamp
+        self.dicts = dicts
+        self.codes = codes
+
+    def __len__(self):
+        return len(next(iter(self.codes.values()), ()))
+
+    def iter_stations(self):
+        """Decode stations back into the dictionaries."""
+
+        columns = [(c, self.dicts[c], self.codes[c]) for c in self.dicts]
+
+        for i in range(len(self)):
+            yield {c: values[codes[i]] for c, values, codes in columns}
+
+    def list_stations(self):
+        return {station['mac']: station for station in self.iter_stations()}
+
+
+def encode(stations, timestamp):
+    dicts = {c: [] for c in COLUMNS}
+    index = {c: {} for c in COLUMNS}
+    codes = {c: [] for c in COLUMNS}
+
+    for station in stations:
+        for c in COLUMNS:
+            value = station[c]
+            code = index[c].get(value)
+
+            if code is None:
+                code = index[c][value] = len(dicts[c])
+                dicts[c].append(value)
+
+            codes[c].append(code)
+
+    header = {
+        'time': timestamp,
+        'count': len(codes[COLUMNS[0]]),
+        'columns': [],
+    }
+
+    body = []
+
+    for c in COLUMNS:
+        typecode = 'B' if len(dicts[c]) <= 0x100 else \
+                   'H' if len(dicts[c]) <= 0x10000 else 'I'
+
+        data = array(typecode, codes[c])
+
+        if sys.byteorder == 'big':
+            data.byteswap()
+
+        header['columns'].append({
+            'name': c,
+            'type': typecode,
+            'itemsize': data.itemsize,
+            'values': dicts[c],
+        })
+
+        body.append(data.tobytes())
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf8')
+    return MAGIC + struct.pack('<I', len(header)) + header + b''.join(body)
+
+
+def append_snapshot(path, stations, timestamp=None):
+    """
+    Append a station table to the archive at `path`.
+
+    Every snapshot is written as a separate gzip member, so appending
+    never rewrites the existing data and the whole file is still a valid
+    gzip stream.
+    """
+
+    record = encode(stations, timestamp or time())
+
+    with open(path, 'ab') as fp:
+        with gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+            gz.write(record)
+
+
+def read_exactly(fp, size):
+    data = fp.read(size)
+
+    if len(data) != size:
+        raise ArchiveError('Archive is truncated')
+
+    return data
+
+
+def read_snapshots(path):
+    """
+    Iterate over snapshots in the archive at `path`.
+
+    The file is decompressed as a stream and only one snapshot is held
+    in memory at a time.
+    """
+
+    with gzip.open(path, 'rb') as fp:
+        while True:
+            magic = fp.read(len(MAGIC))
+
+            if not magic:
+                return
+
+            if magic != MAGIC:
+                raise ArchiveError('Not a station archive')
+
+            size, = struct.unpack('<I', read_exactly(fp, 4))
+
+            try:
+                header = json.loads(read_exactly(fp, size).decode('utf8'))
+            except ValueError:
+                raise ArchiveError('Damaged snapshot header')
+
+            dicts = {}
+            codes = {}
+
+            for column in header['columns']:
+                data = array(column['type'])
+
+                if data.itemsize != column['itemsize']:
+                    raise ArchiveError('Unsupported column type')
+
+                data.frombytes(read_exactly(fp, header['count'] * data.itemsize))
+
+                if sys.byteorder == 'big':
+                    data.byteswap()
+
+                dicts[column['name']] = column['values']
+                codes[column['name']] = data
+
+            yield ArchivedSnapshot(header['time'], dicts, codes)
+
+
+def last_snapshot(path):
+    """Return the most recent snapshot in the archive at `path`."""
+
+    snapshot = None
+
+    for snapshot in read_snapshots(path):
+        pass
+
+    if snapshot is None:
+        raise ArchiveError('Archive is empty')
+
+    return snapshot
+
+
+# vim:set sw=4 ts=4 et:
@@ -3,10 +3,18 @@
 
 import re
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from random import uniform
 from threading import Lock
-from requests import Session, HTTPError
-from time import time
-from xml.etree.ElementTree import XML, ParseError
+from requests import Session, HTTPError, RequestException
+from time import time, monotonic, sleep
+from xml.etree.ElementTree import XML, XMLPullParser, ParseError
+
+from wifinator.breaker import CircuitBreaker
+from wifinator.profiling import timed
+from wifinator.scheduler import Scheduler, priority, current_priority, \
+                                call_with_priority, WRITE, CLASSES
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from requests.packages.urllib3 import disable_warnings
@@ -14,39 +22,209 @@ from requests.packages.urllib3 import disable_warnings
 disable_warnings(InsecureRequestWarning)
 
 
+def sanitize(data):
+    """
+    Escape ASCII control characters in the controller output.
+
+    The controller shamelessly retains them and some users are able to
+    inject them through their login names.  Works on arbitrary chunks
+    of UTF-8, since the characters never appear in multi-byte sequences.
+    """
+
+    return re.sub(b'[\x00-\x09\x11-\x12\x14-\x1f]',
+                  lambda m: ('\\x%.2x' % m.group(0)[0]).encode('utf8'),
+                  data)
+
+
+def parse_age(age):
+    """
+    Convert station age such as `01:02:03` or `2d:01:02:03` to seconds.
+
+    Unknown formats are treated as very old.
+    """
+
+    days = 0
+    seconds = 0
+
+    try:
+        for part in age.split(':'):
+            if part.endswith('d'):
+                days += int(part[:-1])
+            else:
+                seconds = seconds * 60 + int(part)
+    except ValueError:
+        return float('inf')
+
+    return days * 86400 + seconds
+
+
 class ArubaError(Exception):
     """Generic error related to communication with Aruba WiFi controllers."""
 
 
+class ArubaUnavailable(ArubaError):
+    """Controller could not be reached or is being given a break."""
+
+
 class Aruba(object):
+    # Used unless the address already specifies scheme and port.
+    BASE_URL = 'https://{host}:4343'
+
     # <url> ? command @@ timestamp & UIDARUBA=session-id
-    COMMAND_URL = 'https://{host}:4343/screens/cmnutil/execCommandReturnResult.xml'
+    COMMAND_URL = '{base}/screens/cmnutil/execCommandReturnResult.xml'
 
     # POST opcode, url, needxml, uid, passwd
-    LOGIN_URL = 'https://{host}:4343/screens/wms/wms.login'
+    LOGIN_URL = '{base}/screens/wms/wms.login'
+
+    def __init__(self, host, username, password, scheduler=None,
+                 breaker=None, timeout=(5.0, 30.0), retries=2, budget=60.0):
+        """
+        Store address and credentials for later.
 
-    def __init__(self, host, username, password):
-        """Store address and credentials for later."""
+        The address is either a bare host name or an URL such as
+        `http://localhost:8443`, handy to talk to a controller emulator.
+        All commands are admitted by the `scheduler`, which does not
+        limit them in any way by default.
+
+        Every HTTP request is limited by the `(connect, read)` timeout
+        and every command, including the retries and reading of streamed
+        responses, by the `budget` of seconds.  Read-only commands are
+        tried up to `retries` more times.  The `breaker` stops further
+        attempts after repeated failures.
+        """
 
         self.host = host
         self.username = username
         self.password = password
+        self.scheduler = scheduler or Scheduler()
+        self.breaker = breaker or CircuitBreaker()
+
+        self.timeout = timeout
+        self.retries = retries
+        self.budget = budget
 
         self.session = Session()
 
-        self.login_url = self.LOGIN_URL.format(host=host)
-        self.command_url = self.COMMAND_URL.format(host=host)
+        if '://' in host:
+            base = host.rstrip('/')
+        else:
+            base = self.BASE_URL.format(host=host)
 
-    def request(self, command):
+        # Identifies the controller in status reports.
+        self.name = base
+
+        self.login_url = self.LOGIN_URL.format(base=base)
+        self.command_url = self.COMMAND_URL.format(base=base)
+
+    def attempt(self, send, retries=0, deadline=None):
+        """
+        Call `send(timeout)` until it succeeds or we run out of retries.
+
+        Only network errors are retried, after a random delay that grows
+        exponentially with every attempt.  The timeout is shortened so
+        that no attempt ends after the `deadline`, by default the budget
+        from now on.  Must be called within a slot of the scheduler,
+        which is given up during the delay.  Raises `ArubaUnavailable`
+        when all attempts fail or when the circuit breaker is open.
+        """
+
+        if deadline is None:
+            deadline = monotonic() + self.budget
+
+        attempt = 0
+
+        while True:
+            if not self.breaker.allow():
+                raise ArubaUnavailable('Controller is unavailable, '
+                                       'not trying again yet')
+
+            remaining = deadline - monotonic()
+
+            if remaining <= 0:
+                raise ArubaUnavailable('Controller is unavailable, '
+                                       'out of time')
+
+            timeout = tuple(min(t, remaining) for t in self.timeout)
+
+            try:
+                with timed('controller'):
+                    r = send(timeout)
+
+            except RequestException as e:
+                self.breaker.failure()
+
+                delay = uniform(0, 0.5 * 2 ** attempt)
+                attempt += 1
+
+                if attempt > retries or monotonic() + delay > deadline:
+                    raise ArubaUnavailable('Controller is unavailable: {0}' \
+                                                .format(e))
+
+                # Let other commands through while we wait.
+                with self.scheduler.released():
+                    sleep(delay)
+
+                continue
+
+            self.breaker.success()
+            return r
+
+    @contextmanager
+    def limits(self, retries, budget):
+        """
+        Use different `retries` and `budget` within the block.
+
+        Meant for the warm-up, when nothing else talks to the controller
+        yet and it is better to give up quickly and try again later.
+        """
+
+        saved = self.retries, self.budget
+        self.retries, self.budget = retries, budget
+
+        try:
+            yield
+        finally:
+            self.retries, self.budget = saved
+
+    @property
+    def controllers(self):
+        """Individual controllers, just this one."""
+        return [self]
+
+    def map(self, fn):
+        """Call `fn` with every controller, see `ArubaCluster.map`."""
+
+        try:
+            return [(self, fn(self), None)]
+        except Exception as e:
+            return [(self, None, e)]
+
+    def metrics(self):
+        return {
+            self.name: {
+                'scheduler': self.scheduler.metrics(),
+                'breaker': self.breaker.status(),
+            },
+        }
+
+    def get(self, command, stream=False, deadline=None):
         s = self.session.cookies.get('SESSION', '')
         p = '{0}@@{1}&UIDARUBA={2}'.format(command, int(time()), s)
-        r = self.session.get(self.command_url, verify=False, params=p)
 
-        # The controller shamelessly retains ASCII control characters and
-        # some users are able to inject them through their login names.
-        data = re.sub(b'[\x00-\x09\x11-\x12\x14-\x1f]',
-                      lambda m: ('\\x%.2x' % m.group(0)[0]).encode('utf8'),
-                      r.text.encode('utf8', 'xmlcharrefreplace'))
+        # Only the read-only commands are safe to repeat.
+        retries = self.retries if command.startswith('show ') else 0
+
+        def send(timeout):
+            return self.session.get(self.command_url, verify=False, params=p,
+                                    stream=stream, timeout=timeout)
+
+        return self.attempt(send, retries, deadline)
+
+    def request(self, command):
+        with self.scheduler.slot():
+            r = self.get(command)
+
+        data = sanitize(r.text.encode('utf8', 'xmlcharrefreplace'))
 
         if data:
             try:
@@ -54,14 +232,89 @@ class Aruba(object):
             except ParseError:
                 raise ArubaError('Response is not a valid XML element')
 
-    def request_table(self, command):
-        r = self.request(command)
+    def iter_table(self, command):
+        """
+        Iterate over rows of a tabular command output.
+
+        The response is parsed incrementally as it arrives and every row
+        is discarded right after it has been yielded, so that even large
+        tables can be processed without keeping them in memory.  The
+        budget is checked after every piece of the response.
+        """
+
+        deadline = monotonic() + self.budget
+
+        # The slot is held until the whole table arrives.
+        with self.scheduler.slot():
+            r = self.get(command, stream=True, deadline=deadline)
+            parser = XMLPullParser(events=('start', 'end'))
+
+            stack = []
+            table = None
+            header = True
+
+            chunks = r.iter_content(65536, decode_unicode=True)
+
+            try:
+                while True:
+                    try:
+                        with timed('controller'):
+                            chunk = next(chunks, None)
+
+                    except RequestException as e:
+                        self.breaker.failure()
+                        raise ArubaUnavailable('Controller is unavailable: {0}' \
+                                                    .format(e))
+
+                    if chunk is None:
+                        break
 
-        if r.find('t') is None:
+                    if monotonic() > deadline:
+                        self.breaker.failure()
+                        raise ArubaUnavailable('Controller is unavailable, '
+                                               'table took too long')
+
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode('utf8', 'xmlcharrefreplace')
+
+                    parser.feed(sanitize(chunk))
+
+                    for event, elem in parser.read_events():
+                        if event == 'start':
+                            if len(stack) == 1 and elem.tag == 't' \
+                                    and table is None:
+                                table = elem
+
+                            stack.append(elem)
+                            continue
+
+                        stack.pop()
+
+                        if table is None or not stack or stack[-1] is not table:
+                            continue
+
+                        table.remove(elem)
+
+                        if header:
+                            header = False
+                            continue
+
+                        yield [(c.text.strip() if c.text is not None else '') \
+                               for c in elem]
+
+                parser.close()
+
+            except ParseError:
+                raise ArubaError('Response is not a valid XML element')
+
+            finally:
+                r.close()
+
+        if table is None:
             raise ArubaError('Response does not contain a table')
 
-        return [[(c.text.strip() if c.text is not None else '') for c in row] \
-                for row in r.find('t')[1:]]
+    def request_table(self, command):
+        return list(self.iter_table(command))
 
     def request_dict(self, command):
         return {row[0]: row[1] for row in self.request_table(command)}
@@ -70,13 +323,17 @@ class Aruba(object):
         if self.request('show roleinfo').find('data'):
             return
 
-        r = self.session.post(self.login_url, verify=False, data={
-            'opcode': 'login',
-            'url': '/',
-            'needxml': '0',
-            'uid': self.username,
-            'passwd': self.password,
-        })
+        def send(timeout):
+            return self.session.post(self.login_url, verify=False, data={
+                'opcode': 'login',
+                'url': '/',
+                'needxml': '0',
+                'uid': self.username,
+                'passwd': self.password,
+            }, timeout=timeout)
+
+        with self.scheduler.slot():
+            r = self.attempt(send)
 
         if 'Authentication complete' not in r.text:
             raise ArubaError('Login failed')
@@ -95,14 +352,12 @@ class Aruba(object):
 
         return profiles
 
-    def list_stations(self):
-        """List client stations with MAC addresses and more."""
-
-        stations = {}
+    def iter_stations(self):
+        """Iterate over client stations with MAC addresses and more."""
 
-        r = self.request_table('show station-table')
+        r = self.iter_table('show station-table')
         for mac, name, role, age, auth, ap, essid, phy, remote, profile in r:
-            stations[mac] = {
+            yield {
                 'mac': mac,
                 'name': name,
                 'role': role,
@@ -115,12 +370,15 @@ class Aruba(object):
                 'profile': profile,
             }
 
-        return stations
+    def list_stations(self):
+        """List client stations with MAC addresses and more."""
+
+        return {station['mac']: station for station in self.iter_stations()}
 
     def essid_stats(self):
         stats = {}
 
-        for station in self.list_stations().values():
+        for station in self.iter_stations():
             essid = station['essid']
             stats.setdefault(essid, 0)
             stats[essid] += 1
@@ -130,7 +388,7 @@ class Aruba(object):
     def ap_stats(self):
         stats = {}
 
-        for station in self.list_stations().values():
+        for station in self.iter_stations():
             ap = station['ap']
             stats.setdefault(ap, 0)
             stats[ap] += 1
@@ -140,13 +398,124 @@ class Aruba(object):
     def edit_profile(self, profile, ssid, psk, active):
         """Adjust service profile. PSK is in plain text."""
 
-        self.request('wlan ssid-profile {0} essid {1}'.format(profile, ssid))
-        self.request('wlan ssid-profile {0} wpa-passphrase {1}'.format(profile, psk))
+        with priority(WRITE):
+            self.request('wlan ssid-profile {0} essid {1}'.format(profile, ssid))
+            self.request('wlan ssid-profile {0} wpa-passphrase {1}'.format(profile, psk))
 
-        if active:
-            self.request('wlan ssid-profile {0} ssid-enable'.format(profile))
-        else:
-            self.request('wlan ssid-profile {0} no ssid-enable'.format(profile))
+            if active:
+                self.request('wlan ssid-profile {0} ssid-enable'.format(profile))
+            else:
+                self.request('wlan ssid-profile {0} no ssid-enable'.format(profile))
+
+
+class ArubaCluster(object):
+    """
+    Multiple controllers serving the same network.
+
+    Station tables are downloaded from all the controllers at once and
+    merged.  Stations that roam between controllers can show up in more
+    than one table, in that case the entry with the lowest age wins.
+    Configuration is not handled here, it needs to be applied to every
+    controller on its own.
+    """
+
+    def __init__(self, controllers):
+        self.controllers = list(controllers)
+
+        # The same controller might be listed more than once, keep their
+        # status apart by adding the position to the name.
+        names = [c.name for c in self.controllers]
+
+        for i, c in enumerate(self.controllers):
+            if names.count(c.name) > 1:
+                c.name = '{0}#{1}'.format(c.name, i + 1)
+
+        # Every priority class gets its own threads, so that a long
+        # synchronization does not hold up the interactive downloads.
+        self.executors = {cls: ThreadPoolExecutor(len(self.controllers))
+                          for cls in CLASSES}
+
+        # Outcome of the last station download from every controller.
+        self.status = {}
+
+    def map(self, fn):
+        """
+        Call `fn` with every controller in parallel.
+
+        Returns list of `(controller, result, error)` tuples.  Commands
+        keep the priority of the calling thread.
+        """
+
+        cls = current_priority()
+        executor = self.executors[cls]
+
+        futures = [(c, executor.submit(call_with_priority, cls, fn, c))
+                   for c in self.controllers]
+
+        results = []
+
+        with timed('controller'):
+            for controller, future in futures:
+                try:
+                    results.append((controller, future.result(), None))
+                except Exception as e:
+                    results.append((controller, None, e))
+
+        return results
+
+    def login(self):
+        for controller, result, error in self.map(Aruba.login):
+            if error is not None:
+                raise error
+
+    def metrics(self):
+        metrics = {}
+
+        for c in self.controllers:
+            metrics.update(c.metrics())
+            metrics[c.name]['stations'] = self.status.get(c.name)
+
+        return metrics
+
+    def list_stations(self):
+        """
+        List client stations of all controllers.
+
+        Stations of the controllers that fail are left out, but when
+        all of them fail, the first error is raised.
+        """
+
+        stations = {}
+        errors = []
+
+        for controller, result, error in self.map(Aruba.list_stations):
+            if error is not None:
+                self.status[controller.name] = {'ok': False, 'error': str(error),
+                                                'time': time()}
+                errors.append(error)
+                continue
+
+            self.status[controller.name] = {'ok': True, 'error': None,
+                                            'time': time()}
+
+            for mac, station in result.items():
+                station['controller'] = controller.name
+                other = stations.get(mac)
+
+                if other is None or \
+                        parse_age(station['age']) < parse_age(other['age']):
+                    stations[mac] = station
+
+        if errors and len(errors) == len(self.controllers):
+            raise errors[0]
+
+        return stations
+
+    def iter_stations(self):
+        return iter(self.list_stations().values())
+
+    essid_stats = Aruba.essid_stats
+    ap_stats = Aruba.ap_stats
 
 
 # vim:set sw=4 ts=4 et:
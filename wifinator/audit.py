@@ -0,0 +1,294 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['AuditLog', 'AuditError', 'profile_state', 'audit_record',
+           'insert_records', 'export_audit', 'EXPORT_COLUMNS']
+
+from csv import writer
+from datetime import datetime
+from io import StringIO
+from threading import local
+from uuid import uuid4
+
+import fcntl
+import json
+import os
+
+
+# Flat columns of the CSV export.
+EXPORT_COLUMNS = ('id', 'time', 'user', 'profile',
+                  'old_ssid', 'old_psk', 'old_start', 'old_stop',
+                  'new_ssid', 'new_psk', 'new_start', 'new_stop')
+
+FIELDS = ('ssid', 'psk', 'start', 'stop')
+
+
+def profile_state(profile):
+    """
+    Serialize profile for the audit log.
+
+    Accepts a profile row, a dictionary with the same keys as returned
+    by `parse_profile` or `None` for a profile that does not exist.
+    """
+
+    if profile is None:
+        return None
+
+    if not isinstance(profile, dict):
+        profile = {field: getattr(profile, field) for field in FIELDS}
+
+    return {
+        'ssid': profile['ssid'],
+        'psk': profile['psk'],
+        'start': profile['start'].strftime('%Y-%m-%d %H:%M:%S'),
+        'stop': profile['stop'].strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def audit_record(username, pid, old, new, time=None):
+    """Row of the audit table describing a change of the profile."""
+
+    return {
+        'user': username,
+        'profile': pid,
+        'old_data': profile_state(old),
+        'new_data': profile_state(new),
+        'time': time or datetime.now(),
+    }
+
+
+def insert_records(db, records, bind=None):
+    """
+    Insert audit records using a single statement.
+
+    Uses the current session transaction unless an explicit connection
+    is passed in the `bind` argument.
+    """
+
+    if not records:
+        return
+
+    stmt = db.audit._table.insert().values(list(records))
+
+    if bind is None:
+        db.session.execute(stmt, bind=db.bind)
+    else:
+        bind.execute(stmt)
+
+
+class AuditError(Exception):
+    """Change could not be recorded in the audit log."""
+
+
+class AuditLog(object):
+    """
+    Records changes of the profiles.
+
+    By default, the records are inserted within the same transaction as
+    the change itself.  With a `queue` path, they are appended to that
+    write-ahead file instead and `flush()` then moves them to the
+    database in batches, sparing the requests one insert each.
+
+    Queued records are written and synced before the change commits and
+    cancelled when the commit fails, so that no committed change goes
+    unrecorded.  Should the process die in between, the record is kept
+    even though the change might not have been committed.
+
+    Callers record changes and then `commit()` or `rollback()` through
+    the log instead of the database session.  The queue is locked using
+    a `.lock` file next to it, so it can be shared by multiple processes.
+    """
+
+    def __init__(self, db, queue=None, batch=500):
+        self.db = db
+        self.queue = queue
+        self.batch = batch
+
+        if queue is not None:
+            self.lock_path = queue + '.lock'
+            self.processing = queue + '.processing'
+
+        # Records of the current transaction, waiting for commit.
+        self.pending = local()
+
+    def record(self, username, pid, old, new):
+        """Record change of a single profile, see `audit_record`."""
+        self.add([audit_record(username, pid, old, new)])
+
+    def add(self, records):
+        if self.queue is None:
+            insert_records(self.db, records)
+            return
+
+        if not hasattr(self.pending, 'records'):
+            self.pending.records = []
+
+        self.pending.records.extend(records)
+
+    def commit(self):
+        records = self.discard()
+
+        if not records:
+            self.db.commit()
+            return
+
+        txn = uuid4().hex
+        entries = [dict(r, time=r['time'].isoformat(), txn=txn)
+                   for r in records]
+
+        lock = None
+
+        try:
+            # Flushing waits for the transactions in progress.
+            lock = open(self.lock_path, 'a')
+            fcntl.flock(lock, fcntl.LOCK_SH)
+
+            self.append(entries)
+
+        except OSError as e:
+            if lock is not None:
+                lock.close()
+
+            self.db.rollback()
+            raise AuditError('Failed to record the change: {0}'.format(e))
+
+        with lock:
+            try:
+                self.db.commit()
+            except Exception:
+                try:
+                    self.append([{'cancel': txn}])
+                except OSError:
+                    # Imported here to keep wifinatorctl startup fast.
+                    from twisted.python import log
+                    log.err(None, 'Failed to cancel audit records')
+
+                raise
+
+    def rollback(self):
+        self.db.rollback()
+        self.discard()
+
+    def discard(self):
+        """Forget records of the current transaction, return them."""
+
+        records = getattr(self.pending, 'records', [])
+        self.pending.records = []
+        return records
+
+    def append(self, entries):
+        lines = ''.join(json.dumps(entry) + '\n' for entry in entries)
+
+        with open(self.queue, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.write(lines)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def flush(self):
+        """
+        Move queued records to the database.
+
+        Blocks until done, run it in a thread.  Returns number of the
+        records moved.
+        """
+
+        if self.queue is None:
+            return 0
+
+        # Set the queue aside, so that new records can be appended while
+        # we insert these.  Records left over by a failed flush go first.
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if not os.path.exists(self.processing):
+                if not os.path.exists(self.queue):
+                    return 0
+
+                os.rename(self.queue, self.processing)
+
+        records = []
+        cancelled = set()
+
+        with open(self.processing) as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+
+                entry = json.loads(line)
+
+                if 'cancel' in entry:
+                    cancelled.add(entry['cancel'])
+                    continue
+
+                records.append(entry)
+
+        records = [dict(r, time=datetime.fromisoformat(r['time']))
+                   for r in records if r.pop('txn', None) not in cancelled]
+
+        # Everything or nothing, the file is only removed once the
+        # records are safely in the database.
+        if records:
+            with self.db.bind.begin() as conn:
+                for i in range(0, len(records), self.batch):
+                    insert_records(self.db, records[i:i + self.batch], conn)
+
+        os.unlink(self.processing)
+        return len(records)
+
+
+def export_audit(db, start=None, stop=None, format='ndjson'):
+    """
+    Stream audit records in the given time range, oldest first.
+
+    Yields chunks of NDJSON or CSV text.  Rows are fetched using a server
+    side cursor, so that the whole log is never held in memory.
+    """
+
+    audit = db.audit._table
+    query = audit.select().order_by(audit.c.time, audit.c.id)
+
+    if start is not None:
+        query = query.where(audit.c.time >= start)
+
+    if stop is not None:
+        query = query.where(audit.c.time < stop)
+
+    if format == 'csv':
+        buf = StringIO()
+        out = writer(buf)
+        out.writerow(EXPORT_COLUMNS)
+
+    with db.bind.connect() as conn:
+        rows = conn.execution_options(stream_results=True).execute(query)
+
+        for row in rows:
+            time = row.time.isoformat()
+
+            if format == 'ndjson':
+                yield json.dumps({
+                    'id': row.id,
+                    'time': time,
+                    'user': row.user,
+                    'profile': row.profile,
+                    'old_data': row.old_data,
+                    'new_data': row.new_data,
+                }) + '\n'
+                continue
+
+            old = row.old_data or {}
+            new = row.new_data or {}
+
+            out.writerow((row.id, time, row.user, row.profile)
+                         + tuple(old.get(f) for f in FIELDS)
+                         + tuple(new.get(f) for f in FIELDS))
+
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+
+    if format == 'csv' and buf.tell():
+        yield buf.getvalue()
+
+
+# vim:set sw=4 ts=4 et:
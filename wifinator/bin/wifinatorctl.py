@@ -1,26 +1,27 @@
 #!/usr/bin/python3 -tt
 # -*- coding: utf-8 -*-
 
-import re
 import os
 import sys
+import json
+import time
 import click
+import getpass
 
 # Configuration is stored in a boring ini file.
 from configparser import ConfigParser
 from collections import OrderedDict
 
 # Output formatting libraries.
-from csv import writer, DictWriter
-from tabulate import tabulate
+from csv import writer
 
-# For affiliation rule parsing.
-from fnmatch import fnmatch
-
-from ldap3 import Server, Connection, ALL
-
-# Import the Aruba driver.
-from wifinator.aruba import Aruba
+# Lightweight parts of the application.  Heavy libraries such as the
+# `requests`, `ldap3`, `tabulate` or SQLAlchemy are imported only by
+# the code that needs them, in order to keep the startup fast.
+from wifinator.stations import StationSnapshot
+from wifinator.archive import *
+from wifinator.affiliation import *
+from wifinator.profile import *
 
 
 __all__ = ['cli']
@@ -35,50 +36,155 @@ class Model:
         # Save the configuration for later.
         self.ini = ini
 
-        # Read WiFi controller options.
-        aruba_address = ini.get('aruba', 'address')
-        aruba_username = ini.get('aruba', 'username')
-        aruba_password = ini.get('aruba', 'password')
-
         # No LDAP connection by default.
         self.ldap = None
 
-        # Prepare the WiFi controller client.
-        self.aruba = Aruba(aruba_address, aruba_username, aruba_password)
+        # No database connection by default either.
+        self.db = None
+
+        # WiFi controller client is prepared on first use.
+        self.aruba_client = None
 
         # Parse in the affiliation mapping rules.
-        self.affiliation = OrderedDict()
+        self.affiliation = AffiliationRules(ini.items('affiliation'))
+
+    @property
+    def aruba(self):
+        """WiFi controller client, logged in on first use."""
+
+        if self.aruba_client is None:
+            # Import the Aruba driver.
+            from wifinator.aruba import Aruba, ArubaCluster
+            from wifinator.breaker import CircuitBreaker
+            from wifinator.scheduler import Scheduler, CONCURRENCY
+
+            # Read WiFi controller options.
+            aruba_addresses = self.ini.get('aruba', 'address').split()
+            aruba_username = self.ini.get('aruba', 'username')
+            aruba_password = self.ini.get('aruba', 'password')
+
+            timeout = (self.ini.getfloat('aruba', 'connect-timeout', fallback=5.0),
+                       self.ini.getfloat('aruba', 'read-timeout', fallback=30.0))
+            retries = self.ini.getint('aruba', 'retries', fallback=2)
+            budget = self.ini.getfloat('aruba', 'budget', fallback=60.0)
+            failure_threshold = self.ini.getint('aruba', 'failure-threshold',
+                                                fallback=5)
+            reset_timeout = self.ini.getfloat('aruba', 'reset-timeout',
+                                              fallback=30.0)
 
-        for org, rules in ini.items('affiliation'):
-            self.affiliation[org] = re.split(r'\s+', rules)
+            def make_aruba(address):
+                # Respect the same limits as the daemon.
+                scheduler = Scheduler(
+                    self.ini.getint('aruba', 'concurrency',
+                                    fallback=CONCURRENCY),
+                    self.ini.getfloat('aruba', 'rate', fallback=None),
+                    self.ini.getfloat('aruba', 'burst', fallback=None))
+
+                breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+                return Aruba(address, aruba_username, aruba_password,
+                             scheduler, breaker, timeout, retries, budget)
+
+            if len(aruba_addresses) > 1:
+                aruba = ArubaCluster([make_aruba(a) for a in aruba_addresses])
+            else:
+                aruba = make_aruba(aruba_addresses[0])
+
+            aruba.login()
+
+            self.aruba_client = aruba
+
+        return self.aruba_client
 
     def enable_ldap(self):
         if self.ldap is not None:
             return
 
+        from ldap3 import Server, Connection, ALL
+
         ldap_host = self.ini.get('ldap', 'host')
         ldap_bind = self.ini.get('ldap', 'bind')
         ldap_pass = self.ini.get('ldap', 'pass')
 
-        self.ldap_base = self.ini.get('ldap', 'base')
-        self.ldap_filter = self.ini.get('ldap', 'filter')
-        self.ldap_attribute = self.ini.get('ldap', 'attribute')
+        ldap_cache = self.ini.get('ldap', 'cache', fallback=None)
+        cache_ttl = self.ini.getfloat('ldap', 'cache-ttl', fallback=86400)
+        negative_ttl = self.ini.getfloat('ldap', 'negative-ttl', fallback=3600)
 
         server = Server(ldap_host, get_info=ALL)
-        self.ldap = Connection(server, ldap_bind, ldap_pass, auto_bind=True)
+
+        def connect():
+            return Connection(server, ldap_bind, ldap_pass, auto_bind=True)
+
+        cache = None
+        if ldap_cache:
+            cache = ResolverCache(ldap_cache, cache_ttl, negative_ttl)
+
+        self.ldap = LdapResolver(connect,
+                                 self.ini.get('ldap', 'base'),
+                                 self.ini.get('ldap', 'filter'),
+                                 self.ini.get('ldap', 'attribute'),
+                                 cache=cache,
+                                 batch=self.ini.getint('ldap', 'batch', fallback=50),
+                                 connections=self.ini.getint('ldap', 'connections', fallback=4))
+
+        # Results of the lookups performed so far.
+        self.domains = {}
+
+    def close(self):
+        """Release the LDAP connections and their worker threads."""
+
+        if self.ldap is not None:
+            self.ldap.close()
+            self.ldap = None
+
+    def enable_db(self):
+        if self.db is not None:
+            return
+
+        # Data are accessed through SQLSoup, using SQLAlchemy.
+        from sqlalchemy.orm import scoped_session, sessionmaker
+        from sqlalchemy import create_engine
+        from sqlsoup import SQLSoup
+
+        db_url = self.ini.get('database', 'url')
+
+        engine = create_engine(db_url, isolation_level='SERIALIZABLE')
+        session = scoped_session(sessionmaker(autocommit=False, autoflush=False))
+        self.db = SQLSoup(engine, session=session)
+
+    def iter_stations(self, snapshot=None):
+        """Stations from the controller or from a saved snapshot."""
+
+        if snapshot is not None:
+            return last_snapshot(snapshot).iter_stations()
+
+        return self.aruba.iter_stations()
+
+    def load_locations(self):
+        self.enable_db()
+
+        rows = self.db.bind.execute('SELECT ap, location FROM location')
+        return {ap: location or 'Unknown' for ap, location in rows}
 
     def ldap_search(self, name):
         if self.ldap is None:
             return
 
-        self.ldap.search(self.ldap_base, self.ldap_filter.format(name=name),
-                         attributes=[self.ldap_attribute])
+        if name not in self.domains:
+            self.domains.update(self.ldap.resolve([name]))
+
+        return self.domains[name]
+
+    def ldap_prefetch(self, names):
+        """Resolve many names at once to speed up later `ldap_search`."""
 
-        if len(self.ldap.entries) > 0:
-            attr = getattr(self.ldap.entries[0], self.ldap_attribute)
+        if self.ldap is None:
+            return
 
-            if attr is not None and len(attr) > 0:
-                return attr[0]
+        names = {name for name in names
+                 if '@' not in name and name not in self.domains}
+
+        self.domains.update(self.ldap.resolve(names))
 
     def get_affiliation(self, name, essid):
         if '@' in name:
@@ -86,21 +192,28 @@ class Model:
         else:
             domain = self.ldap_search(name)
 
-        for org, rules in self.affiliation.items():
-            for rule in rules:
-                if domain is not None and fnmatch(domain, rule):
-                    return org
+        return self.affiliation.classify(domain, essid)
 
-                if fnmatch(essid, rule):
-                    return org
 
-        if domain is None:
-            return 'Local'
+pass_model = click.make_pass_decorator(Model)
 
-        return 'Other'
+def snapshot_option(fn):
+    """Allow a sub-command to run against a saved snapshot."""
 
+    return click.option('--from-snapshot', '-S', 'snapshot', metavar='PATH',
+                        type=click.Path(exists=True, dir_okay=False),
+                        help='Use the latest snapshot in the archive '
+                             'instead of the controller.')(fn)
 
-pass_model = click.make_pass_decorator(Model)
+def output_options(fn):
+    """Add the output format options to a sub-command."""
+
+    fn = click.option('--format', '-f', 'fmt', default='table',
+                      type=click.Choice(['table', 'csv', 'tsv', 'ndjson']),
+                      help='Output format.  All but table are streamed.')(fn)
+    fn = click.option('--csv', '-C', is_flag=True,
+                      help='Format output as CSV.')(fn)
+    return fn
 
 @click.group()
 @click.option('--config', '-c', default='/etc/ntk/wifinator.ini',
@@ -121,16 +234,20 @@ def cli(ctx, config):
         sys.exit(1)
 
     # Prepare the domain model.
+    # Controller login is deferred until it is actually needed.
     model = Model(config)
-    model.aruba.login()
 
     # Pass the our model onto the sub-commands.
     ctx.obj = model
 
+    # Clean up once the sub-command finishes.
+    ctx.call_on_close(model.close)
+
 @cli.command('stations')
-@click.option('--csv', '-C', is_flag=True, help='Format output as CSV.')
+@output_options
+@snapshot_option
 @pass_model
-def stations(model, csv=False):
+def stations(model, csv=False, fmt='table', snapshot=None):
     """
     Full station listing
     """
@@ -148,25 +265,32 @@ def stations(model, csv=False):
         ('profile', 'Profile'),
     ])
 
-    rows = list(model.aruba.list_stations().values())
-    print_table(headers, rows, csv)
+    rows = model.iter_stations(snapshot)
+    print_table(headers, rows, 'csv' if csv else fmt)
 
 @cli.command('essid-stats')
-@click.option('--csv', '-C', is_flag=True, help='Format output as CSV.')
+@output_options
+@snapshot_option
 @pass_model
-def essid_stats(model, csv=False):
+def essid_stats(model, csv=False, fmt='table', snapshot=None):
     """
     ESSID device counts
     """
 
-    rows = model.aruba.essid_stats().items()
-    print_table(('ESSID', 'Count'), sorted(rows), csv)
+    stats = {}
+
+    for station in model.iter_stations(snapshot):
+        stats[station['essid']] = stats.get(station['essid'], 0) + 1
+
+    rows = stats.items()
+    print_table(('ESSID', 'Count'), sorted(rows), 'csv' if csv else fmt)
 
 @cli.command('org-users')
-@click.option('--csv', '-C', is_flag=True, help='Format output as CSV.')
+@output_options
+@snapshot_option
 @click.option('--ldap', '-l', is_flag=True, help='Use LDAP to match logins.')
 @pass_model
-def user_domains(model, csv=False, ldap=False):
+def user_domains(model, csv=False, fmt='table', snapshot=None, ldap=False):
     """
     Organization user counts
 
@@ -181,7 +305,12 @@ def user_domains(model, csv=False, ldap=False):
     orgs = {}
     seen = set()
 
-    for station in model.aruba.list_stations().values():
+    stations = list(model.iter_stations(snapshot))
+
+    # Look up all the names in as few LDAP queries as possible.
+    model.ldap_prefetch(station['name'] for station in stations)
+
+    for station in stations:
         # Make sure we do not count the same user multiple times.
         # Yes, they can have multiple devices.
 
@@ -194,44 +323,331 @@ def user_domains(model, csv=False, ldap=False):
         orgs.setdefault(org, 0)
         orgs[org] += 1
 
-    print_table(('Organization', 'Count'), sorted(orgs.items()), csv)
+    print_table(('Organization', 'Count'), sorted(orgs.items()),
+                'csv' if csv else fmt)
 
-def print_table(headers, rows, csv=False):
-    if isinstance(headers, dict):
-        rows = reorder_rows_by_headers(headers, rows)
+@cli.group('snapshot')
+def snapshot():
+    """
+    Station table archive
+
+    Snapshots of the station table can be stored in a compact archive
+    and used later instead of the controller with --from-snapshot.
+    """
+
+@snapshot.command('save')
+@click.argument('path', type=click.Path(dir_okay=False))
+@pass_model
+def snapshot_save(model, path):
+    """
+    Append current station table to an archive
+    """
+
+    append_snapshot(path, model.aruba.iter_stations())
+
+@snapshot.command('list')
+@output_options
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@pass_model
+def snapshot_list(model, path, csv=False, fmt='table'):
+    """
+    List snapshots in an archive
+    """
+
+    rows = ((time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s.time)), len(s))
+            for s in read_snapshots(path))
+
+    print_table(('Time', 'Stations'), rows, 'csv' if csv else fmt)
+
+@cli.command('report')
+@click.option('--by', '-b', 'dimension', default='zone',
+              type=click.Choice(['zone', 'essid', 'org']),
+              help='What to group the stations by.')
+@click.option('--bucket', '-B', default='day',
+              type=click.Choice(['hour', 'day', 'month']),
+              help='Length of the reporting period.')
+@click.option('--percentile', '-p', 'percentiles', multiple=True,
+              type=float, default=[50, 95], metavar='P',
+              help='Percentile of concurrent users to report.')
+@click.option('--ldap', '-l', is_flag=True, help='Use LDAP to match logins.')
+@click.option('--format', '-f', 'fmt', default='csv',
+              type=click.Choice(['table', 'csv', 'tsv', 'ndjson', 'json']),
+              help='Output format.')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@pass_model
+def report(model, paths, dimension='zone', bucket='day', percentiles=(),
+           ldap=False, fmt='csv'):
+    """
+    Occupancy report from saved snapshots
+
+    Reads all snapshots from the given archives and reports peak, mean
+    and percentiles of concurrent users, distinct users and peak device
+    count for every zone, ESSID or organization in every period.
+    Requires NumPy.
+    """
+
+    try:
+        from wifinator.report import Report
+    except ImportError:
+        print('The report command requires NumPy, exiting.', file=sys.stderr)
+        sys.exit(1)
+
+    if ldap and dimension == 'org':
+        model.enable_ldap()
+
+    def classify(name, essid):
+        return model.get_affiliation(name, essid)
+
+    locations = model.load_locations() if dimension == 'zone' else None
+    result = Report(dimension, bucket, percentiles, locations, classify)
+
+    for path in paths:
+        for snapshot in read_snapshots(path):
+            if dimension == 'org':
+                model.ldap_prefetch(snapshot.dicts['name'])
+
+            result.add(snapshot)
+
+    headers = result.headers()
+
+    if fmt == 'json':
+        keys = [h.lower() for h in headers]
+        json.dump([dict(zip(keys, row)) for row in result.rows()],
+                  sys.stdout, indent=2)
+        print()
+    else:
+        print_table(headers, result.rows(), fmt)
+
+@cli.command('import')
+@click.option('--format', '-f', type=click.Choice(['csv', 'json']),
+              help='Input format, guessed from the contents by default.')
+@click.option('--user', '-u', default=None,
+              help='User name to record in the audit log, '
+                   'the current user by default.')
+@click.option('--sync/--no-sync', default=True,
+              help='Synchronize the controller afterwards.')
+@click.argument('path', type=click.File('r'))
+@pass_model
+def import_profiles(model, path, format=None, user=None, sync=True):
+    """
+    Bulk profile import
+
+    Reads profiles from a CSV file with the ssid, psk, start and stop
+    columns or from a JSON list of objects with the same keys.  Dates are
+    in the YYYY-MM-DD format.  All profiles are validated first and then
+    created in a single transaction, followed by a single controller
+    synchronization.
+    """
+
+    from sqlalchemy.exc import SQLAlchemyError
+    from wifinator.manager import Manager
+
+    if user is None:
+        try:
+            user = getpass.getuser()
+        except (KeyError, OSError):
+            print('Cannot determine current user, use --user.',
+                  file=sys.stderr)
+            sys.exit(1)
+
+    model.enable_db()
+
+    try:
+        profiles = parse_profiles(read_profiles(path.read(), format))
+    except ProfileError as e:
+        print(e.args[0], file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        ids = insert_profiles(model.db, profiles, user)
+        model.db.commit()
+    except SQLAlchemyError as e:
+        model.db.rollback()
+        print(e.args[0], file=sys.stderr)
+        sys.exit(1)
+
+    print('Imported {0} profiles.'.format(len(ids)), file=sys.stderr)
+
+    if sync:
+        from wifinator.aruba import ArubaError
+        from wifinator.scheduler import call_with_priority, WRITE
+
+        profile_prefix = model.ini.get('aruba', 'profile-prefix')
+
+        try:
+            manager = Manager(model.db, model.aruba, profile_prefix)
+            call_with_priority(WRITE, manager.sync)
+        except (ArubaError, SQLAlchemyError) as e:
+            print('Synchronization failed, the profiles will be applied '
+                  'by the daemon later: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
+
+@cli.command('watch')
+@click.option('--interval', '-i', default=5.0, metavar='SECONDS',
+              help='Sampling interval.')
+@click.option('--rate', '-r', is_flag=True,
+              help='Show rate of change per minute.')
+@click.option('--ldap', '-l', is_flag=True,
+              help='Use LDAP to match logins for the org view.')
+@click.argument('view', type=click.Choice(['essid', 'ap', 'org', 'zone']))
+@pass_model
+def watch(model, view, interval=5.0, rate=False, ldap=False):
+    """
+    Continuously refreshed counts
+
+    Keeps a single controller session open and samples the station table
+    in regular intervals.  Full table is printed at the beginning, then
+    only the rows that have changed since the previous sample.
 
-    if csv:
-        if isinstance(headers, dict):
-            w = DictWriter(sys.stdout, dialect='unix',
-                           fieldnames=[h.lower() for h in headers])
+    Views are ESSID and AP device counts, organization user counts and
+    zone user counts, the last one using the locations in the database.
+    """
+
+    from wifinator.aruba import ArubaError, ArubaUnavailable
+    from tabulate import tabulate
 
-            w.writeheader()
+    if ldap and view == 'org':
+        model.enable_ldap()
 
-            for row in rows:
-                w.writerow({k.lower(): v for k, v in row.items()})
+    locations = model.load_locations() if view == 'zone' else None
+
+    def list_stations():
+        try:
+            return model.aruba.list_stations()
+        except ArubaUnavailable:
+            raise
+        except ArubaError:
+            # The session has most probably expired.
+            model.aruba.login()
+            return model.aruba.list_stations()
+
+    def sample():
+        try:
+            stations = list_stations()
+        except ArubaUnavailable as e:
+            stamp = time.strftime('%H:%M:%S')
+            print('{0}  Skipping sample: {1}'.format(stamp, e),
+                  file=sys.stderr)
+            return None
+
+        counts = {}
+
+        if view == 'essid':
+            for station in stations.values():
+                counts[station['essid']] = counts.get(station['essid'], 0) + 1
+
+        elif view == 'ap':
+            for station in stations.values():
+                counts[station['ap']] = counts.get(station['ap'], 0) + 1
+
+        elif view == 'org':
+            users = {s['name']: s['essid'] for s in stations.values()}
+            model.ldap_prefetch(users)
+
+            for name, essid in users.items():
+                org = model.get_affiliation(name, essid)
+                counts[org] = counts.get(org, 0) + 1
 
         else:
-            w = writer(sys.stdout, dialect='unix')
-            w.writerow([h.lower() for h in headers])
+            counts = StationSnapshot(stations).zone_counts(locations)
+
+        return counts
+
+    title = {'essid': 'ESSID', 'ap': 'AP', 'org': 'Organization',
+             'zone': 'Zone'}[view]
+
+    try:
+        last = sample()
+        last_time = time.time()
+
+        while last is None:
+            time.sleep(interval)
+            last = sample()
+            last_time = time.time()
+
+        print(tabulate(sorted(last.items()), (title, 'Count')))
+        sys.stdout.flush()
+
+        width = max([len(title)] + [len(str(k)) for k in last])
+
+        tick = last_time
+
+        while True:
+            time.sleep(max(0, tick + interval - time.time()))
+
+            counts = sample()
+            now = tick = time.time()
+
+            if counts is None:
+                # Compare the next sample with the last one we have got.
+                continue
+
+            stamp = time.strftime('%H:%M:%S', time.localtime(now))
+
+            for key in sorted(set(counts) | set(last), key=str):
+                old = last.get(key, 0)
+                new = counts.get(key, 0)
 
-            for row in rows:
-                w.writerow(row)
+                if old == new:
+                    continue
 
+                width = max(width, len(str(key)))
+                line = '{0}  {1:<{2}}  {3:>6}  {4:>+6}' \
+                            .format(stamp, key, width, new, new - old)
+
+                if rate:
+                    line += '  {0:>+8.1f}/min' \
+                                .format((new - old) * 60 / (now - last_time))
+
+                print(line)
+
+            sys.stdout.flush()
+
+            last = counts
+            last_time = now
+
+    except KeyboardInterrupt:
+        pass
+
+def print_table(headers, rows, format='table'):
+    """
+    Print rows in the requested format.
+
+    The `headers` are either a sequence of column titles with rows being
+    sequences as well, or a mapping of row keys to column titles with rows
+    being dictionaries.  All formats except for the table are written out
+    row by row as they are produced, without collecting them first.
+    """
+
+    if isinstance(headers, dict):
+        keys = list(headers)
+        titles = list(headers.values())
+        rows = (tuple(row[k] for k in keys) for row in rows)
     else:
-        print(tabulate(rows, headers))
+        keys = [h.lower() for h in headers]
+        titles = list(headers)
 
-def reorder_rows_by_headers(headers, rows):
-    new_rows = []
+    if format == 'csv':
+        write_rows(writer(sys.stdout, dialect='unix'), keys, rows)
 
-    for row in rows:
-        new_row = OrderedDict()
+    elif format == 'tsv':
+        write_rows(writer(sys.stdout, dialect='excel-tab',
+                          lineterminator='\n'), keys, rows)
 
-        for header in headers:
-            new_row[header] = row[header]
+    elif format == 'ndjson':
+        for row in rows:
+            sys.stdout.write(json.dumps(dict(zip(keys, row))) + '\n')
 
-        new_rows.append(new_row)
+    else:
+        from tabulate import tabulate
+        print(tabulate(list(rows), titles))
+
+def write_rows(w, keys, rows):
+    w.writerow(keys)
 
-    return new_rows
+    for row in rows:
+        w.writerow(row)
 
 
 if __name__ == '__main__':
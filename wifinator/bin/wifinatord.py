@@ -3,32 +3,177 @@
 
 import os
 import sys
+import json
 import click
+import shutil
+import socket
+import tempfile
 
 # Twisted hosts our website and helps with async development.
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.internet.protocol import ProcessProtocol
 from twisted.web.server import Site
 from twisted.web.wsgi import WSGIResource
+from twisted.web.resource import Resource
 from twisted.python import log
 
 # Data are accessed through SQLSoup, using SQLAlchemy.
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 from sqlsoup import SQLSoup
 
 # Configuration is stored in a boring ini file.
 from configparser import ConfigParser
 
 # Import all the application handles.
-from wifinator.aruba import Aruba
-from wifinator.manager import Manager
+from wifinator.aruba import Aruba, ArubaCluster
+from wifinator.audit import AuditLog
+from wifinator.breaker import CircuitBreaker
+from wifinator.events import ZoneEvents
+from wifinator.history import ZoneHistory
+from wifinator.manager import Manager, WorkerManager
 from wifinator.rbac import AccessModel
-from wifinator.site import make_site
+from wifinator.scheduler import Scheduler, CONCURRENCY, \
+                                call_with_priority, BACKGROUND
+from wifinator.shared import SharedFile
+from wifinator.site import make_site, warm_up_site
+from wifinator.warmup import WarmUp, reflect_tables
 
 
 __all__ = ['cli']
 
 
+class SiteRoot(Resource):
+    """
+    Serves native Twisted resources next to the WSGI website.
+
+    Streaming endpoints must not occupy a WSGI thread for the whole
+    lifetime of the connection, so they are registered as children of
+    this resource and everything else falls through to the website.
+    """
+
+    def __init__(self, wsgi):
+        Resource.__init__(self)
+        self.wsgi = wsgi
+
+    def getChild(self, path, request):
+        request.prepath.pop()
+        request.postpath.insert(0, path)
+        return self.wsgi
+
+
+# Descriptors the worker processes receive from the owner.
+LISTEN_FD = 3
+CONTROL_FD = 4
+
+
+class Worker(ProcessProtocol):
+    """
+    Worker process serving the website next to the owner.
+
+    Workers ask for controller synchronization by writing JSON lines
+    to their control descriptor.  Workers that die are started again.
+    """
+
+    def __init__(self, spawn, manager):
+        self.spawn = spawn
+        self.manager = manager
+        self.buffer = b''
+
+    def childDataReceived(self, fd, data):
+        if fd != CONTROL_FD:
+            return
+
+        self.buffer += data
+
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+
+            try:
+                force = json.loads(line.decode('utf8'))['sync']
+            except (ValueError, KeyError, TypeError):
+                log.msg('Invalid worker request: {0!r}'.format(line))
+                continue
+
+            self.manager.schedule_sync(force)
+
+    def processEnded(self, reason):
+        log.msg('Worker exited: {0}'.format(reason.value))
+        reactor.callLater(1.0, self.spawn)
+
+
+def spawn_workers(count, port, manager, argv):
+    """
+    Start additional processes sharing our listening socket.
+
+    Every worker runs the same website with its own interpreter, so that
+    the requests are spread over multiple cores.  The kernel distributes
+    incoming connections among all the processes accepting on the socket.
+    """
+
+    workers = []
+    stopping = []
+
+    def spawn():
+        if stopping:
+            return
+
+        worker = Worker(spawn, manager)
+        reactor.spawnProcess(worker, sys.executable,
+                             [sys.executable, '-m', 'wifinator.bin.wifinatord']
+                                + argv,
+                             env=os.environ,
+                             childFDs={0: 0, 1: 1, 2: 2,
+                                       LISTEN_FD: port.fileno(),
+                                       CONTROL_FD: 'r'})
+        workers.append(worker)
+
+    def stop():
+        stopping.append(True)
+
+        for worker in workers:
+            try:
+                worker.transport.signalProcess('TERM')
+            except Exception:
+                pass
+
+    for i in range(count):
+        spawn()
+
+    reactor.addSystemEventTrigger('before', 'shutdown', stop)
+
+
+def read_engine_options(url, size):
+    """
+    Options of the engine used for reading the data.
+
+    PostgreSQL sessions are also made read-only, so that an accidental
+    write fails instead of sneaking past the serializable transactions.
+    """
+
+    if make_url(url).get_backend_name() != 'postgresql':
+        return {}
+
+    return {
+        'isolation_level': 'READ COMMITTED',
+        'pool_size': size,
+        'max_overflow': size,
+        'connect_args': {
+            'options': '-c default_transaction_read_only=on',
+        },
+    }
+
+
+def request_sync(force):
+    """Ask the owner process to synchronize the controller."""
+
+    line = json.dumps({'sync': list(force)}) + '\n'
+    os.write(CONTROL_FD, line.encode('utf8'))
+
+
 @click.command()
 @click.option('--config', '-c', default='/etc/ntk/wifinator.ini',
               metavar='PATH', help='Load a configuration file.')
@@ -36,8 +181,14 @@ __all__ = ['cli']
 @click.option('--debug', '-d', default=False, is_flag=True,
               help='Enable debug logging.')
 
+@click.option('--workers', '-w', default=None, type=int, metavar='N',
+              help='Number of processes serving the website.')
+
+@click.option('--worker-of', default=None, metavar='PATH', hidden=True,
+              help='Run as a worker, reading samples from the file.')
+
 @click.version_option('0.1.0')
-def cli(config, debug):
+def cli(config, debug, workers, worker_of):
     """
     Run the Wifinátor site and all background tasks.
     """
@@ -55,11 +206,17 @@ def cli(config, debug):
 
     # Read database iniuration options.
     db_url = ini.get('database', 'url')
+    db_read_url = ini.get('database', 'read-url', fallback=db_url)
+    db_read_pool_size = ini.getint('database', 'read-pool-size', fallback=10)
 
     # Read website iniuration options.
     http_debug = ini.getboolean('http', 'debug', fallback=False)
     http_host = ini.get('http', 'host', fallback='localhost')
     http_port = ini.getint('http', 'port', fallback=5000)
+    slow_request = ini.getfloat('http', 'slow-request', fallback=None)
+
+    if workers is None:
+        workers = ini.getint('http', 'workers', fallback=1)
 
     # Read role mappings.
     access_model = AccessModel(ini.items('access'))
@@ -69,30 +226,180 @@ def cli(config, debug):
     session = scoped_session(sessionmaker(autocommit=False, autoflush=False))
     db = SQLSoup(engine, session=session)
 
+    # Reads do not need serializable transactions and should not compete
+    # with the writes for connections, so they get their own pool.
+    read_engine = create_engine(db_read_url,
+                                **read_engine_options(db_read_url,
+                                                      db_read_pool_size))
+    read_session = scoped_session(sessionmaker(autocommit=False,
+                                               autoflush=False))
+    read_db = SQLSoup(read_engine, session=read_session)
+
     # Read WiFi controller options.
-    aruba_address = ini.get('aruba', 'address')
+    aruba_addresses = ini.get('aruba', 'address').split()
     aruba_username = ini.get('aruba', 'username')
     aruba_password = ini.get('aruba', 'password')
     profile_prefix = ini.get('aruba', 'profile-prefix')
+    station_max_age = ini.getfloat('aruba', 'station-max-age', fallback=30.0)
+    sample_interval = ini.getfloat('aruba', 'sample-interval', fallback=10.0)
+    concurrency = ini.getint('aruba', 'concurrency', fallback=CONCURRENCY)
+    rate = ini.getfloat('aruba', 'rate', fallback=None)
+    burst = ini.getfloat('aruba', 'burst', fallback=None)
+
+    connect_timeout = ini.getfloat('aruba', 'connect-timeout', fallback=5.0)
+    read_timeout = ini.getfloat('aruba', 'read-timeout', fallback=30.0)
+    retries = ini.getint('aruba', 'retries', fallback=2)
+    budget = ini.getfloat('aruba', 'budget', fallback=60.0)
+    warm_up_budget = ini.getfloat('aruba', 'warm-up-budget', fallback=10.0)
+    failure_threshold = ini.getint('aruba', 'failure-threshold', fallback=5)
+    reset_timeout = ini.getfloat('aruba', 'reset-timeout', fallback=30.0)
+
+    def make_aruba(address):
+        # Limit the load we put on the controller from this process.
+        scheduler = Scheduler(concurrency, rate, burst)
+
+        # Stop waiting for the controller when it keeps failing.
+        breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        breaker.listeners.append(lambda old, new: \
+                log.msg('Controller {0} circuit breaker {1} -> {2}' \
+                            .format(address, old, new)))
+
+        return Aruba(address, aruba_username, aruba_password, scheduler,
+                     breaker, (connect_timeout, read_timeout), retries,
+                     budget)
+
+    # Prepare the WiFi controller client, possibly for multiple controllers.
+    if len(aruba_addresses) > 1:
+        aruba = ArubaCluster([make_aruba(a) for a in aruba_addresses])
+    else:
+        aruba = make_aruba(aruba_addresses[0])
+
+    # Read zone history options.
+    history_path = ini.get('history', 'path', fallback=None)
+    history_keep = {
+        'hour': ini.getint('history', 'hours', fallback=48),
+        'day': ini.getint('history', 'days', fallback=31),
+    }
+    history_exclude = ini.get('history', 'exclude', fallback='').split()
+
+    if min(history_keep.values()) < 1:
+        log.msg('History must keep at least one hour and one day, exiting.')
+        sys.exit(1)
+
+    # Read audit log options.
+    audit_queue = ini.get('audit', 'queue', fallback=None)
+    audit_batch = ini.getint('audit', 'batch', fallback=500)
+    audit_flush_interval = ini.getfloat('audit', 'flush-interval', fallback=1.0)
+
+    audit = AuditLog(db, audit_queue, audit_batch)
+
+    if worker_of is not None:
+        # Read history saved by the owner process.
+        if history_path is None:
+            history_path = os.path.join(os.path.dirname(worker_of), 'history')
+
+        history = ZoneHistory(history_keep, history_exclude, history_path)
+
+        # Use samples taken by the owner process.
+        manager = WorkerManager(db, aruba, profile_prefix, station_max_age,
+                                sample_interval, SharedFile(worker_of),
+                                history, read_db, request_sync)
 
-    # Prepare the WiFi controller client.
-    aruba = Aruba(aruba_address, aruba_username, aruba_password)
+    elif workers > 1:
+        # Publish samples for the workers, preferably in memory.
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        shared_dir = tempfile.mkdtemp(prefix='wifinator-', dir=shm)
+        shared = SharedFile(os.path.join(shared_dir, 'sample'))
 
-    # Prepare the manager that runs our background tasks.
-    manager = Manager(db, aruba, profile_prefix)
+        reactor.addSystemEventTrigger('after', 'shutdown',
+                                      shutil.rmtree, shared_dir, True)
+
+        # The workers need to see the history as well.
+        if history_path is None:
+            history_path = os.path.join(shared_dir, 'history')
+
+        history = ZoneHistory(history_keep, history_exclude, history_path)
+
+        # Prepare the manager that runs our background tasks.
+        manager = Manager(db, aruba, profile_prefix, station_max_age,
+                          sample_interval, shared, history, read_db)
+
+    else:
+        history = ZoneHistory(history_keep, history_exclude, history_path)
+
+        # Prepare the manager that runs our background tasks.
+        manager = Manager(db, aruba, profile_prefix, station_max_age,
+                          sample_interval, history=history, read_db=read_db)
+
+    # Track how far we are with the preparations.
+    warmup = WarmUp()
 
     # Prepare the website that will get exposed to the users.
-    site = make_site(db, manager, access_model, debug=http_debug)
+    app = make_site(db, manager, access_model, debug=http_debug,
+                    slow_request=slow_request, audit=audit, warmup=warmup)
+
+    # Do the slow things now, instead of during the first requests.
+    warmup.run('database', reflect_tables, db)
+    warmup.run('read database', reflect_tables, read_db)
+
+    warm_up_site(app, warmup)
+    manager.warm_up(warmup, warm_up_budget)
+    warmup.finish()
+
+    if not warmup.ready:
+        # Keep trying to get fully ready in the background.
+        def retry_warm_up():
+            d = deferToThread(call_with_priority, BACKGROUND, warmup.retry)
+            d.addCallback(lambda ready: ready and retry.stop())
+            d.addErrback(log.err, 'Warm-up retry failed')
+            return d
+
+        retry = LoopingCall(retry_warm_up)
+        retry.start(30.0, now=False)
 
     # Prepare WSGI resource for the website.
-    site = Site(WSGIResource(reactor, reactor.getThreadPool(), site))
+    root = SiteRoot(WSGIResource(reactor, reactor.getThreadPool(), app))
 
-    # Bind the website to it's address.
-    reactor.listenTCP(http_port, site, interface=http_host)
+    # Stream zone counts to the wall displays.
+    events = Resource()
+    events.putChild(b'zones', ZoneEvents(manager))
+    root.putChild(b'events', events)
+
+    site = Site(root)
+
+    if worker_of is not None:
+        # Accept connections on the socket inherited from the owner.
+        sock = socket.socket(fileno=LISTEN_FD)
+        family = sock.family
+        sock.detach()
+
+        reactor.adoptStreamPort(LISTEN_FD, family, site)
+
+    else:
+        # Bind the website to it's address.
+        port = reactor.listenTCP(http_port, site, interface=http_host)
+
+        if workers > 1:
+            argv = ['--config', config, '--worker-of', shared.path]
+
+            if debug:
+                argv.append('--debug')
+
+            spawn_workers(workers - 1, port, manager, argv)
 
     # Schedule a call to the manager right after we finish here.
     reactor.callLater(0, manager.start)
 
+    if audit_queue is not None and worker_of is None:
+        # Move queued audit records to the database, for workers as well.
+        def flush_audit():
+            return deferToThread(audit.flush).addErrback(log.err)
+
+        LoopingCall(flush_audit).start(audit_flush_interval, now=False)
+
+        # Do not leave anything behind.
+        reactor.addSystemEventTrigger('before', 'shutdown', flush_audit)
+
     # Run the Twisted reactor until the user terminates us.
     reactor.run()
 
@@ -0,0 +1,110 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['CircuitBreaker', 'CLOSED', 'OPEN', 'HALF_OPEN']
+
+from threading import Lock
+from time import monotonic, time
+
+
+# Commands pass through.
+CLOSED = 'closed'
+
+# Commands fail right away.
+OPEN = 'open'
+
+# Single probe is let through to find out whether to close again.
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Stops talking to a service that keeps failing.
+
+    After `threshold` consecutive failures the breaker opens and all
+    calls are refused for `reset_timeout` seconds.  Then a single probe
+    is let through.  When it succeeds, the breaker closes again,
+    otherwise it stays open for another period.
+
+    Callers ask for permission using `allow()` and must report the
+    outcome of every permitted call using `success()` or `failure()`.
+    Listeners are called with the old and new state on every change.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.changed = time()
+
+        self.listeners = []
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN:
+                if monotonic() < self.opened + self.reset_timeout:
+                    return False
+
+                change = self.transition(HALF_OPEN)
+            else:
+                change = None
+
+            allowed = not self.probing
+            self.probing = True
+
+        self.notify(change)
+        return allowed
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            change = self.transition(CLOSED)
+
+        self.notify(change)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            change = None
+
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.opened = monotonic()
+                change = self.transition(OPEN)
+
+        self.notify(change)
+
+    def transition(self, state):
+        if state == self.state:
+            return None
+
+        old, self.state = self.state, state
+        self.changed = time()
+        return (old, state)
+
+    def notify(self, change):
+        # Called without the lock held, so that listeners can inspect us.
+        if change is None:
+            return
+
+        for listener in list(self.listeners):
+            listener(*change)
+
+    def status(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'since': self.changed,
+        }
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,140 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['ZoneEvents']
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from twisted.python import log
+from zope.interface import implementer
+
+from time import time
+
+import json
+import re
+
+
+@implementer(IPushProducer)
+class ZoneSubscriber(object):
+    """
+    Single client connected to the zone event stream.
+
+    Registered as a streaming producer of its request, so that Twisted
+    pauses it whenever the client does not keep up.  While paused, only
+    the most recent counts are retained and sent once the client drains
+    its buffer.  Slow clients therefore skip intermediate updates instead
+    of accumulating them in memory.
+    """
+
+    # Send a comment after this many seconds of silence to keep the
+    # connection from being closed by proxies.
+    KEEPALIVE = 30.0
+
+    def __init__(self, request, exclude):
+        self.request = request
+        self.exclude = exclude
+
+        self.paused = False
+        self.last = None
+        self.pending = None
+        self.written = time()
+
+        request.registerProducer(self, True)
+
+    def update(self, counts):
+        if self.paused:
+            self.pending = counts if counts != self.last else None
+
+        elif counts != self.last:
+            self.send(counts)
+
+        elif self.written + self.KEEPALIVE < time():
+            self.write(b':\n\n')
+
+    def send(self, counts):
+        self.last = counts
+        self.pending = None
+        self.write(b'data: ' + json.dumps(counts).encode('utf8') + b'\n\n')
+
+    def write(self, data):
+        self.written = time()
+        self.request.write(data)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+        if self.pending is not None:
+            self.send(self.pending)
+
+    def stopProducing(self):
+        self.paused = True
+        self.pending = None
+
+
+class ZoneEvents(Resource):
+    """
+    Server-Sent Events stream of zone user counts.
+
+    Accepts the same `exclude` argument as `/zones`.  Counts are pushed
+    whenever the manager takes a new station sample, but only to the
+    clients whose counts have actually changed.  Counts are computed
+    once per distinct `exclude` set, regardless of number of clients.
+    """
+
+    isLeaf = True
+
+    def __init__(self, manager):
+        Resource.__init__(self)
+
+        self.manager = manager
+        self.subscribers = set()
+        self.latest = None
+
+        manager.listeners.append(self.publish)
+
+    def render_GET(self, request):
+        exclude = request.args.get(b'exclude', [b''])[0].decode('utf8')
+        exclude = frozenset(re.split(r'\s+', exclude.strip()))
+
+        request.setHeader(b'Content-Type', b'text/event-stream; charset=utf-8')
+        request.setHeader(b'Cache-Control', b'no-cache')
+        request.setHeader(b'X-Accel-Buffering', b'no')
+        request.write(b'retry: 5000\n\n')
+
+        subscriber = ZoneSubscriber(request, exclude)
+        self.subscribers.add(subscriber)
+
+        def finished(result):
+            self.subscribers.discard(subscriber)
+
+        request.notifyFinish().addBoth(finished)
+
+        if self.latest is not None:
+            snapshot, locations = self.latest
+            subscriber.update(snapshot.zone_counts(locations, exclude))
+
+        return NOT_DONE_YET
+
+    def publish(self, snapshot, locations):
+        self.latest = (snapshot, locations)
+
+        counts = {}
+
+        for subscriber in list(self.subscribers):
+            if subscriber.exclude not in counts:
+                counts[subscriber.exclude] = \
+                        snapshot.zone_counts(locations, subscriber.exclude)
+
+            try:
+                subscriber.update(counts[subscriber.exclude])
+            except Exception:
+                # Do not let a broken client spoil it for the others.
+                log.err(None, 'Zone event subscriber failed, dropping')
+                self.subscribers.discard(subscriber)
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,120 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['ZoneHistory', 'BUCKETS']
+
+from threading import Lock
+from time import localtime, strftime
+
+from wifinator.hll import HyperLogLog, hash64, PRECISION
+from wifinator.shared import SharedFile
+
+
+# How to label samples of the given bucket.
+BUCKETS = {
+    'hour': '%Y-%m-%d %H:00',
+    'day': '%Y-%m-%d',
+}
+
+
+class ZoneHistory(object):
+    """
+    Distinct users in every zone per hour and per day.
+
+    Every station sample is folded into a HyperLogLog sketch of each
+    zone for the current hour and the current day, so that the memory
+    used does not grow with the number of samples or users.  Only the
+    most recent `keep[bucket]` periods are retained.
+
+    When a `path` is given, the sketches are saved there by `save()` and
+    loaded from there by `load()`, which is how the history survives
+    restarts and how the worker processes get to see it.
+    """
+
+    def __init__(self, keep={'hour': 48, 'day': 31}, exclude=(), path=None,
+                 p=PRECISION):
+        for bucket, periods in keep.items():
+            if bucket not in BUCKETS:
+                raise ValueError('Unknown history bucket {0!r}'.format(bucket))
+
+            if periods < 1:
+                raise ValueError('At least one {0} of history must be kept' \
+                                    .format(bucket))
+
+        self.keep = dict(keep)
+        self.exclude = frozenset(exclude)
+        self.p = p
+
+        self.lock = Lock()
+        self.file = SharedFile(path) if path is not None else None
+
+        # {bucket: {label: {zone: sketch}}}
+        self.sketches = {bucket: {} for bucket in self.keep}
+
+    def add(self, snapshot, locations):
+        """
+        Fold another station snapshot into the history.
+
+        Most of the work is done before taking the lock, so that the
+        readers are not held up.  Please run in a thread.
+        """
+
+        zones = snapshot.zone_users(locations, self.exclude)
+        when = localtime(snapshot.time)
+
+        # Sketch of this sample alone, every user is hashed just once.
+        sample = {}
+
+        for zone, users in zones.items():
+            sketch = sample[zone] = HyperLogLog(self.p)
+
+            for user in users:
+                sketch.add_hash(hash64(user))
+
+        with self.lock:
+            for bucket, sketches in self.sketches.items():
+                label = strftime(BUCKETS[bucket], when)
+                period = sketches.setdefault(label, {})
+
+                for zone, sketch in sample.items():
+                    if zone in period:
+                        period[zone].merge(sketch)
+                    else:
+                        period[zone] = HyperLogLog(self.p, sketch.registers)
+
+                # Labels sort chronologically.
+                labels = sorted(sketches)
+
+                for label in labels[:max(0, len(labels) - self.keep[bucket])]:
+                    del sketches[label]
+
+    def counts(self, bucket):
+        """
+        Estimated distinct users per zone in the retained periods.
+
+        Returns a list of `(label, {zone: users})` pairs, oldest first.
+        """
+
+        with self.lock:
+            return [(label, {zone: sketch.count()
+                             for zone, sketch in period.items()})
+                    for label, period in sorted(self.sketches[bucket].items())]
+
+    def save(self):
+        with self.lock:
+            self.file.write(self.sketches)
+
+    def load(self):
+        """Read the saved sketches, unless they did not change."""
+
+        if self.file is None or not self.file.changed():
+            return
+
+        sketches = self.file.read()
+
+        with self.lock:
+            for bucket in self.sketches:
+                self.sketches[bucket] = sketches.get(bucket, {})
+
+
+# vim:set sw=4 ts=4 et:
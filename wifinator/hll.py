@@ -0,0 +1,98 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['HyperLogLog', 'hash64', 'position', 'estimate', 'PRECISION']
+
+from hashlib import blake2b
+from math import log
+
+
+# Default number of index bits, 2048 registers with ~2.3 % standard error.
+PRECISION = 11
+
+
+def hash64(value):
+    """Stable 64bit hash of a string, the same in every process."""
+    return int.from_bytes(blake2b(value.encode('utf8'), digest_size=8).digest(),
+                          'little')
+
+
+def position(h, p=PRECISION):
+    """Register index and rank of a 64bit hash."""
+
+    bits = 64 - p
+    rest = h & ((1 << bits) - 1)
+    return h >> bits, bits - rest.bit_length() + 1
+
+
+def estimate(registers):
+    """Estimate cardinality from a sequence of register values."""
+
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+
+    zeros = 0
+    total = 0.0
+
+    for r in registers:
+        total += 2.0 ** -r
+
+        if not r:
+            zeros += 1
+
+    e = alpha * m * m / total
+
+    # Use linear counting for small cardinalities.
+    if e <= 2.5 * m and zeros:
+        return m * log(m / zeros)
+
+    return e
+
+
+class HyperLogLog(object):
+    """
+    Cardinality estimate of a set in constant memory.
+
+    Sketches of the same precision can be merged, which results in the
+    sketch of union of the original sets.  Adding the same value again
+    does not change the sketch at all.
+    """
+
+    def __init__(self, p=PRECISION, registers=None):
+        self.p = p
+
+        if registers is None:
+            registers = bytearray(1 << p)
+
+        self.registers = bytearray(registers)
+
+    def add(self, value):
+        self.add_hash(hash64(value))
+
+    def add_hash(self, h):
+        index, rank = position(h, self.p)
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Fold another sketch into this one."""
+
+        if other.p != self.p:
+            raise ValueError('Cannot merge sketches of different precision')
+
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        return int(round(estimate(self.registers)))
+
+    def __len__(self):
+        return self.count()
+
+
+# vim:set sw=4 ts=4 et:
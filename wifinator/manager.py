@@ -1,23 +1,94 @@
 #!/usr/bin/python3 -tt
 # -*- coding: utf-8 -*-
 
-__all__ = ['Manager']
+__all__ = ['Manager', 'WorkerManager']
 
 from twisted.internet.threads import deferToThread
 from twisted.internet import task, reactor
 from twisted.python import log
 
-from wifinator.aruba import Aruba, ArubaError
+from contextlib import ExitStack
+from threading import Lock
+from time import time
+
+import os
+
+from wifinator.aruba import Aruba, ArubaError, ArubaUnavailable
+from wifinator.scheduler import call_with_priority, WRITE, BACKGROUND
+from wifinator.stations import StationSnapshot
 
 class Manager(object):
-    def __init__(self, db, aruba, profile_prefix):
+    def __init__(self, db, aruba, profile_prefix, station_max_age=30,
+                 sample_interval=10, shared=None, history=None,
+                 read_db=None):
+        # Serializable database for writes, read-only one for the rest.
         self.db = db
+        self.read_db = read_db or db
         self.aruba = aruba
         self.profile_prefix = profile_prefix
 
+        # Latest station table, shared by all the readers.
+        self.station_max_age = station_max_age
+        self.station_snapshot = None
+        self.station_lock = Lock()
+
+        # Access point to zone mapping.
+        self.locations = None
+
+        # Callables to notify about every new sample.
+        self.sample_interval = sample_interval
+        self.listeners = []
+
+        # Where to publish samples for the worker processes.
+        self.shared = shared
+
+        # Outcome of the last synchronization of every controller.
+        self.sync_status = {}
+
+        # Distinct users per zone over time.
+        self.history = history
+
     def start(self):
         """Starts periodic operations."""
+
+        if self.history is not None:
+            self.history.load()
+
+            if self.history.file is not None:
+                task.LoopingCall(self.schedule_history_save) \
+                        .start(60.0, now=False)
+
         task.LoopingCall(self.schedule_sync).start(300.0)
+        task.LoopingCall(self.schedule_sample).start(self.sample_interval)
+
+    def warm_up(self, warmup, budget=10.0):
+        """
+        Log into the controller and take the first sample.
+
+        Called before accepting any requests, so that the first ones
+        do not have to wait for the controller.  Every command gets just
+        a single try limited to `budget` seconds, failed steps are left
+        for `warmup.retry()` instead of keeping the site down.
+        """
+
+        def sample():
+            # Continue the saved history, instead of replacing it later.
+            if self.history is not None:
+                self.history.load()
+
+            self.sample()
+
+        with self.warm_up_limits(budget):
+            warmup.run('controller', self.aruba.login)
+            warmup.run('sample', sample)
+
+    def warm_up_limits(self, budget):
+        stack = ExitStack()
+
+        for aruba in self.aruba.controllers:
+            stack.enter_context(aruba.limits(0, budget))
+
+        return stack
 
     def sync(self, force=[]):
         """
@@ -33,8 +104,12 @@ class Manager(object):
 
         log.msg('Starting synchronization...')
 
-        # Fetch profiles that should be active right now.
-        desired_profiles = self.db.bind.execute('''
+        # Fetch profiles that should be active right now.  A replica might
+        # lag behind the changes we are about to propagate, so use the
+        # primary, but without the overhead of a serializable transaction.
+        desired_profiles = self.db.bind \
+                .execution_options(isolation_level='READ COMMITTED') \
+                .execute('''
             SELECT ssid, psk
             FROM profile
             WHERE tsrange(start, stop) @> now()::timestamp
@@ -42,11 +117,37 @@ class Manager(object):
 
         desired_profiles = {ssid: psk for ssid, psk in desired_profiles}
 
+        def sync_controller(aruba):
+            return self.sync_controller(aruba, dict(desired_profiles), force)
+
+        # Configure all the controllers at once.
+        errors = []
+
+        for aruba, result, error in self.aruba.map(sync_controller):
+            self.sync_status[aruba.name] = {
+                'ok': error is None,
+                'error': None if error is None else str(error),
+                'time': time(),
+            }
+
+            if error is not None:
+                log.msg('Synchronization of {0} failed: {1}' \
+                            .format(aruba.name, error))
+                errors.append(error)
+
+        if errors:
+            raise errors[0]
+
+        log.msg('Synchronization finished.')
+
+    def sync_controller(self, aruba, desired_profiles, force=[]):
+        """Apply desired SSID to PSK mapping to a single controller."""
+
         # Log into the controller.
-        self.aruba.login()
+        aruba.login()
 
         # Fetch current profiles from controller.
-        current_profiles = self.aruba.list_profiles()
+        current_profiles = aruba.list_profiles()
 
         # Collect foreign SSIDs to prevent creating duplicates.
         foreign_ssids = set()
@@ -58,9 +159,9 @@ class Manager(object):
                 del current_profiles[name]
 
         def edit_profile(profile, ssid, psk, active):
-            log.msg('Edit {profile}: ssid={ssid}, psk={psk}, active={active}' \
-                        .format(**locals()))
-            return self.aruba.edit_profile(profile, ssid, psk, active)
+            log.msg('Edit {host} {profile}: ssid={ssid}, psk={psk}, '
+                    'active={active}'.format(host=aruba.name, **locals()))
+            return aruba.edit_profile(profile, ssid, psk, active)
 
         # Adjust existing profiles on the controller.
         for name, info in list(current_profiles.items()):
@@ -83,7 +184,7 @@ class Manager(object):
         for ssid, psk in list(desired_profiles.items()):
             # Do not assign conflicting SSIDs.
             if ssid in foreign_ssids:
-                log.msg('Conflicting SSID: {0}'.format(ssid))
+                log.msg('Conflicting SSID on {0}: {1}'.format(aruba.name, ssid))
                 continue
 
             # Allocate one of the current profiles.
@@ -93,7 +194,115 @@ class Manager(object):
             # Modify it to reflect the desired configuration.
             edit_profile(name, ssid, psk, True)
 
-        log.msg('Synchronization finished.')
+    def refresh_stations(self):
+        """Download the station table from the controller right now."""
+
+        snapshot = StationSnapshot(self.aruba.list_stations())
+        self.station_snapshot = snapshot
+        return snapshot
+
+    def get_stations(self, max_age=None):
+        """
+        Return a recent station snapshot.
+
+        The controller is only contacted when the current snapshot is
+        older than `max_age` seconds.  Concurrent callers wait for the
+        single refresh instead of querying the controller on their own.
+        When the controller is unavailable, the last snapshot is served
+        regardless of its age.
+        """
+
+        if max_age is None:
+            max_age = self.station_max_age
+
+        snapshot = self.station_snapshot
+        if snapshot is not None and snapshot.time + max_age > time():
+            return snapshot
+
+        with self.station_lock:
+            snapshot = self.station_snapshot
+            if snapshot is not None and snapshot.time + max_age > time():
+                return snapshot
+
+            try:
+                return self.refresh_stations()
+
+            except ArubaUnavailable as e:
+                if snapshot is None:
+                    raise
+
+                log.msg('Serving stale stations: {0}'.format(e))
+                return snapshot
+
+    def load_locations(self):
+        """Read the access point to zone mapping from the database."""
+
+        rows = self.read_db.bind.execute('SELECT ap, location FROM location')
+        self.locations = {ap: location or 'Unknown' for ap, location in rows}
+        return self.locations
+
+    def get_locations(self):
+        """Return the access point to zone mapping, loading it if needed."""
+
+        if self.locations is None:
+            return self.load_locations()
+
+        return self.locations
+
+    def sample(self):
+        """
+        Take a new station snapshot and refresh the zone mapping.
+
+        Please run in a thread, it waits for both the controller and
+        the database.
+        """
+
+        with self.station_lock:
+            snapshot = self.refresh_stations()
+
+        locations = self.load_locations()
+
+        # Fold it into the history here, away from the reactor.
+        if self.history is not None:
+            self.history.add(snapshot, locations)
+
+        if self.shared is not None:
+            self.shared.write((snapshot, locations))
+
+        return snapshot, locations
+
+    def publish(self, result):
+        """Pass a new sample to all the listeners."""
+
+        snapshot, locations = result
+
+        for listener in list(self.listeners):
+            try:
+                listener(snapshot, locations)
+            except Exception:
+                log.err(None, 'Sample listener failed')
+
+    def schedule_sample(self):
+        """
+        Schedule sampling of the station table.
+
+        Listeners are notified from the reactor thread once the sample
+        has been taken.  Errors are only logged, so that the periodic
+        sampling continues.
+        """
+
+        d = deferToThread(call_with_priority, BACKGROUND, self.sample)
+        d.addCallback(self.publish)
+        d.addErrback(log.err, 'Station sampling failed')
+        return d
+
+    def get_history(self):
+        return self.history
+
+    def schedule_history_save(self):
+        d = deferToThread(self.history.save)
+        d.addErrback(log.err, 'Saving zone history failed')
+        return d
 
     def schedule_sync(self, force=[]):
         """
@@ -102,8 +311,102 @@ class Manager(object):
         Use freely (but not too often, it calls the controller after all),
         after you modify database profiles to speed up the synchronization.
         """
-        deferToThread(self.sync, force)
+        deferToThread(call_with_priority, WRITE, self.sync, force)
+
+
+class WorkerManager(Manager):
+    """
+    Manager of a worker process.
+
+    Only the owner process runs the synchronization and the station
+    sampling.  Workers read its samples from the `shared` file instead
+    and forward synchronization requests using the `request_sync`
+    callable.  The controller is only contacted directly when the owner
+    fails to publish a fresh enough sample.
+    """
+
+    def __init__(self, db, aruba, profile_prefix, station_max_age=30,
+                 sample_interval=10, shared=None, history=None,
+                 read_db=None, request_sync=None):
+        Manager.__init__(self, db, aruba, profile_prefix, station_max_age,
+                         sample_interval, shared, history, read_db)
 
+        self.request_sync = request_sync
+        self.owner = os.getppid()
+        self.logged_in = False
+
+    def start(self):
+        """Starts watching for new samples."""
+        task.LoopingCall(self.poll).start(1.0)
+
+    def warm_up(self, warmup, budget=10.0):
+        """Adopt the owner's sample, or take our own if there is none."""
+
+        def sample():
+            if self.update() is None:
+                self.load_locations()
+                self.refresh_stations()
+
+        with self.warm_up_limits(budget):
+            warmup.run('sample', sample)
+
+    def poll(self):
+        """Pass newly published sample to the listeners."""
+
+        # Do not outlive the owner process.
+        if os.getppid() != self.owner:
+            log.msg('Owner process is gone, exiting.')
+            reactor.stop()
+            return
+
+        if self.shared.changed():
+            sample = self.update()
+
+            if sample is not None:
+                self.publish(sample)
+
+    def update(self):
+        """Adopt the latest published sample, if it is newer."""
+
+        sample = self.shared.read()
+
+        if sample is None:
+            return None
+
+        snapshot, locations = sample
+        current = self.station_snapshot
+
+        if current is None or current.time < snapshot.time:
+            self.station_snapshot = snapshot
+
+        self.locations = locations
+        return sample
+
+    def refresh_stations(self):
+        # We do not run the synchronization that logs the owner in.
+        if not self.logged_in:
+            self.aruba.login()
+            self.logged_in = True
+
+        return Manager.refresh_stations(self)
+
+    def get_stations(self, max_age=None):
+        self.update()
+        return Manager.get_stations(self, max_age)
+
+    def get_locations(self):
+        self.update()
+        return Manager.get_locations(self)
+
+    def get_history(self):
+        if self.history is not None:
+            self.history.load()
+
+        return self.history
+
+    def schedule_sync(self, force=[]):
+        """Ask the owner process to synchronize the controller."""
+        self.request_sync(force)
 
 
 # vim:set sw=4 ts=4 et:
@@ -0,0 +1,154 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['ProfileError', 'parse_profile', 'parse_profiles',
+           'read_profiles', 'insert_profiles']
+
+from csv import DictReader
+from datetime import datetime, timedelta
+
+import json
+
+from wifinator.audit import AuditLog, audit_record
+
+
+class ProfileError(Exception):
+    """Profile data rejected by the validation rules."""
+
+
+def parse_profile(ssid, psk, start, stop):
+    """
+    Validate profile fields as entered by the user.
+
+    Dates are expected in the `YYYY-MM-DD` format, the last day is
+    inclusive.  Returns a dictionary suitable for the profile table or
+    raises `ProfileError` with a human readable message.
+    """
+
+    if len(ssid) > 30:
+        raise ProfileError('Network name too long.')
+
+    if len(psk) > 30:
+        raise ProfileError('Password too long.')
+
+    if len(ssid) == 0:
+        raise ProfileError('Network name missing.')
+
+    if len(psk) < 8:
+        raise ProfileError('Password too short, please supply at least 8 characters.')
+
+    try:
+        start = datetime.strptime(start, '%Y-%m-%d')
+        stop  = datetime.strptime(stop,  '%Y-%m-%d') \
+                    + timedelta(+1, -1)
+    except (TypeError, ValueError):
+        raise ProfileError('Invalid date format.')
+
+    if start > stop:
+        raise ProfileError('Last day must not come before the first day.')
+
+    return {
+        'ssid': ssid,
+        'psk': psk,
+        'start': start,
+        'stop': stop,
+    }
+
+
+def read_profiles(data, format=None):
+    """
+    Read raw profile rows from a CSV or JSON document.
+
+    CSV needs a header with the `ssid`, `psk`, `start` and `stop` columns,
+    JSON a list of objects with the same keys.  When no `format` is given,
+    it is guessed from the first character of the document.
+    """
+
+    if format is None:
+        format = 'json' if data.lstrip()[:1] in ('[', '{') else 'csv'
+
+    if format == 'json':
+        try:
+            rows = json.loads(data)
+        except ValueError:
+            raise ProfileError('Invalid JSON document.')
+
+        if isinstance(rows, dict):
+            rows = rows.get('profiles')
+
+        if not isinstance(rows, list) \
+                or not all(isinstance(row, dict) for row in rows):
+            raise ProfileError('Expected a list of profiles.')
+
+        return rows
+
+    if format == 'csv':
+        reader = DictReader(data.splitlines())
+
+        if reader.fieldnames is None \
+                or not {'ssid', 'psk'} <= set(reader.fieldnames):
+            raise ProfileError('CSV header must contain ssid and psk columns.')
+
+        return list(reader)
+
+    raise ProfileError('Unknown format: {0}'.format(format))
+
+
+def parse_profiles(rows):
+    """
+    Validate all raw rows at once using the `parse_profile` rules.
+
+    Missing dates default to today, just like in the web form.  Every row
+    is checked before anything is reported, so that the user can see all
+    the problems of a batch together.
+    """
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    profiles = []
+    errors = []
+
+    for num, row in enumerate(rows, 1):
+        try:
+            profiles.append(parse_profile(str(row.get('ssid') or ''),
+                                          str(row.get('psk') or ''),
+                                          row.get('start') or today,
+                                          row.get('stop') or today))
+        except ProfileError as e:
+            errors.append('Row {0}: {1}'.format(num, e.args[0]))
+
+    if errors:
+        raise ProfileError(' '.join(errors))
+
+    if not profiles:
+        raise ProfileError('No profiles to import.')
+
+    return profiles
+
+
+def insert_profiles(db, profiles, username, audit=None):
+    """
+    Insert validated profiles and record them in the audit log.
+
+    Profiles are inserted using a single multi-row statement, within the
+    current transaction.  Committing is left to the caller, through the
+    `audit` log when given.  Returns identifiers of the new profiles.
+    """
+
+    if audit is None:
+        audit = AuditLog(db)
+
+    profile = db.profile._table
+
+    ids = [row[0] for row in db.session.execute(
+        profile.insert().values(profiles).returning(profile.c.id),
+        bind=db.bind)]
+
+    now = datetime.now()
+
+    audit.add([audit_record(username, pid, None, p, now)
+               for pid, p in zip(ids, profiles)])
+
+    return ids
+
+
+# vim:set sw=4 ts=4 et:
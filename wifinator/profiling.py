@@ -0,0 +1,119 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['timed', 'add_time', 'start_timing', 'stop_timing', 'Profiler']
+
+from contextlib import contextmanager
+from threading import local, Lock
+from time import perf_counter
+
+import cProfile
+import marshal
+import pstats
+
+
+# Phase timings of the request handled by the current thread.
+state = local()
+
+
+@contextmanager
+def timed(phase):
+    """
+    Account the enclosed block to a phase of the current request.
+
+    Does nothing unless timing has been started in the current thread,
+    so it can be used freely in code shared with background tasks.
+    """
+
+    timer = getattr(state, 'timer', None)
+
+    if timer is None:
+        yield
+        return
+
+    start = perf_counter()
+
+    try:
+        yield
+    finally:
+        timer[phase] = timer.get(phase, 0.0) + perf_counter() - start
+
+
+def start_timing():
+    state.timer = {}
+
+
+def stop_timing():
+    timer = getattr(state, 'timer', None)
+    state.timer = None
+    return timer
+
+
+def add_time(phase, duration):
+    timer = getattr(state, 'timer', None)
+
+    if timer is not None:
+        timer[phase] = timer.get(phase, 0.0) + duration
+
+
+class Profiler(object):
+    """
+    Captures profile of the next few requests.
+
+    Only one request is profiled at a time, since the interpreter does
+    not support multiple active profilers.  Statistics of all captured
+    requests are merged and can be downloaded in the `pstats` format.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.remaining = 0
+        self.captured = 0
+        self.active = False
+        self.stats = None
+
+    def arm(self, count):
+        with self.lock:
+            self.remaining = count
+            self.captured = 0
+            self.stats = None
+
+    def begin(self):
+        # Cheap check for the usual case with profiling turned off.
+        if not self.remaining:
+            return None
+
+        with self.lock:
+            if self.remaining <= 0 or self.active:
+                return None
+
+            self.remaining -= 1
+            self.active = True
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def end(self, profile):
+        profile.disable()
+
+        with self.lock:
+            self.active = False
+            self.captured += 1
+
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def dump(self):
+        """Return the merged statistics as a `pstats` file contents."""
+
+        with self.lock:
+            if self.stats is None:
+                return None
+
+            return marshal.dumps(self.stats.stats)
+
+
+# vim:set sw=4 ts=4 et:
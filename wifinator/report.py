@@ -0,0 +1,199 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['Report']
+
+from time import localtime, strftime
+
+import numpy as np
+
+
+# Titles of the group column.
+DIMENSIONS = {
+    'zone': 'Zone',
+    'essid': 'ESSID',
+    'org': 'Organization',
+}
+
+# How to label snapshots of the given bucket.
+BUCKETS = {
+    'hour': '%Y-%m-%d %H:00',
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+}
+
+
+class Categories(object):
+    """Global categorical codes shared by all the snapshots."""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def map(self, values):
+        """Translate a snapshot dictionary to an array of global codes."""
+
+        result = np.empty(len(values), dtype=np.int64)
+
+        for i, value in enumerate(values):
+            code = self.codes.get(value)
+
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+
+            result[i] = code
+
+        return result
+
+
+class Report(object):
+    """
+    Occupancy statistics over many archived station snapshots.
+
+    Snapshots are reduced to per-group device and distinct user counts
+    as they are added, using the dictionary-encoded columns directly.
+    Only per-bucket sets of (group, user) pairs are kept around in order
+    to count distinct users over the whole bucket.
+
+    Groups are zones (using the `locations` AP mapping), ESSIDs or
+    organizations (using the `classify(name, essid)` callable).
+    """
+
+    def __init__(self, dimension, bucket='day', percentiles=(50, 95),
+                 locations=None, classify=None):
+        self.dimension = dimension
+        self.bucket = BUCKETS[bucket]
+        self.percentiles = list(percentiles)
+        self.locations = locations or {}
+        self.classify = classify
+
+        self.groups = Categories()
+        self.users = Categories()
+
+        # Per snapshot bucket label and sparse group counts.
+        self.labels = []
+        self.samples = []
+
+        # Unique (group, user) pairs seen in every bucket.
+        self.pairs = {}
+
+    def codes(self, snapshot, column):
+        return np.frombuffer(snapshot.codes[column],
+                             dtype='u{0}'.format(snapshot.codes[column].itemsize)) \
+                 .astype(np.int64)
+
+    def group_codes(self, snapshot):
+        dicts = snapshot.dicts
+
+        if self.dimension == 'essid':
+            return self.groups.map(dicts['essid'])[self.codes(snapshot, 'essid')]
+
+        if self.dimension == 'zone':
+            zones = [self.locations.get(ap, 'Unknown') for ap in dicts['ap']]
+            return self.groups.map(zones)[self.codes(snapshot, 'ap')]
+
+        # Organizations depend on both the name and the ESSID, but there
+        # are much fewer distinct pairs than stations.
+        width = max(1, len(dicts['essid']))
+        pairs = self.codes(snapshot, 'name') * width \
+                    + self.codes(snapshot, 'essid')
+
+        unique, inverse = np.unique(pairs, return_inverse=True)
+        orgs = [self.classify(dicts['name'][p // width],
+                              dicts['essid'][p % width]) for p in unique]
+
+        return self.groups.map(orgs)[inverse]
+
+    def add(self, snapshot):
+        """Fold another snapshot into the report."""
+
+        label = strftime(self.bucket, localtime(snapshot.time))
+        self.labels.append(label)
+
+        if len(snapshot) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            self.samples.append((empty, empty, empty))
+            return
+
+        groups = self.group_codes(snapshot)
+        users = self.users.map(snapshot.dicts['name'])[self.codes(snapshot, 'name')]
+
+        devices = np.bincount(groups)
+        pairs = np.unique((groups << 32) | users)
+        distinct = np.bincount(pairs >> 32, minlength=len(devices))
+
+        present = np.flatnonzero(devices)
+        self.samples.append((present, devices[present], distinct[present]))
+
+        bucket = self.pairs.setdefault(label, [])
+        bucket.append(pairs)
+
+        # Keep the accumulated pairs compact.
+        if len(bucket) >= 64:
+            self.pairs[label] = [np.unique(np.concatenate(bucket))]
+
+    def rows(self):
+        """
+        Compute the aggregates and yield them as report rows.
+
+        Every row describes one group in one bucket: number of samples,
+        peak and mean of the concurrent users, the requested percentiles
+        of the same, distinct users over the whole bucket and peak number
+        of devices.
+        """
+
+        if not self.samples:
+            return
+
+        groups = len(self.groups)
+        users = np.zeros((len(self.samples), groups))
+        devices = np.zeros((len(self.samples), groups))
+
+        for i, (present, dev, dist) in enumerate(self.samples):
+            users[i, present] = dist
+            devices[i, present] = dev
+
+        labels = sorted(set(self.labels))
+        index = {label: i for i, label in enumerate(labels)}
+        inverse = np.array([index[label] for label in self.labels])
+
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(labels) + 1))
+
+        users = users[order]
+        devices = devices[order]
+
+        peak = np.maximum.reduceat(users, bounds[:-1], axis=0)
+        total = np.add.reduceat(users, bounds[:-1], axis=0)
+        peak_devices = np.maximum.reduceat(devices, bounds[:-1], axis=0)
+        counts = np.diff(bounds)
+
+        for b, label in enumerate(labels):
+            rows = users[bounds[b]:bounds[b + 1]]
+
+            if self.percentiles:
+                pct = np.percentile(rows, self.percentiles, axis=0)
+            else:
+                pct = np.zeros((0, groups))
+
+            pairs = self.pairs.get(label) or [np.zeros(0, dtype=np.int64)]
+            pairs = np.unique(np.concatenate(pairs))
+            distinct = np.bincount(pairs >> 32, minlength=groups)
+
+            for g in np.flatnonzero(peak_devices[b]):
+                yield (label, self.groups.values[g], int(counts[b]),
+                       int(peak[b, g]), round(float(total[b, g] / counts[b]), 2)) \
+                      + tuple(round(float(p), 2) for p in pct[:, g]) \
+                      + (int(distinct[g]), int(peak_devices[b, g]))
+
+    def headers(self):
+        return ('Bucket', DIMENSIONS[self.dimension], 'Samples', 'Max', 'Mean') \
+             + tuple('P{0:g}'.format(p) for p in self.percentiles) \
+             + ('Distinct', 'Devices')
+
+
+# vim:set sw=4 ts=4 et:
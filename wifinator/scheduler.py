@@ -0,0 +1,256 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['INTERACTIVE', 'WRITE', 'BACKGROUND', 'CLASSES', 'CONCURRENCY',
+           'Scheduler', 'priority', 'current_priority', 'call_with_priority']
+
+from collections import deque
+from contextlib import contextmanager
+from heapq import heappush, heappop, heapify
+from itertools import count
+from threading import Condition, local
+from time import monotonic
+
+
+# Priority classes of controller commands, most urgent first.
+INTERACTIVE = 0
+WRITE = 1
+BACKGROUND = 2
+
+CLASSES = {
+    INTERACTIVE: 'interactive',
+    WRITE: 'write',
+    BACKGROUND: 'background',
+}
+
+
+# Commands sent to a single controller at once, unless configured.
+CONCURRENCY = 4
+
+
+# Priority class of the commands issued by the current thread.
+state = local()
+
+
+@contextmanager
+def priority(cls):
+    """
+    Issue commands from the enclosed block with the given priority.
+
+    Commands issued outside of any such block are considered to be
+    interactive, since they mostly come from the website.
+    """
+
+    previous = getattr(state, 'priority', INTERACTIVE)
+    state.priority = cls
+
+    try:
+        yield
+    finally:
+        state.priority = previous
+
+
+def current_priority():
+    return getattr(state, 'priority', INTERACTIVE)
+
+
+def call_with_priority(cls, fn, *args, **kwargs):
+    """Call the function with commands issued using the given priority."""
+
+    with priority(cls):
+        return fn(*args, **kwargs)
+
+
+class Timings(object):
+    """Wait and service times of one priority class."""
+
+    # Number of the most recent commands to compute percentiles from.
+    WINDOW = 1024
+
+    def __init__(self):
+        self.total = 0
+        self.failed = 0
+        self.waits = deque(maxlen=self.WINDOW)
+        self.services = deque(maxlen=self.WINDOW)
+
+    def summary(self):
+        def pct(values, p):
+            if not values:
+                return 0.0
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+        return {
+            'total': self.total,
+            'failed': self.failed,
+            'wait': {
+                'p50': pct(self.waits, 50),
+                'p95': pct(self.waits, 95),
+                'max': max(self.waits, default=0.0),
+            },
+            'service': {
+                'p50': pct(self.services, 50),
+                'p95': pct(self.services, 95),
+                'max': max(self.services, default=0.0),
+            },
+        }
+
+
+class Scheduler(object):
+    """
+    Admission control for the controller commands.
+
+    At most `concurrency` commands are in progress at any time and new
+    ones are started at most `rate` times per second, with bursts of up
+    to `burst` commands.  Waiting commands are admitted strictly by their
+    priority class and then in the order of arrival, so that a queue of
+    background commands cannot delay the interactive ones.  Limits left
+    at `None` are not enforced.
+    """
+
+    def __init__(self, concurrency=None, rate=None, burst=None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or max(1.0, rate or 0.0)
+
+        self.cond = Condition()
+        self.queue = []
+        self.counter = count()
+        self.running = 0
+
+        self.tokens = self.burst
+        self.refilled = monotonic()
+
+        self.timings = {cls: Timings() for cls in CLASSES}
+
+    def take_token(self):
+        """
+        Take a token from the bucket.
+
+        Returns zero on success, otherwise number of seconds to wait
+        before there will be a token available.
+        """
+
+        if self.rate is None:
+            return 0.0
+
+        now = monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+
+        return (1.0 - self.tokens) / self.rate
+
+    def acquire(self, cls):
+        ticket = (cls, next(self.counter))
+
+        with self.cond:
+            heappush(self.queue, ticket)
+
+            try:
+                while True:
+                    if self.queue[0] != ticket or (self.concurrency is not None
+                            and self.running >= self.concurrency):
+                        self.cond.wait()
+                        continue
+
+                    delay = self.take_token()
+
+                    if not delay:
+                        break
+
+                    self.cond.wait(delay)
+
+            except BaseException:
+                self.queue.remove(ticket)
+                heapify(self.queue)
+                self.cond.notify_all()
+                raise
+
+            heappop(self.queue)
+            self.running += 1
+
+            # Let the next one in line check the limits.
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, cls=None):
+        """
+        Wait for permission to issue a command and hold it.
+
+        Uses priority of the current thread unless `cls` is given.
+        """
+
+        if cls is None:
+            cls = current_priority()
+
+        timings = self.timings[cls]
+        start = monotonic()
+
+        self.acquire(cls)
+        admitted = monotonic()
+        failed = True
+
+        try:
+            yield
+            failed = False
+
+        finally:
+            self.release()
+
+            with self.cond:
+                timings.total += 1
+                timings.failed += failed
+                timings.waits.append(admitted - start)
+                timings.services.append(monotonic() - admitted)
+
+    @contextmanager
+    def released(self, cls=None):
+        """
+        Give up the held slot for a while, such as to back off a retry.
+
+        Must be used within `slot()`.  Waits to be admitted again, with
+        the priority of the current thread unless `cls` is given.
+        """
+
+        if cls is None:
+            cls = current_priority()
+
+        self.release()
+
+        try:
+            yield
+        finally:
+            self.acquire(cls)
+
+    def metrics(self):
+        """Current load and timings of the individual classes in seconds."""
+
+        with self.cond:
+            waiting = {name: 0 for name in CLASSES.values()}
+
+            for cls, seq in self.queue:
+                waiting[CLASSES[cls]] += 1
+
+            return {
+                'concurrency': self.concurrency,
+                'rate': self.rate,
+                'running': self.running,
+                'classes': {
+                    name: dict(self.timings[cls].summary(),
+                               waiting=waiting[name])
+                    for cls, name in CLASSES.items()
+                },
+            }
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,70 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['SharedFile']
+
+from tempfile import NamedTemporaryFile
+
+import os
+import pickle
+
+
+class SharedFile(object):
+    """
+    Python object shared between processes through a file.
+
+    The owner process pickles every new version to a temporary file and
+    atomically renames it over the previous one, so that readers never
+    see a partial write.  Readers only check the file identity on every
+    access and unpickle it when it changes.  Place the file on a memory
+    backed file system such as `/dev/shm` to avoid touching the disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.value = None
+
+    def write(self, value):
+        directory = os.path.dirname(os.path.abspath(self.path))
+
+        with NamedTemporaryFile('wb', dir=directory, delete=False,
+                                prefix='.shared-') as fp:
+            pickle.dump(value, fp, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(fp.name, self.path)
+
+    def read(self):
+        """
+        Return the latest published value.
+
+        Returns `None` until the owner publishes the first one.
+        """
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        if stamp != self.stamp:
+            with open(self.path, 'rb') as fp:
+                self.value = pickle.load(fp)
+
+            self.stamp = stamp
+
+        return self.value
+
+    def changed(self):
+        """Check whether a newer value has been published."""
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+
+        return (st.st_ino, st.st_mtime_ns, st.st_size) != self.stamp
+
+
+# vim:set sw=4 ts=4 et:
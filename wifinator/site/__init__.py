@@ -7,21 +7,28 @@ from sqlalchemy import *
 from sqlalchemy.exc import *
 from werkzeug.exceptions import *
 from wifinator.site.util import *
+from wifinator.audit import *
+from wifinator.profile import *
+from wifinator.profiling import *
 from functools import wraps
+from twisted.python import log
 
 from flask_qrcode import QRcode
 from flask_weasyprint import HTML, render_pdf
 
-from sqlalchemy import desc
+from sqlalchemy import desc, event
 from sqlalchemy.exc import SQLAlchemyError
 from datetime import date, datetime, timedelta
+from time import perf_counter
 from xml.sax.saxutils import escape
 
 import flask
+import json
 import os
 import re
 
-def make_site(db, manager, access_model, debug=False):
+def make_site(db, manager, access_model, debug=False, slow_request=None,
+              audit=None, warmup=None):
     app = flask.Flask('.'.join(__name__.split('.')[:-1]))
     app.secret_key = os.urandom(16)
     app.debug = debug
@@ -29,6 +36,74 @@ def make_site(db, manager, access_model, debug=False):
     # Init QRCode plugin
     QRcode(app)
 
+    # Captures profiles of requests on demand.
+    profiler = Profiler()
+
+    # Every route explicitly picks one of the databases.  Reads go to the
+    # read-only one, create, edit and delete to the serializable one.
+    read_db = manager.read_db
+    write_db = manager.db
+
+    # Changes are committed through the audit log.
+    if audit is None:
+        audit = AuditLog(write_db)
+
+    if slow_request is not None:
+        # Account time spent in the database to the current request.
+        # The start is kept on the statement context, so that nothing is
+        # left behind on the pooled connection when a statement fails.
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            context.query_start = perf_counter()
+
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            add_time('db', perf_counter() - context.query_start)
+
+        for engine in {read_db.bind, write_db.bind}:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.before_request
+    def start_request():
+        if slow_request is not None:
+            flask.g.request_start = perf_counter()
+            start_timing()
+
+        flask.g.profile = profiler.begin()
+
+    @app.after_request
+    def finish_request(response):
+        if slow_request is None:
+            return response
+
+        timer = stop_timing() or {}
+        total = perf_counter() - flask.g.request_start
+        timer['other'] = max(0.0, total - sum(timer.values()))
+
+        response.headers['Server-Timing'] = ', '.join(
+            '{0};dur={1:.1f}'.format(phase, duration * 1000)
+            for phase, duration in sorted(timer.items()))
+
+        if total >= slow_request:
+            log.msg('Slow request: {0} {1} took {2:.3f}s ({3})'.format(
+                flask.request.method, flask.request.full_path.rstrip('?'), total,
+                ', '.join('{0} {1:.3f}s'.format(phase, duration)
+                          for phase, duration in sorted(timer.items()))))
+
+        return response
+
+    @app.teardown_request
+    def finish_profile(exception=None):
+        profile = flask.g.pop('profile', None)
+
+        if profile is not None:
+            profiler.end(profile)
+
+    def render_template(*args, **kwargs):
+        with timed('template'):
+            return flask.render_template(*args, **kwargs)
+
     @app.template_filter('to_alert')
     def category_to_alert(category):
         return {
@@ -126,7 +201,7 @@ def make_site(db, manager, access_model, debug=False):
 
     @app.errorhandler(Forbidden.code)
     def unauthorized(e):
-        return flask.render_template('forbidden.html')
+        return render_template('forbidden.html')
 
 
     @app.route('/')
@@ -134,48 +209,37 @@ def make_site(db, manager, access_model, debug=False):
     def index():
         nonlocal has_privilege
 
-        profiles = manager.db.profile \
-                    .filter(manager.db.profile.stop > datetime.now()) \
-                    .order_by(manager.db.profile.start).all()
+        profiles = read_db.profile \
+                    .filter(read_db.profile.stop > datetime.now()) \
+                    .order_by(read_db.profile.start).all()
 
-        audit = manager.db.audit \
-                    .order_by(desc(manager.db.audit.time)) \
+        audit = read_db.audit \
+                    .order_by(desc(read_db.audit.time)) \
                     .limit(50).all()
 
         changes = interpret_audit(audit)
 
         today = date.today().strftime('%Y-%m-%d')
 
-        return flask.render_template('main.html', **locals())
+        return render_template('main.html', **locals())
 
     @app.route('/delete/<int:pid>')
     @authorized_only(privilege='admin')
     @pass_user_info
     def delete(pid, uid, username):
-        old = manager.db.profile.get(pid)
+        old = write_db.profile.get(pid)
         if old is None:
             flask.flash('Network disappeared in the meantime.', 'warning')
             return flask.redirect('/')
 
-        manager.db.audit.insert(**{
-            'user': username,
-            'profile': pid,
-            'old_data': {
-                'ssid': old.ssid,
-                'psk': old.psk,
-                'start': old.start.strftime('%Y-%m-%d %H:%M:%S'),
-                'stop': old.stop.strftime('%Y-%m-%d %H:%M:%S'),
-            },
-            'new_data': None,
-            'time': datetime.now(),
-        })
+        audit.record(username, pid, old, None)
 
-        manager.db.profile.filter(manager.db.profile.id == pid).delete()
+        write_db.profile.filter(write_db.profile.id == pid).delete()
 
         try:
-            manager.db.commit()
-        except SQLAlchemyError as e:
-            manager.db.rollback()
+            audit.commit()
+        except (SQLAlchemyError, AuditError) as e:
+            audit.rollback()
             flask.flash(e.args[0], 'error')
             return flask.redirect('/')
 
@@ -186,168 +250,218 @@ def make_site(db, manager, access_model, debug=False):
     @app.route('/edit/<int:pid>')
     @authorized_only(privilege='admin')
     def edit(pid):
-        profile = manager.db.profile.get(pid)
+        profile = read_db.profile.get(pid)
         if profile is None:
             flask.flash('Network disappeared in the meantime.', 'warning')
             return flask.redirect('/')
 
-        return flask.render_template('edit.html', **locals())
+        return render_template('edit.html', **locals())
 
     @app.route('/printable/<int:pid>')
     @authorized_only(privilege='admin')
     def printable(pid):
-        profile = manager.db.profile.get(pid)
+        profile = read_db.profile.get(pid)
         qr_string = f"WIFI:S:{profile.ssid};T:WPA;P:{profile.psk};;"
 
         if profile is None:
             flask.flash('Network disappeared in the meantime.', 'warning')
             return flask.redirect('/')
 
-        html = flask.render_template('printable.html', **locals())
-        return render_pdf(HTML(string=html))
+        html = render_template('printable.html', **locals())
+
+        with timed('pdf'):
+            return render_pdf(HTML(string=html))
 
 
     @app.route('/edit/<int:pid>/confirm', methods=['POST'])
     @authorized_only(privilege='admin')
     @pass_user_info
     def edit_confirm(pid, uid, username):
-        old = manager.db.profile.get(pid)
+        old = write_db.profile.get(pid)
         if old is None:
             flask.flash('Network disappeared in the meantime.', 'warning')
             return flask.redirect('/')
 
-        new_ssid  = flask.request.form.get('ssid',  old.ssid)
-        new_psk   = flask.request.form.get('psk',   old.psk)
-        new_start = flask.request.form.get('start', old.start.strftime('%Y-%m-%d'))
-        new_stop  = flask.request.form.get('stop',  old.stop.strftime('%Y-%m-%d'))
-
-        if len(new_ssid) > 30:
-            flask.flash('Network name too long.', 'errot')
-            return flask.redirect('/edit/%i' % pid)
-
-        if len(new_psk) > 30:
-            flask.flash('Password too long.', 'error')
-            return flask.redirect('/edit/%i' % pid)
-
-        if len(new_ssid) == 0:
-            flask.flash('Network name missing.', 'error')
-            return flask.redirect('/edit/%i' % pid)
-
-        if len(new_psk) < 8:
-            flask.flash('Password too short, please supply at least 8 characters.', 'error')
-            return flask.redirect('/edit/%i' % pid)
-
         try:
-            new_start = datetime.strptime(new_start, '%Y-%m-%d')
-            new_stop  = datetime.strptime(new_stop,  '%Y-%m-%d') \
-                        + timedelta(+1, -1)
-        except ValueError:
-            flask.flash('Invalid date format.', 'error')
-            return flask.redirect('/edit/%i' % pid)
-
-        if new_start > new_stop:
-            flask.flash('Last day must not come before the first day.', 'error')
+            new = parse_profile(
+                flask.request.form.get('ssid',  old.ssid),
+                flask.request.form.get('psk',   old.psk),
+                flask.request.form.get('start', old.start.strftime('%Y-%m-%d')),
+                flask.request.form.get('stop',  old.stop.strftime('%Y-%m-%d')))
+        except ProfileError as e:
+            flask.flash(e.args[0], 'error')
             return flask.redirect('/edit/%i' % pid)
 
-        manager.db.audit.insert(**{
-            'user': username,
-            'profile': pid,
-            'old_data': {
-                'ssid': old.ssid,
-                'psk': old.psk,
-                'start': old.start.strftime('%Y-%m-%d %H:%M:%S'),
-                'stop': old.stop.strftime('%Y-%m-%d %H:%M:%S'),
-            },
-            'new_data': {
-                'ssid': new_ssid,
-                'psk': new_psk,
-                'start': new_start.strftime('%Y-%m-%d %H:%M:%S'),
-                'stop': new_stop.strftime('%Y-%m-%d %H:%M:%S'),
-             },
-            'time': datetime.now(),
-        })
+        audit.record(username, pid, old, new)
 
-        old.ssid  = new_ssid
-        old.psk   = new_psk
-        old.start = new_start
-        old.stop  = new_stop
+        old.ssid  = new['ssid']
+        old.psk   = new['psk']
+        old.start = new['start']
+        old.stop  = new['stop']
 
         try:
-            manager.db.commit()
-        except SQLAlchemyError as e:
-            manager.db.rollback()
+            audit.commit()
+        except (SQLAlchemyError, AuditError) as e:
+            audit.rollback()
             flask.flash(e.args[0], 'error')
             return flask.redirect('/')
 
-        manager.schedule_sync([new_ssid])
+        manager.schedule_sync([new['ssid']])
         return flask.redirect('/')
 
     @app.route('/create', methods=['POST'])
     @authorized_only(privilege='admin')
     @pass_user_info
     def create(uid, username):
-        ssid  = flask.request.form.get('ssid',  '')
-        psk   = flask.request.form.get('psk',   '')
-        start = flask.request.form.get('start', datetime.now().strftime('%Y-%m-%d'))
-        stop  = flask.request.form.get('stop',  datetime.now().strftime('%Y-%m-%d'))
-
-        if len(ssid) > 30:
-            flask.flash('Network name too long.', 'error')
+        try:
+            profile = parse_profile(
+                flask.request.form.get('ssid',  ''),
+                flask.request.form.get('psk',   ''),
+                flask.request.form.get('start', datetime.now().strftime('%Y-%m-%d')),
+                flask.request.form.get('stop',  datetime.now().strftime('%Y-%m-%d')))
+        except ProfileError as e:
+            flask.flash(e.args[0], 'error')
             return flask.redirect('/')
 
-        if len(psk) > 30:
-            flask.flash('Password too long.', 'error')
+        try:
+            new = write_db.profile.insert(**profile)
+
+            # Obtain identifier of the new profile for the audit log.
+            write_db.flush()
+
+            audit.record(username, new.id, None, profile)
+            audit.commit()
+        except (SQLAlchemyError, AuditError) as e:
+            audit.rollback()
+            flask.flash(e.args[0], 'error')
             return flask.redirect('/')
 
-        if len(ssid) == 0:
-            flask.flash('Network name missing.', 'error')
+        manager.schedule_sync()
+        return flask.redirect('/')
+
+    @app.route('/import', methods=['POST'])
+    @authorized_only(privilege='admin')
+    @pass_user_info
+    def bulk_import(uid, username):
+        upload = flask.request.files.get('file')
+
+        if upload is not None:
+            data = upload.read()
+        else:
+            data = flask.request.get_data()
+
+        format = flask.request.form.get('format') \
+                 or flask.request.args.get('format')
+
+        if format is None and upload is not None:
+            format = {'.csv': 'csv', '.json': 'json'} \
+                        .get(os.path.splitext(upload.filename or '')[1].lower())
+
+        try:
+            rows = read_profiles(data.decode('utf8'), format)
+            profiles = parse_profiles(rows)
+        except UnicodeDecodeError:
+            flask.flash('Import must be encoded in UTF-8.', 'error')
+            return flask.redirect('/')
+        except ProfileError as e:
+            flask.flash(e.args[0], 'error')
             return flask.redirect('/')
 
-        if len(psk) < 8:
-            flask.flash('Password too short, please supply at least 8 characters.', 'error')
+        try:
+            insert_profiles(write_db, profiles, username, audit)
+            audit.commit()
+        except (SQLAlchemyError, AuditError) as e:
+            audit.rollback()
+            flask.flash(e.args[0], 'error')
             return flask.redirect('/')
 
+        manager.schedule_sync()
+        return flask.redirect('/')
+
+    @app.route('/stations', methods=['GET'])
+    @authorized_only(privilege='user')
+    def stations():
+        args = flask.request.args
+
         try:
-            start = datetime.strptime(start, '%Y-%m-%d')
-            stop  = datetime.strptime(stop,  '%Y-%m-%d') \
-                        + timedelta(+1, -1)
+            limit = int(args.get('limit', 0))
         except ValueError:
-            flask.flash('Invalid date format.', 'error')
-            return flask.redirect('/')
+            raise BadRequest('Invalid limit')
 
-        if start > stop:
-            flask.flash('Last day must not come before the first day.', 'error')
-            return flask.redirect('/')
+        if limit < 0:
+            raise BadRequest('Invalid limit')
 
-        new = manager.db.profile.insert(**{
-            'ssid': ssid,
-            'psk': psk,
-            'start': start,
-            'stop': stop,
-        })
+        limit = limit or None
+
+        snapshot = manager.get_stations()
+
+        aps = {args['ap']} if 'ap' in args else None
+
+        if 'zone' in args:
+            locations = manager.get_locations()
 
-        manager.db.audit.insert(**{
-            'user': username,
-            'profile': new.id,
-            'old_data': None,
-            'new_data': {
-                'ssid': ssid,
-                'psk': psk,
-                'start': start.strftime('%Y-%m-%d %H:%M:%S'),
-                'stop': stop.strftime('%Y-%m-%d %H:%M:%S'),
-             },
-            'time': datetime.now(),
+            in_zone = {ap for ap in snapshot.by_ap
+                       if locations.get(ap, 'Unknown') == args['zone']}
+
+            aps = in_zone if aps is None else aps & in_zone
+
+        selected = snapshot.select(essid=args.get('essid'),
+                                   aps=aps,
+                                   role=args.get('role'),
+                                   prefix=args.get('prefix'),
+                                   after=args.get('cursor'))
+
+        if args.get('format') == 'ndjson':
+            def generate():
+                for num, station in enumerate(selected):
+                    if limit is not None and num >= limit:
+                        break
+
+                    yield json.dumps(station) + '\n'
+
+            return flask.Response(generate(), mimetype='application/x-ndjson')
+
+        limit = min(limit or 100, 1000)
+        page = []
+
+        for station in selected:
+            if len(page) == limit:
+                break
+
+            page.append(station)
+
+        return flask.jsonify({
+            'time': snapshot.time,
+            'stations': page,
+            'next': page[-1]['mac'] if len(page) == limit else None,
         })
 
+    @app.route('/audit/export', methods=['GET'])
+    @authorized_only(privilege='admin')
+    def audit_export():
+        format = flask.request.args.get('format', 'ndjson')
+
+        if format not in ('ndjson', 'csv'):
+            raise BadRequest('Invalid format')
+
         try:
-            manager.db.commit()
-        except SQLAlchemyError as e:
-            manager.db.rollback()
-            flask.flash(e.args[0], 'error')
-            return flask.redirect('/')
+            start, stop = [datetime.strptime(flask.request.args[arg], '%Y-%m-%d')
+                           if flask.request.args.get(arg) else None
+                           for arg in ('from', 'to')]
+        except ValueError:
+            raise BadRequest('Invalid date format')
 
-        manager.schedule_sync()
-        return flask.redirect('/')
+        # The last day is inclusive.
+        if stop is not None:
+            stop += timedelta(days=1)
+
+        mimetype = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}[format]
+
+        return flask.Response(
+            flask.stream_with_context(export_audit(read_db, start, stop, format)),
+            mimetype=mimetype,
+            headers={'Content-Disposition':
+                     'attachment; filename=audit.{0}'.format(format)})
 
     @app.route('/zones', methods=['GET'])
     def zones():
@@ -355,48 +469,101 @@ def make_site(db, manager, access_model, debug=False):
         exclude = flask.request.args.get('exclude', '')
         exclude = re.split(r'\s+', exclude.strip())
 
-        zones = {}
-        locations = {}
+        # Stations are sampled periodically by the manager.
+        snapshot = manager.get_stations()
+        zones = snapshot.zone_counts(manager.get_locations(), exclude)
 
-        # Cache AP locations in memory.
-        for item in manager.db.location.all():
-            locations[item.ap] = item.location
-            zones.setdefault(item.location or 'Unknown', 0)
+        return flask.jsonify(zones)
+
+    @app.route('/zones/history', methods=['GET'])
+    def zones_history():
+        bucket = flask.request.args.get('bucket', 'hour')
+
+        if bucket not in ('hour', 'day'):
+            raise BadRequest('Invalid bucket')
+
+        history = manager.get_history()
+
+        if history is None:
+            raise NotFound('Zone history is not being collected')
+
+        # Estimates, accurate to a few percent.
+        return flask.jsonify({
+            'bucket': bucket,
+            'history': [{'time': label, 'zones': zones}
+                        for label, zones in history.counts(bucket)],
+        })
 
-        # Get information about all connected clients.
-        stations = manager.aruba.list_stations()
+    @app.route('/ready')
+    def ready():
+        if warmup is None:
+            return flask.jsonify({'ready': True})
 
-        # Calculate ratio of users per wireless device.
-        # Many users connect from multiple devices with the same credentials.
-        wifi_count = len(stations)
-        user_count = len(set(s['name'] for s in stations.values()))
-        ratio = user_count / wifi_count
+        status = warmup.status()
+        return flask.jsonify(status), 200 if status['ready'] else 503
 
-        # Split devices among the zones.
-        for station in stations.values():
-            if station['essid'] in exclude:
-                continue
+    @app.route('/metrics')
+    @authorized_only(privilege='admin')
+    def metrics():
+        # Every worker process reports on its own.
+        return flask.jsonify({
+            'pid': os.getpid(),
+            'controllers': manager.aruba.metrics(),
+            'sync': manager.sync_status,
+        })
 
-            location = locations.get(station['ap'], 'Unknown')
+    @app.route('/debug/profile', methods=['GET', 'POST'])
+    @authorized_only(privilege='admin')
+    def debug_profile():
+        if flask.request.method == 'POST':
             try:
-                zones[location] += 1
-            except KeyError:
-                print('AP {} not found in database'.format(location))
+                count = int(flask.request.values.get('requests', 10))
+            except ValueError:
+                raise BadRequest('Invalid number of requests')
 
+            profiler.arm(count)
 
-        # Convert devices counts into rounded user counts.
-        for zone in list(zones):
-            zones[zone] = round(zones[zone] * ratio)
+        return flask.jsonify({
+            'remaining': profiler.remaining,
+            'captured': profiler.captured,
+        })
 
-        return flask.jsonify(zones)
+    @app.route('/debug/profile.pstats')
+    @authorized_only(privilege='admin')
+    def debug_profile_download():
+        data = profiler.dump()
+
+        if data is None:
+            raise NotFound('No profile has been captured yet')
+
+        return flask.Response(data, mimetype='application/octet-stream',
+                              headers={'Content-Disposition':
+                                       'attachment; filename=wifinator.pstats'})
 
     @app.teardown_appcontext
     def shutdown_session(exception=None):
-        manager.db.rollback()
+        audit.rollback()
+        read_db.rollback()
 
 
     return app
 
 
+def warm_up_site(app, warmup):
+    """Compile all templates and load the PDF stack ahead of time."""
+
+    def compile_templates():
+        for name in app.jinja_env.list_templates(extensions=['html']):
+            app.jinja_env.get_template(name)
+
+    def load_pdf():
+        with app.test_request_context():
+            QRcode.qrcode('WIFI:S:warm-up;T:WPA;P:warm-up;;')
+            HTML(string='<p>Warm-up</p>').write_pdf()
+
+    warmup.run('templates', compile_templates)
+    warmup.run('pdf', load_pdf)
+
+
 # vim:set sw=4 ts=4 et:
 # -*- coding: utf-8 -*-
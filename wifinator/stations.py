@@ -0,0 +1,124 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['StationSnapshot']
+
+from bisect import bisect_left, bisect_right
+from time import time
+
+
+class StationSnapshot(object):
+    """
+    Immutable view of the controller station table at one moment.
+
+    Stations are kept sorted by their MAC address, which also serves as
+    the pagination cursor.  Secondary indexes map access points, ESSIDs
+    and user names to positions in that sorted list, so that filtered
+    queries do not need to scan the whole table.
+    """
+
+    def __init__(self, stations, timestamp=None):
+        self.time = timestamp or time()
+        self.stations = sorted(stations.values(), key=lambda s: s['mac'])
+        self.macs = [s['mac'] for s in self.stations]
+
+        self.by_ap = {}
+        self.by_essid = {}
+
+        for pos, station in enumerate(self.stations):
+            self.by_ap.setdefault(station['ap'], []).append(pos)
+            self.by_essid.setdefault(station['essid'], []).append(pos)
+
+        # Names are kept sorted for prefix lookups.
+        self.names = sorted((s['name'], pos) for pos, s in enumerate(self.stations))
+        self.name_keys = [name for name, pos in self.names]
+
+    def __len__(self):
+        return len(self.stations)
+
+    def zone_users(self, locations, exclude=()):
+        """
+        Distinct users connected in every zone.
+
+        The `locations` map access points to zones.  Stations connected
+        to unknown access points are only counted when there is an
+        `Unknown` zone.  Stations on any of the `exclude` ESSIDs are
+        ignored.  Users are identified by their login name, stations
+        without one by their MAC address.  Returns sets of users.
+        """
+
+        zones = {location: set() for location in locations.values()}
+
+        for station in self.stations:
+            if station['essid'] in exclude:
+                continue
+
+            users = zones.get(locations.get(station['ap'], 'Unknown'))
+
+            if users is not None:
+                users.add(station['name'] or station['mac'])
+
+        return zones
+
+    def zone_counts(self, locations, exclude=()):
+        """
+        Count distinct users in every zone, see `zone_users`.
+
+        A user with multiple devices in the same zone is counted once,
+        but users with devices in multiple zones count in each of them.
+        """
+
+        return {zone: len(users) for zone, users
+                in self.zone_users(locations, exclude).items()}
+
+    def with_prefix(self, prefix):
+        """Positions of stations with user name starting with `prefix`."""
+
+        lo = bisect_left(self.name_keys, prefix)
+        hi = bisect_right(self.name_keys, prefix + '\U0010ffff')
+        return sorted(pos for name, pos in self.names[lo:hi])
+
+    def select(self, essid=None, aps=None, role=None, prefix=None, after=None):
+        """
+        Iterate over stations matching all of the given criteria.
+
+        The `aps` is a collection of access points, any of which the
+        station may be connected to.  Stations with MAC address not
+        greater than `after` are skipped, in order to resume a previous
+        listing.
+        """
+
+        candidates = []
+
+        if essid is not None:
+            candidates.append(self.by_essid.get(essid, []))
+
+        if aps is not None:
+            candidates.append(sorted(pos for ap in set(aps)
+                                         for pos in self.by_ap.get(ap, [])))
+
+        if prefix:
+            candidates.append(self.with_prefix(prefix))
+
+        if candidates:
+            candidates.sort(key=len)
+            others = [set(c) for c in candidates[1:]]
+            positions = [pos for pos in candidates[0]
+                         if all(pos in other for other in others)]
+        else:
+            positions = range(len(self.stations))
+
+        if after is not None:
+            first = bisect_right(self.macs, after)
+            positions = positions[bisect_left(positions, first):]
+
+        for pos in positions:
+            station = self.stations[pos]
+
+            if role is not None and station['role'] != role:
+                continue
+
+            yield station
+
+
+# vim:set sw=4 ts=4 et:
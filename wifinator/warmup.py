@@ -0,0 +1,120 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+__all__ = ['WarmUp', 'reflect_tables', 'TABLES']
+
+from threading import Lock
+from time import perf_counter
+
+from twisted.python import log
+
+
+# Tables the website and the background tasks work with.
+TABLES = ('profile', 'audit', 'location')
+
+
+def reflect_tables(db, tables=TABLES):
+    """Reflect tables that SQLSoup would otherwise reflect on first use."""
+
+    for name in tables:
+        db.entity(name)
+
+
+class WarmUp(object):
+    """
+    Preparation of the process before it starts accepting requests.
+
+    Every step is timed and logged.  Steps that fail are only logged
+    as well, since it is better to serve slowly or partially than not
+    at all, and can be run again using `retry()`.  The process is ready
+    once `finish()` has been called and no step remains failed.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.steps = {}
+        self.calls = {}
+        self.finished = False
+        self.started = perf_counter()
+        self.total = None
+
+    def run(self, name, fn, *args):
+        """Run a single step, return whether it succeeded."""
+
+        start = perf_counter()
+        error = None
+
+        try:
+            fn(*args)
+        except Exception as e:
+            log.err(None, 'Warm-up step {0} failed'.format(name))
+            error = str(e)
+
+        duration = perf_counter() - start
+
+        with self.lock:
+            attempts = self.steps.get(name, {}).get('attempts', 0)
+
+            self.steps[name] = {
+                'name': name,
+                'duration': duration,
+                'error': error,
+                'attempts': attempts + 1,
+            }
+
+            self.calls[name] = (fn, args)
+
+        log.msg('Warm-up step {0} took {1:.3f}s'.format(name, duration))
+        return error is None
+
+    def failed(self):
+        """Names of the failed steps, in the order they were first run."""
+
+        with self.lock:
+            return [name for name, step in self.steps.items()
+                    if step['error'] is not None]
+
+    @property
+    def ready(self):
+        return self.finished and not self.failed()
+
+    def finish(self):
+        self.total = perf_counter() - self.started
+        self.finished = True
+
+        log.msg('Warm-up finished in {0:.3f}s'.format(self.total))
+
+        failed = self.failed()
+
+        if failed:
+            log.msg('Warm-up steps failed: {0}'.format(', '.join(failed)))
+
+    def retry(self):
+        """
+        Run the failed steps again, return whether we are ready now.
+
+        Stops at the first step that fails again, since the later ones
+        usually depend on it.  Blocks, run it in a thread.
+        """
+
+        for name in self.failed():
+            fn, args = self.calls[name]
+
+            if not self.run(name, fn, *args):
+                return False
+
+        log.msg('Warm-up steps recovered, ready.')
+        return self.ready
+
+    def status(self):
+        with self.lock:
+            steps = [dict(step) for step in self.steps.values()]
+
+        return {
+            'ready': self.finished and all(s['error'] is None for s in steps),
+            'total': self.total,
+            'steps': steps,
+        }
+
+
+# vim:set sw=4 ts=4 et: